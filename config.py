@@ -16,6 +16,13 @@ class ChunkType(StrEnum):
     TABLE = "table"
 
 
+class ParseArtifactMode(StrEnum):
+    # only in-memory content list and images are produced
+    LEAN = "lean"
+    # parser intermediate results are also rendered and kept on disk
+    DEBUG = "debug"
+
+
 @run_once
 def init_root_config():
     # logger
@@ -46,6 +53,13 @@ def init_root_config():
                                          'tiny_rag_parsed_assets')
     logging.info(f"parsed asset data dir: {PARSED_ASSET_DATA_DIR}")
 
+    # unreferenced parsed assets are deleted after the grace period, assets of
+    # documents being indexed are not referenced yet.
+    global ASSET_GC_GRACE_SECONDS
+    ASSET_GC_GRACE_SECONDS = int(os.environ.get('ASSET_GC_GRACE_SECONDS',
+                                                3600))
+    logging.info(f'asset gc grace seconds: {ASSET_GC_GRACE_SECONDS}')
+
     # ======================================================================== #
     # PDF parser
     global PDF_PARSER_NAME, PDF_PARSER_CONFIG_PATH
@@ -55,6 +69,59 @@ def init_root_config():
     logging.info(f'pdf parser name: {PDF_PARSER_NAME}')
     logging.info(f'pdf parser config path: {PDF_PARSER_CONFIG_PATH}')
 
+    # parsed content cache, keyed by file content hash and page hash. Least
+    # recently used entries are evicted beyond PARSE_CACHE_MAX_MB, 0 for no
+    # limit.
+    global PARSE_CACHE_ENABLE, PARSE_CACHE_DIR, PARSE_CACHE_MAX_MB
+    PARSE_CACHE_ENABLE = os.environ.get('PARSE_CACHE_ENABLE',
+                                        '1').lower() in ['1', 'true']
+    PARSE_CACHE_DIR = os.path.join(RAG_DATA_DIR, 'parse_cache',
+                                   PDF_PARSER_NAME)
+    PARSE_CACHE_MAX_MB = int(os.environ.get('PARSE_CACHE_MAX_MB', 10240))
+    logging.info(f'parse cache enable: {PARSE_CACHE_ENABLE}')
+    logging.info(f'parse cache dir: {PARSE_CACHE_DIR}')
+    logging.info(f'parse cache max mb: {PARSE_CACHE_MAX_MB}')
+
+    # pages with a usable text layer are extracted directly, only scanned pages
+    # are analyzed by parser models.
+    global PDF_TEXT_LAYER_ENABLE, PDF_TEXT_LAYER_MIN_CHARS
+    PDF_TEXT_LAYER_ENABLE = os.environ.get('PDF_TEXT_LAYER_ENABLE',
+                                           '1').lower() in ['1', 'true']
+    PDF_TEXT_LAYER_MIN_CHARS = int(
+        os.environ.get('PDF_TEXT_LAYER_MIN_CHARS', 200))
+    logging.info(f'pdf text layer enable: {PDF_TEXT_LAYER_ENABLE}')
+    logging.info(f'pdf text layer min chars: {PDF_TEXT_LAYER_MIN_CHARS}')
+
+    # large PDFs are split into shards of consecutive pages, shards are parsed
+    # in parallel worker processes. 0 shard pages disables sharding.
+    global PDF_PARSE_WORKERS, PDF_PARSE_SHARD_PAGES
+    PDF_PARSE_WORKERS = int(os.environ.get('PDF_PARSE_WORKERS', 1))
+    PDF_PARSE_SHARD_PAGES = int(os.environ.get('PDF_PARSE_SHARD_PAGES', 32))
+    logging.info(f'pdf parse workers: {PDF_PARSE_WORKERS}')
+    logging.info(f'pdf parse shard pages: {PDF_PARSE_SHARD_PAGES}')
+
+    # debug mode keeps MinerU intermediate artifacts, i.e., rendered model /
+    # layout / span pdfs, markdown and json dumps, under debug dir.
+    global PDF_PARSE_ARTIFACT_MODE, PDF_PARSE_DEBUG_DIR
+    PDF_PARSE_ARTIFACT_MODE = ParseArtifactMode(
+        os.environ.get('PDF_PARSE_ARTIFACT_MODE', ParseArtifactMode.LEAN))
+    PDF_PARSE_DEBUG_DIR = os.path.join(RAG_DATA_DIR, 'parse_debug')
+    logging.info(f'pdf parse artifact mode: {PDF_PARSE_ARTIFACT_MODE}')
+    logging.info(f'pdf parse debug dir: {PDF_PARSE_DEBUG_DIR}')
+
+    # chunk size budget in tokens, tokens are counted by embedding model
+    # tokenizer ('embed') or estimated ('estimate').
+    global CHUNK_MIN_TOKENS, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+    global CHUNK_TOKENIZER
+    CHUNK_MIN_TOKENS = int(os.environ.get('CHUNK_MIN_TOKENS', 200))
+    CHUNK_MAX_TOKENS = int(os.environ.get('CHUNK_MAX_TOKENS', 512))
+    CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 64))
+    CHUNK_TOKENIZER = os.environ.get('CHUNK_TOKENIZER', 'embed')
+    logging.info(f'chunk min tokens: {CHUNK_MIN_TOKENS}')
+    logging.info(f'chunk max tokens: {CHUNK_MAX_TOKENS}')
+    logging.info(f'chunk overlap tokens: {CHUNK_OVERLAP_TOKENS}')
+    logging.info(f'chunk tokenizer: {CHUNK_TOKENIZER}')
+
     # ======================================================================== #
     # embedding model
     global EMBED_MODEL_CONFIG_PATH, EMBED_DENSE_DIM, EMBED_MODEL_NAME
@@ -66,6 +133,119 @@ def init_root_config():
     logging.info(f'embed model config file path: {EMBED_MODEL_CONFIG_PATH}')
     logging.info(f'embed model dense embed dim: {EMBED_DENSE_DIM}')
 
+    # batch limits when embedding chunks in bulk, a batch is closed once either
+    # chunk number or total embedded characters reaches the limit.
+    global EMBED_BATCH_SIZE, EMBED_BATCH_MAX_CHARS
+    EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', 32))
+    EMBED_BATCH_MAX_CHARS = int(
+        os.environ.get('EMBED_BATCH_MAX_CHARS', 64 * 1024))
+    logging.info(f'embed batch size: {EMBED_BATCH_SIZE}')
+    logging.info(f'embed batch max chars: {EMBED_BATCH_MAX_CHARS}')
+
+    # persistent embedding cache, keyed by model name and embedded text hash.
+    # set EMBED_CACHE_MAX_MB to 0 to disable the cache.
+    global EMBED_CACHE_DIR, EMBED_CACHE_MAX_MB
+    EMBED_CACHE_DIR = os.path.join(RAG_DATA_DIR, 'embed_cache')
+    EMBED_CACHE_MAX_MB = int(os.environ.get('EMBED_CACHE_MAX_MB', 1024))
+    logging.info(f'embed cache dir: {EMBED_CACHE_DIR}')
+    logging.info(f'embed cache max mb: {EMBED_CACHE_MAX_MB}')
+
+    # ============================================================================ #
+    # ingestion pipeline
+    # NOTE: each parse worker process loads its own parser models, set parse
+    # workers according to available memory.
+    global INGEST_HASH_WORKERS, INGEST_PARSE_WORKERS, INGEST_QUEUE_SIZE
+    INGEST_HASH_WORKERS = int(os.environ.get('INGEST_HASH_WORKERS', 2))
+    INGEST_PARSE_WORKERS = int(os.environ.get('INGEST_PARSE_WORKERS', 2))
+    INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 8))
+    logging.info(f'ingest hash workers: {INGEST_HASH_WORKERS}')
+    logging.info(f'ingest parse workers: {INGEST_PARSE_WORKERS}')
+    logging.info(f'ingest queue size: {INGEST_QUEUE_SIZE}')
+
+    # jobs wait for parse in order of estimated parse seconds, boosted if the
+    # file is modified within recent seconds. Jobs estimated longer than large
+    # job seconds never occupy all parse workers.
+    global INGEST_LARGE_JOB_SECONDS, INGEST_RECENT_SECONDS
+    INGEST_LARGE_JOB_SECONDS = float(
+        os.environ.get('INGEST_LARGE_JOB_SECONDS', 60))
+    INGEST_RECENT_SECONDS = float(os.environ.get('INGEST_RECENT_SECONDS', 600))
+    logging.info(f'ingest large job seconds: {INGEST_LARGE_JOB_SECONDS}')
+    logging.info(f'ingest recent seconds: {INGEST_RECENT_SECONDS}')
+
+    # backpressure, submitting blocks once max pending jobs are unfinished, and
+    # parse waits while parsed content in flight exceeds memory budget. Files
+    # larger than stream file size are indexed in streaming mode.
+    global INGEST_MAX_PENDING_JOBS, INGEST_MEMORY_BUDGET_MB, INGEST_STREAM_FILE_SIZE_MB
+    INGEST_MAX_PENDING_JOBS = int(
+        os.environ.get('INGEST_MAX_PENDING_JOBS', 1000))
+    INGEST_MEMORY_BUDGET_MB = int(
+        os.environ.get('INGEST_MEMORY_BUDGET_MB', 1024))
+    INGEST_STREAM_FILE_SIZE_MB = int(
+        os.environ.get('INGEST_STREAM_FILE_SIZE_MB', 64))
+    logging.info(f'ingest max pending jobs: {INGEST_MAX_PENDING_JOBS}')
+    logging.info(f'ingest memory budget mb: {INGEST_MEMORY_BUDGET_MB}')
+    logging.info(f'ingest stream file size mb: {INGEST_STREAM_FILE_SIZE_MB}')
+
+    # files are parsed in dedicated worker processes, workers are recycled
+    # after max tasks or when rss is too high, and killed on timeout. Files
+    # failing all retries are quarantined until changed.
+    global PARSE_WORKER_MAX_TASKS, PARSE_WORKER_MAX_RSS_MB
+    global PARSE_TIMEOUT_SECONDS, PARSE_MAX_RETRIES, PARSE_QUARANTINE_PATH
+    PARSE_WORKER_MAX_TASKS = int(os.environ.get('PARSE_WORKER_MAX_TASKS', 20))
+    PARSE_WORKER_MAX_RSS_MB = int(
+        os.environ.get('PARSE_WORKER_MAX_RSS_MB', 8192))
+    PARSE_TIMEOUT_SECONDS = float(
+        os.environ.get('PARSE_TIMEOUT_SECONDS', 1800))
+    PARSE_MAX_RETRIES = int(os.environ.get('PARSE_MAX_RETRIES', 1))
+    PARSE_QUARANTINE_PATH = os.path.join(RAG_DATA_DIR,
+                                         'parse_quarantine.json')
+    logging.info(f'parse worker max tasks: {PARSE_WORKER_MAX_TASKS}')
+    logging.info(f'parse worker max rss mb: {PARSE_WORKER_MAX_RSS_MB}')
+    logging.info(f'parse timeout seconds: {PARSE_TIMEOUT_SECONDS}')
+    logging.info(f'parse max retries: {PARSE_MAX_RETRIES}')
+    logging.info(f'parse quarantine path: {PARSE_QUARANTINE_PATH}')
+
+    # ingestion jobs are persisted and resumed after restart, parsed chunks are
+    # checkpointed so that a resumed job needs no parse. A job interrupted more
+    # than max attempts times, e.g., crashing the server, is marked failed.
+    global INGEST_JOB_DB_PATH, INGEST_CHECKPOINT_DIR, INGEST_JOB_MAX_ATTEMPTS
+    INGEST_JOB_DB_PATH = os.path.join(RAG_DATA_DIR, 'ingest_jobs.db')
+    INGEST_CHECKPOINT_DIR = os.path.join(RAG_DATA_DIR, 'ingest_checkpoint')
+    INGEST_JOB_MAX_ATTEMPTS = int(os.environ.get('INGEST_JOB_MAX_ATTEMPTS', 3))
+    logging.info(f'ingest job db path: {INGEST_JOB_DB_PATH}')
+    logging.info(f'ingest checkpoint dir: {INGEST_CHECKPOINT_DIR}')
+    logging.info(f'ingest job max attempts: {INGEST_JOB_MAX_ATTEMPTS}')
+
+    # file events of a path are coalesced and only handled once the file stays
+    # unchanged for this many seconds.
+    global INGEST_SETTLE_SECONDS
+    INGEST_SETTLE_SECONDS = float(os.environ.get('INGEST_SETTLE_SECONDS', 2.0))
+    logging.info(f'ingest settle seconds: {INGEST_SETTLE_SECONDS}')
+
+    # file directory is polled instead of watched by filesystem events, e.g.,
+    # docker bind mounts of macos host where events are lost. Scan interval
+    # adapts between min and max seconds, each scan stats at most stat batch
+    # files so that scan cost stays flat for large directories.
+    global FILE_WATCH_POLLING, FILE_WATCH_POLL_MIN_SECONDS, FILE_WATCH_POLL_MAX_SECONDS, FILE_WATCH_POLL_STAT_BATCH
+    FILE_WATCH_POLLING = os.environ.get('FILE_WATCH_POLLING',
+                                        '0').lower() in ['1', 'true']
+    FILE_WATCH_POLL_MIN_SECONDS = float(
+        os.environ.get('FILE_WATCH_POLL_MIN_SECONDS', 1.0))
+    FILE_WATCH_POLL_MAX_SECONDS = float(
+        os.environ.get('FILE_WATCH_POLL_MAX_SECONDS', 30.0))
+    FILE_WATCH_POLL_STAT_BATCH = int(
+        os.environ.get('FILE_WATCH_POLL_STAT_BATCH', 2000))
+    logging.info(f'file watch polling: {FILE_WATCH_POLLING}')
+    logging.info(f'file watch poll min seconds: {FILE_WATCH_POLL_MIN_SECONDS}')
+    logging.info(f'file watch poll max seconds: {FILE_WATCH_POLL_MAX_SECONDS}')
+    logging.info(f'file watch poll stat batch: {FILE_WATCH_POLL_STAT_BATCH}')
+
+    # number of threads hashing changed file candidates on startup.
+    global STARTUP_HASH_WORKERS
+    STARTUP_HASH_WORKERS = int(
+        os.environ.get('STARTUP_HASH_WORKERS', min(32, os.cpu_count() or 1)))
+    logging.info(f'startup hash workers: {STARTUP_HASH_WORKERS}')
+
     # ============================================================================ #
     # vector db config
     global MILVUS_ROOT_DATA_DIR, MILVUS_DB_NAME, MILVUS_COLLECTION_NAME
@@ -1,10 +1,20 @@
+import config
 from .pdf_parser import PDFParser
-from .parser import Parser
+from .text_parser import TextParser, MarkdownParser
+from .docx_parser import DocxParser
+from .parser import Parser, SupportedFileType
 
 Pasers = {
     'MinerU': PDFParser,
 }
 
+# parsers of non-pdf files, pdf parser is selected by `config.PDF_PARSER_NAME`.
+FileParsers = {
+    SupportedFileType.TXT: TextParser,
+    SupportedFileType.MD: MarkdownParser,
+    SupportedFileType.DOCX: DocxParser,
+}
+
 
 def get_parser(name: str = "MinerU") -> Parser:
     if name not in Pasers:
@@ -13,3 +23,18 @@ def get_parser(name: str = "MinerU") -> Parser:
         raise Exception(msg)
     p = Pasers[name]
     return p()
+
+
+def get_file_parser(file_path: str) -> Parser:
+    """
+    Get parser by file postfix.
+    """
+    postfix = file_path.split('.')[-1].lower()
+    if postfix == SupportedFileType.PDF:
+        return get_parser(config.PDF_PARSER_NAME)
+    if postfix not in FileParsers:
+        msg = f"unsupported file type: {postfix}" + "\n" \
+            f"supported file types are {[k.value for k in SupportedFileType]}"
+        raise Exception(msg)
+    p = FileParsers[postfix]
+    return p()
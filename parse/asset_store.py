@@ -0,0 +1,222 @@
+import os
+import time
+import shutil
+import sqlite3
+import logging
+import tempfile
+import threading
+
+import config
+from utils import get_file_hash64, logging_exception
+
+
+class AssetStore:
+    """
+    Content addressed store of parsed assets, e.g., images. An asset is placed
+    by its content hash, hard linked from the parsed file if possible, so the
+    same image parsed from many documents or many times takes one file and no
+    copy.
+
+    Assets are reference counted by chunk uuid. An asset is an orphan from
+    `put` until referenced, and again once its last reference is released, so
+    that assets of failed or superseded jobs, never referenced, are deleted by
+    `gc` as well. Orphans are kept for `gc_grace_seconds`, they may belong to a
+    document still being indexed.
+
+    Layout:
+    - `{root_dir}/{hash[:2]}/{hash}{ext}`
+    - `{root_dir}/assets.db`: chunk references and orphan assets with the time
+        they became orphans.
+    """
+
+    def __init__(self, root_dir: str, gc_grace_seconds: float = 3600):
+        self.root_dir = root_dir
+        self.gc_grace_seconds = gc_grace_seconds
+        os.makedirs(root_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(root_dir, 'assets.db'),
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS asset_ref ('
+                           'uuid TEXT PRIMARY KEY, '
+                           'asset TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS asset_ref_asset '
+                           'ON asset_ref (asset)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS asset_orphan ('
+                           'asset TEXT PRIMARY KEY, '
+                           'orphan_time REAL NOT NULL DEFAULT 0)')
+        self._conn.commit()
+
+    def put(self, src_path: str) -> str:
+        """
+        Put a file into store, the source file is left as is. An asset not
+        referenced yet is recorded as an orphan, see `gc`.
+
+        Returns:
+        - Absolute path of the asset in store.
+        """
+        h = get_file_hash64(src_path)
+        ext = os.path.splitext(src_path)[1].lower()
+        dst_path = os.path.join(self.root_dir, h[:2], f'{h}{ext}')
+        if os.path.exists(dst_path):
+            # refresh mtime, so that gc keeps an asset being reused
+            os.utime(dst_path)
+            self._add_orphan(dst_path)
+            return dst_path
+
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path))
+        os.close(fd)
+        try:
+            try:
+                os.unlink(temp_path)
+                os.link(src_path, temp_path)
+            except OSError:
+                # cross device or no hard link support
+                shutil.copyfile(src_path, temp_path)
+            os.replace(temp_path, dst_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        os.utime(dst_path)
+        self._add_orphan(dst_path)
+        return dst_path
+
+    def _add_orphan(self, path: str):
+        """
+        Record an asset just put as an orphan unless it is referenced.
+        """
+        asset = self.asset_key(path)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO asset_orphan (asset, orphan_time) '
+                'SELECT ?, ? WHERE NOT EXISTS '
+                '(SELECT 1 FROM asset_ref WHERE asset = ?)',
+                (asset, time.time(), asset))
+            self._conn.commit()
+
+    def asset_key(self, path: str) -> str:
+        """
+        Returns:
+        - Asset key of an asset path, i.e., `{hash[:2]}/{hash}{ext}`. Path put
+            by another process into the same store gives the same key.
+        """
+        name = os.path.basename(path)
+        return os.path.join(name[:2], name)
+
+    def add_refs(self, refs: dict[str, str]):
+        """
+        Args:
+        - refs: chunk uuid to absolute asset path returned by `put`.
+        """
+        if len(refs) == 0:
+            return
+        rows = [(uuid, self.asset_key(path)) for uuid, path in refs.items()]
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO asset_ref (uuid, asset) VALUES (?, ?)',
+                rows)
+            self._conn.executemany('DELETE FROM asset_orphan WHERE asset = ?',
+                                   [(asset, ) for _, asset in rows])
+            self._conn.commit()
+
+    def rekey_refs(self, keys: dict[str, str]):
+        """
+        Move references to new chunk uuids, e.g., chunks of a renamed document.
+
+        Args:
+        - keys: old chunk uuid to new chunk uuid.
+        """
+        if len(keys) == 0:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE OR REPLACE asset_ref SET uuid = ? WHERE uuid = ?',
+                [(new, old) for old, new in keys.items()])
+            self._conn.commit()
+
+    def release(self, uuids: list[str]) -> int:
+        """
+        Drop references of chunks, assets left without reference become
+        orphans to be deleted by `gc`.
+
+        Returns:
+        - Number of new orphan assets.
+        """
+        if len(uuids) == 0:
+            return 0
+        with self._lock:
+            assets = set()
+            for i in range(0, len(uuids), 500):
+                batch = uuids[i:i + 500]
+                marks = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f'SELECT asset FROM asset_ref WHERE uuid IN ({marks})',
+                    batch).fetchall()
+                assets.update(r[0] for r in rows)
+                self._conn.execute(
+                    f'DELETE FROM asset_ref WHERE uuid IN ({marks})', batch)
+
+            orphans = [
+                asset for asset in assets if self._conn.execute(
+                    'SELECT 1 FROM asset_ref WHERE asset = ? LIMIT 1',
+                    (asset, )).fetchone() is None
+            ]
+            now = time.time()
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO asset_orphan (asset, orphan_time) '
+                'VALUES (?, ?)', [(asset, now) for asset in orphans])
+            self._conn.commit()
+        return len(orphans)
+
+    def gc(self) -> int:
+        """
+        Delete assets orphaned, and not written, within `gc_grace_seconds`.
+
+        Returns:
+        - Number of deleted assets.
+        """
+        deadline = time.time() - self.gc_grace_seconds
+        deleted = 0
+        with self._lock:
+            orphans = [
+                r[0] for r in self._conn.execute(
+                    'SELECT asset FROM asset_orphan WHERE orphan_time <= ?',
+                    (deadline, )).fetchall()
+            ]
+            for asset in orphans:
+                path = os.path.join(self.root_dir, asset)
+                try:
+                    if os.path.exists(path):
+                        if os.path.getmtime(path) > deadline:
+                            continue
+                        os.unlink(path)
+                        deleted += 1
+                except Exception as e:
+                    logging_exception(e)
+                    continue
+                self._conn.execute('DELETE FROM asset_orphan WHERE asset = ?',
+                                   (asset, ))
+            self._conn.commit()
+        if deleted > 0:
+            logging.info(f'asset store: delete {deleted} orphan assets')
+        return deleted
+
+
+_asset_stores = {}
+_asset_stores_lock = threading.Lock()
+
+
+def get_asset_store(root_dir: str = None) -> AssetStore:
+    """
+    Get asset store of `root_dir`, default to `config.PARSED_ASSET_DATA_DIR`.
+    """
+    root_dir = root_dir or config.PARSED_ASSET_DATA_DIR
+    with _asset_stores_lock:
+        if root_dir not in _asset_stores:
+            _asset_stores[root_dir] = AssetStore(
+                root_dir=root_dir,
+                gc_grace_seconds=config.ASSET_GC_GRACE_SECONDS,
+            )
+        return _asset_stores[root_dir]
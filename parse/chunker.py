@@ -0,0 +1,306 @@
+import re
+import json
+import logging
+import threading
+from typing import Callable, Iterable, Iterator, Union
+
+import config
+from utils import estimate_token_num, logging_exception
+
+# a sentence with its trailing punctuation and spaces, newline also ends a
+# sentence.
+_sentence_pattern = re.compile(r'[^.!?;。！？；\n]*(?:[.!?;。！？；\n]+|$)\s*')
+_word_pattern = re.compile(r'\S+\s*|\s+')
+
+
+class _TextCursor:
+    """
+    Read position in the text of a block cut across chunks. The text is split
+    into sentences once and a sentence into words only when it is cut, so that
+    cutting a long block takes linear time.
+    """
+
+    def __init__(self, text: str, count_tokens: Callable[[str], int]):
+        self.count_tokens = count_tokens
+        self.sentences = [s for s in _sentence_pattern.findall(text) if s]
+        self.index = 0
+        # tokens of current sentence, None if not counted yet
+        self.sentence_tokens = None
+        # (word, tokens) of current sentence once it is split by words
+        self.words = None
+        self.word_index = 0
+        # characters taken from current word
+        self.offset = 0
+
+    def done(self) -> bool:
+        return self.index >= len(self.sentences)
+
+    def peek(self, budget: int) -> tuple[str, int]:
+        """
+        Returns:
+        - Next unit of text, within `budget` tokens if possible, and its
+            tokens: the next sentence, or the next word of a sentence longer
+            than `budget`, or next characters of a word longer than `budget`.
+        """
+        if self.words is None:
+            sentence = self.sentences[self.index]
+            if self.sentence_tokens is None:
+                self.sentence_tokens = self.count_tokens(sentence)
+            if self.sentence_tokens <= budget:
+                return sentence, self.sentence_tokens
+            self.words = [(word, self.count_tokens(word))
+                          for word in _word_pattern.findall(sentence)]
+            self.word_index = 0
+
+        word, word_tokens = self.words[self.word_index]
+        if self.offset == 0 and word_tokens <= budget:
+            return word, word_tokens
+        # no space in between, e.g., long CJK text, cut by characters
+        step = max(1, len(word) * budget // word_tokens)
+        piece = word[self.offset:self.offset + step]
+        return piece, self.count_tokens(piece)
+
+    def advance(self, unit: str):
+        """
+        Move past `unit`, the text last returned by `peek`.
+        """
+        if self.words is not None:
+            self.offset += len(unit)
+            if self.offset < len(self.words[self.word_index][0]):
+                return
+            self.offset = 0
+            self.word_index += 1
+            if self.word_index < len(self.words):
+                return
+            self.words = None
+        self.index += 1
+        self.sentence_tokens = None
+
+    def rest(self) -> str:
+        """
+        Returns:
+        - Text not read yet.
+        """
+        if self.words is None:
+            return ''.join(self.sentences[self.index:])
+        word_rest = ''.join(word for word, _ in self.words[self.word_index:])
+        return word_rest[self.offset:] + ''.join(
+            self.sentences[self.index + 1:])
+
+
+class TokenChunker:
+    """
+    Group content blocks into chunks by token budget:
+    - text / equation blocks are packed into a chunk until adding the next
+        block would exceed `max_tokens`, a block longer than `max_tokens` is
+        split by sentences, then by words.
+    - a headline block, i.e., `text_level` set, starts a new chunk once the
+        current chunk reaches `min_tokens`, shorter sections are merged into
+        the next one.
+    - a chunk closed by the token budget passes its last `overlap_tokens`
+        tokens, at sentence granularity, to the next chunk, chunks closed at a
+        headline have no overlap.
+    - image / table blocks are independent chunks, emitted when met.
+    """
+
+    def __init__(
+        self,
+        min_tokens: int = 200,
+        max_tokens: int = 512,
+        overlap_tokens: int = 64,
+        count_tokens: Callable[[str], int] = None,
+    ):
+        """
+        Args:
+        - min_tokens: min tokens of a chunk closed at a headline.
+        - max_tokens: max tokens of a chunk.
+        - overlap_tokens: max tokens shared by two consecutive chunks.
+        - count_tokens: token counter, default to `get_token_counter()`.
+        """
+        assert 0 < min_tokens <= max_tokens, \
+            f'min tokens ({min_tokens}) should be in (0, max tokens ({max_tokens})]'
+        assert 0 <= overlap_tokens < max_tokens, \
+            f'overlap tokens ({overlap_tokens}) should be less than max tokens ({max_tokens})'
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens or get_token_counter()
+
+    def iter_groups(
+        self,
+        blocks: Iterable[dict],
+    ) -> Iterator[Union[dict, list[dict]]]:
+        """
+        Returns:
+        - An iterator of either an image / table block dict, or a list of text
+            blocks making up one text chunk. Blocks split across chunks are
+            yielded as copies holding part of the text.
+        """
+        # pieces of current chunk, (block index, block, text, tokens)
+        pieces = []
+        # tokens of current chunk, not counting overlap from previous chunk
+        new_tokens = 0
+        for block_idx, block in enumerate(blocks):
+            if block['type'] in ['image', 'table']:
+                yield block
+                continue
+            if block['type'] not in ['text', 'equation']:
+                continue
+
+            if block.get('text_level') is not None:
+                if new_tokens >= self.min_tokens:
+                    yield self._merge(pieces)
+                    pieces, new_tokens = [], 0
+                elif new_tokens == 0:
+                    # drop overlap carried into a new section
+                    pieces = []
+
+            text = str(block['text'])
+            if len(text) == 0:
+                continue
+            tokens = self.count_tokens(text)
+            # sentences are only split once the block does not fit
+            cursor = None
+            while cursor is None or not cursor.done():
+                used = sum(p[3] for p in pieces)
+                if used + tokens <= self.max_tokens:
+                    if cursor is not None:
+                        text = cursor.rest()
+                    pieces.append((block_idx, block, text, tokens))
+                    new_tokens += tokens
+                    break
+
+                # block does not fit, close current chunk if it is large
+                # enough, otherwise fill it with the head of the block.
+                if new_tokens >= self.min_tokens:
+                    yield self._merge(pieces)
+                    pieces, new_tokens = self._tail(pieces), 0
+                    continue
+                if cursor is None:
+                    cursor = _TextCursor(text, self.count_tokens)
+                head, head_tokens = self._cut(cursor,
+                                              budget=self.max_tokens - used,
+                                              force=len(pieces) == 0)
+                if len(head) > 0:
+                    pieces.append((block_idx, block, head, head_tokens))
+                    new_tokens += head_tokens
+                    tokens = max(0, tokens - head_tokens)
+                elif new_tokens > 0:
+                    yield self._merge(pieces)
+                    pieces, new_tokens = self._tail(pieces), 0
+                else:
+                    # overlap leaves no room for the block, drop overlap
+                    pieces = []
+
+        if new_tokens > 0:
+            yield self._merge(pieces)
+
+    def _cut(self, cursor: _TextCursor, budget: int,
+             force: bool) -> tuple[str, int]:
+        """
+        Cut the longest head of remaining text within `budget` tokens, at
+        sentence boundary if possible, then word boundary, then character.
+
+        Args:
+        - cursor: remaining text, moved past the head.
+        - budget: max tokens of the head.
+        - force: return at least one unit even if it exceeds `budget`.
+
+        Returns:
+        - Head text and its tokens.
+        """
+        head, head_tokens = [], 0
+        while not cursor.done():
+            unit, unit_tokens = cursor.peek(budget=max(1, budget))
+            if head_tokens + unit_tokens > budget and \
+                    (len(head) > 0 or not force):
+                break
+            cursor.advance(unit)
+            head.append(unit)
+            head_tokens += unit_tokens
+        return ''.join(head), head_tokens
+
+    def _sentences(self, text: str) -> list[str]:
+        return [s for s in _sentence_pattern.findall(text) if s]
+
+    def _tail(self, pieces: list[tuple]) -> list[tuple]:
+        """
+        Returns:
+        - Trailing pieces within `overlap_tokens` tokens, the earliest piece may
+            be cut to its trailing sentences.
+        """
+        budget = self.overlap_tokens
+        tail = []
+        for block_idx, block, text, tokens in reversed(pieces):
+            if tokens <= budget:
+                tail.append((block_idx, block, text, tokens))
+                budget -= tokens
+                continue
+            sentences, sentences_tokens = [], 0
+            for sentence in reversed(self._sentences(text)):
+                sentence_tokens = self.count_tokens(sentence)
+                if sentences_tokens + sentence_tokens > budget:
+                    break
+                sentences.insert(0, sentence)
+                sentences_tokens += sentence_tokens
+            if len(sentences) > 0:
+                tail.append(
+                    (block_idx, block, ''.join(sentences), sentences_tokens))
+            break
+        tail.reverse()
+        return tail
+
+    def _merge(self, pieces: list[tuple]) -> list[dict]:
+        """
+        Merge consecutive pieces of the same block back into one block.
+        """
+        blocks = []
+        last_idx = None
+        for block_idx, block, text, _ in pieces:
+            if block_idx == last_idx:
+                blocks[-1]['text'] += text
+                continue
+            blocks.append(dict(block, text=text))
+            last_idx = block_idx
+        return blocks
+
+
+def _load_embed_tokenizer():
+    from transformers import AutoTokenizer
+
+    with open(config.EMBED_MODEL_CONFIG_PATH) as f:
+        model_config = json.load(f)
+    return AutoTokenizer.from_pretrained(model_config['model_name_or_path'])
+
+
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+
+def get_token_counter() -> Callable[[str], int]:
+    """
+    Get token counter of the embedding model tokenizer, so that chunk sizes
+    match what the embedding model sees. Fall back to `estimate_token_num` if
+    the tokenizer can not be loaded, e.g., the mock embedding model in tests.
+
+    Returns:
+    - A function returning token number of given text.
+    """
+    global _token_counter
+    with _token_counter_lock:
+        if _token_counter is not None:
+            return _token_counter
+
+        if config.CHUNK_TOKENIZER == 'embed':
+            try:
+                tokenizer = _load_embed_tokenizer()
+                _token_counter = lambda text: len(
+                    tokenizer.encode(text, add_special_tokens=False))
+                logging.info('chunk tokens are counted by embed tokenizer')
+                return _token_counter
+            except Exception as e:
+                logging_exception(e)
+
+        logging.info('chunk tokens are estimated')
+        _token_counter = lambda text: estimate_token_num(text)[0]
+        return _token_counter
@@ -0,0 +1,96 @@
+import os
+import re
+import html
+import logging
+from typing import Iterator
+
+from parse.parser import ContentListParser, Chunk
+
+
+class DocxParser(ContentListParser):
+    """
+    Word document parser, backed by [python-docx](https://github.com/python-openxml/python-docx).
+    Paragraphs and tables are converted into content blocks in document order,
+    paragraphs with heading style are emitted with `text_level` set. Embedded
+    images are ignored.
+    """
+
+    heading_pattern = re.compile(r'^Heading (\d)$')
+
+    def parse(
+        self,
+        file_path: str,
+        asset_save_dir: str,
+        content_hash: str = None,
+    ) -> list[Chunk]:
+        self.file_name = os.path.basename(file_path)
+
+        content_list = list(self.iter_blocks(file_path))
+        logging.info(f'{self.file_name}: total {len(content_list)} blocks')
+
+        return self.build_chunks(
+            content_list=content_list,
+            temp_asset_dir='',
+            asset_save_dir=asset_save_dir,
+        )
+
+    def parse_iter(
+        self,
+        file_path: str,
+        asset_save_dir: str,
+        content_hash: str = None,
+    ) -> Iterator[Chunk]:
+        self.file_name = os.path.basename(file_path)
+
+        yield from self.build_chunks_iter(
+            blocks=self.iter_blocks(file_path),
+            temp_asset_dir='',
+            asset_save_dir=asset_save_dir,
+        )
+
+    def iter_blocks(self, file_path: str) -> Iterator[dict]:
+        import docx
+        from docx.table import Table
+        from docx.text.paragraph import Paragraph
+
+        document = docx.Document(file_path)
+        for element in document.element.body.iterchildren():
+            tag = element.tag.split('}')[-1]
+            if tag == 'p':
+                paragraph = Paragraph(element, document)
+                text = paragraph.text.strip()
+                if len(text) == 0:
+                    continue
+                block = {'type': 'text', 'text': text}
+                text_level = self.heading_level(paragraph.style.name)
+                if text_level is not None:
+                    block['text_level'] = text_level
+                yield block
+
+            elif tag == 'tbl':
+                table = Table(element, document)
+                yield {
+                    'type': 'table',
+                    'table_body': self.table_html(table),
+                    'table_caption': '',
+                }
+
+    def heading_level(self, style_name: str) -> int:
+        """
+        Returns:
+        - Heading level of paragraph style, None if not a heading style.
+        """
+        if style_name == 'Title':
+            return 1
+        m = self.heading_pattern.match(style_name or '')
+        if m is None:
+            return None
+        return int(m.group(1))
+
+    def table_html(self, table) -> str:
+        rows = []
+        for row in table.rows:
+            cells = ''.join(f'<td>{html.escape(cell.text.strip())}</td>'
+                            for cell in row.cells)
+            rows.append(f'<tr>{cells}</tr>')
+        return f"<table>{''.join(rows)}</table>"
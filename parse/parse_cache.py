@@ -0,0 +1,376 @@
+import os
+import re
+import json
+import shutil
+import logging
+import tempfile
+import threading
+from typing import Iterator, Union
+
+import xxhash
+
+import config
+from utils import get_hash64, logging_exception
+
+
+class ParseCache:
+    """
+    Persistent cache of parsed content list, so that re-chunking or
+    re-indexing does not need to run layout / OCR models again.
+
+    Two kinds of entries are kept:
+    - file entry: the whole document content list, keyed by file content hash.
+        Stored as json lines, one block per line, so that it is written and
+        read block by block without holding the whole document.
+    - page entry: blocks of a single page, keyed by page hash, so that only new
+        or changed pages of a modified document need to be analyzed.
+
+    Keys are suffixed with `config_key`, a digest of parser settings changing
+    parsed content, so that entries parsed under other settings are never hit.
+
+    Images referenced by cached blocks are kept in `images` directory under the
+    cache directory, block `img_path` is relative to the cache directory.
+
+    Cache size is bounded by `max_bytes`, least recently used files are evicted
+    once exceeded. Files are touched when hit, so that file mtime is the last
+    used time, shared by all parser processes using the cache. An entry whose
+    images are evicted is a miss.
+
+    Layout:
+    - `{cache_dir}/files/{content_hash}-{config_key}.jsonl`
+    - `{cache_dir}/pages/{page_hash}-{config_key}.json`
+    - `{cache_dir}/images/{image_name}`
+    """
+
+    # eviction removes files until cache size drops below this ratio of
+    # `max_bytes`, so that eviction does not run on every put.
+    EVICT_RATIO = 0.9
+
+    def __init__(self,
+                 cache_dir: str,
+                 max_bytes: int = 0,
+                 config_key: str = ''):
+        """
+        Args:
+        - cache_dir: cache directory.
+        - max_bytes: size limit of cache files, 0 for no limit.
+        - config_key: digest of parser settings, see `get_parse_config_key`.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.config_key = config_key
+        self.file_dir = os.path.join(cache_dir, 'files')
+        self.page_dir = os.path.join(cache_dir, 'pages')
+        self.image_dir = os.path.join(cache_dir, 'images')
+        for d in [self.file_dir, self.page_dir, self.image_dir]:
+            os.makedirs(d, exist_ok=True)
+
+        # approximate cache size, scanned on first put and re-scanned by
+        # eviction, other processes write the same cache.
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _entry_path(self, entry_dir: str, key: str, ext: str = '.json') -> str:
+        if len(self.config_key) > 0:
+            key = f'{key}-{self.config_key}'
+        return os.path.join(entry_dir, f'{key}{ext}')
+
+    def iter_file(self, content_hash: str) -> Union[Iterator[dict], None]:
+        """
+        Returns:
+        - An iterator of cached content blocks of the document, read one by
+            one, None if not cached.
+        """
+        path = self._entry_path(self.file_dir, content_hash, '.jsonl')
+        if not os.path.exists(path):
+            return None
+        try:
+            # touch entry and its images as recently used before any block is
+            # returned, a first pass holding no blocks.
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    img_path = json.loads(line).get('img_path', '')
+                    if len(img_path) > 0:
+                        os.utime(os.path.join(self.cache_dir, img_path))
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process, or images of the entry evicted
+            return None
+        except Exception as e:
+            logging_exception(e)
+            return None
+        return self._iter_lines(path)
+
+    def _iter_lines(self, path: str) -> Iterator[dict]:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def open_file(self, content_hash: str) -> 'FileEntryWriter':
+        """
+        Returns:
+        - A writer of the document entry, blocks are written one by one and the
+            entry is saved by `FileEntryWriter.commit`.
+        """
+        return FileEntryWriter(
+            cache=self,
+            path=self._entry_path(self.file_dir, content_hash, '.jsonl'),
+        )
+
+    def has_page(self, page_hash: str) -> bool:
+        return os.path.exists(self._entry_path(self.page_dir, page_hash))
+
+    def get_page(self, page_hash: str) -> Union[list[dict], None]:
+        return self._load(self._entry_path(self.page_dir, page_hash))
+
+    def put_page(
+        self,
+        page_hash: str,
+        blocks: list[dict],
+        temp_asset_dir: str,
+    ) -> list[dict]:
+        """
+        Save blocks of one page, images referenced by blocks are copied from
+        `temp_asset_dir` into cache.
+
+        Returns:
+        - The saved blocks, `page_idx` is reset to 0.
+        """
+        saved = []
+        for block in blocks:
+            block = dict(block)
+            block['page_idx'] = 0
+            img_path = block.get('img_path', '')
+            if len(img_path) > 0:
+                src_path = os.path.join(temp_asset_dir, img_path)
+                name = os.path.basename(img_path)
+                dst_path = os.path.join(self.image_dir, name)
+                if os.path.exists(src_path) and not os.path.exists(dst_path):
+                    shutil.copyfile(src_path, dst_path)
+                    self._charge(os.path.getsize(dst_path))
+                block['img_path'] = os.path.join(
+                    os.path.basename(self.image_dir), name)
+            saved.append(block)
+
+        self._dump(self._entry_path(self.page_dir, page_hash), saved)
+        return saved
+
+    def _load(self, path: str) -> Union[list[dict], None]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content_list = json.load(f)
+            # touch entry and its images as recently used
+            paths = [path]
+            for block in content_list:
+                img_path = block.get('img_path', '')
+                if len(img_path) > 0:
+                    paths.append(os.path.join(self.cache_dir, img_path))
+            for p in paths:
+                os.utime(p)
+        except FileNotFoundError:
+            # evicted by another process, or images of the entry evicted
+            return None
+        except Exception as e:
+            logging_exception(e)
+            return None
+        return content_list
+
+    def _dump(self, path: str, content_list: list[dict]):
+        # NOTE: multiple parser processes may write the same entry, write to
+        # a temp file and rename so that readers never see partial entries.
+        # temp files are hidden from eviction.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         prefix='.')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(content_list, f, ensure_ascii=False)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        self._charge(size)
+
+    def _charge(self, size: int):
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(s for _, s, _ in self._list_files())
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _list_files(self) -> list[tuple]:
+        """
+        Returns:
+        - A list of (mtime, size, path) of cache files.
+        """
+        files = []
+        for d in [self.file_dir, self.page_dir, self.image_dir]:
+            with os.scandir(d) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def _evict(self):
+        """
+        Delete least recently used files until cache size drops below
+        `EVICT_RATIO` of `max_bytes`, caller must hold `_lock`.
+        """
+        files = sorted(self._list_files())
+        size = sum(s for _, s, _ in files)
+        target = self.max_bytes * self.EVICT_RATIO
+        evicted = 0
+        for _, file_size, path in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+            evicted += 1
+        self._size = size
+        logging.info(f'{self.cache_dir}: evict {evicted} files')
+
+
+class FileEntryWriter:
+    """
+    Write a file entry block by block into a hidden temp file, renamed into
+    place by `commit`, so that readers never see partial entries. The temp file
+    is discarded if the writer is closed before commit, e.g., parse failed.
+    """
+
+    def __init__(self, cache: ParseCache, path: str):
+        self.cache = cache
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                              prefix='.')
+        self._f = os.fdopen(fd, 'w', encoding='utf-8')
+
+    def write(self, block: dict):
+        self._f.write(json.dumps(block, ensure_ascii=False))
+        self._f.write('\n')
+
+    def commit(self):
+        self._f.close()
+        size = os.path.getsize(self.temp_path)
+        os.replace(self.temp_path, self.path)
+        self.temp_path = None
+        self.cache._charge(size)
+
+    def close(self):
+        if self.temp_path is None:
+            return
+        self._f.close()
+        os.remove(self.temp_path)
+        self.temp_path = None
+
+
+# indirect object reference, e.g., `12 0 R`
+_ref_pattern = re.compile(r'(\d+) \d+ R')
+
+
+def get_page_hash(doc, page_idx: int, memo: dict = None) -> str:
+    """
+    Hash of a page in a PyMuPDF document, computed from page size, rotation,
+    page content streams and the resource tree of the page, i.e., fonts,
+    images and form XObjects with their own resources, so that pages drawing
+    different XObjects by the same content stream differ. Object numbers are
+    left out, the same page in another document has the same hash.
+
+    Args:
+    - doc: `fitz.Document`.
+    - page_idx: page index.
+    - memo: xref to object digest, shared by pages of `doc` so that objects
+        used by many pages, e.g., fonts, are hashed once.
+    """
+    if memo is None:
+        memo = {}
+    page = doc[page_idx]
+    h = xxhash.xxh64()
+    h.update(str((tuple(page.rect), page.rotation)).encode('utf-8'))
+    h.update(page.read_contents())
+
+    # resources may be inherited from the page tree
+    xref = page.xref
+    while True:
+        kind, resources = doc.xref_get_key(xref, 'Resources')
+        if kind != 'null':
+            break
+        kind, parent = doc.xref_get_key(xref, 'Parent')
+        if kind != 'xref':
+            resources = ''
+            break
+        xref = int(parent.split()[0])
+    _update_object_text(doc, h, resources, memo, set())
+    return h.hexdigest()
+
+
+def _update_object_text(doc, h, text: str, memo: dict, path: set):
+    """
+    Update hash with object source text and digests of objects it refers to.
+    """
+    h.update(_ref_pattern.sub('R', text).encode('utf-8'))
+    for m in _ref_pattern.finditer(text):
+        h.update(_get_object_digest(doc, int(m.group(1)), memo, path).encode())
+
+
+def _get_object_digest(doc, xref: int, memo: dict, path: set) -> str:
+    if xref in memo:
+        return memo[xref]
+    if xref in path:
+        # reference cycle, the object is already being hashed
+        return 'cycle'
+    kind, value = doc.xref_get_key(xref, 'Type')
+    if kind == 'name' and value in ['/Page', '/Pages']:
+        # e.g., `/P` of an annotation, the page tree is not a resource
+        return value
+
+    path.add(xref)
+    h = xxhash.xxh64()
+    _update_object_text(doc, h, doc.xref_object(xref, compressed=True), memo,
+                        path)
+    if doc.xref_is_stream(xref):
+        h.update(doc.xref_stream_raw(xref) or b'')
+    path.discard(xref)
+    memo[xref] = h.hexdigest()
+    return memo[xref]
+
+
+def get_parse_config_key() -> str:
+    """
+    Digest of parser settings changing parsed content, i.e., which pages are
+    extracted from text layer instead of analyzed by models.
+    """
+    settings = {
+        'pdf_text_layer_enable': config.PDF_TEXT_LAYER_ENABLE,
+        'pdf_text_layer_min_chars': config.PDF_TEXT_LAYER_MIN_CHARS,
+    }
+    return get_hash64(json.dumps(settings, sort_keys=True).encode('utf-8'))
+
+
+_parse_cache = None
+
+
+def get_parse_cache() -> Union[ParseCache, None]:
+    """
+    Returns:
+    - Parse cache, None if cache is disabled.
+    """
+    global _parse_cache
+    if not config.PARSE_CACHE_ENABLE:
+        return None
+    config_key = get_parse_config_key()
+    if _parse_cache is None or _parse_cache.config_key != config_key:
+        _parse_cache = ParseCache(
+            cache_dir=config.PARSE_CACHE_DIR,
+            max_bytes=config.PARSE_CACHE_MAX_MB * 1024 * 1024,
+            config_key=config_key,
+        )
+    return _parse_cache
@@ -1,21 +1,38 @@
+import os
+import logging
+import struct
 import xxhash
 from strenum import StrEnum
 from abc import ABC, abstractmethod
+from typing import Dict, Any, BinaryIO, Iterable, Iterator
 
+import config
 from config import ChunkType
-from utils import get_hash64
+from utils import safe_strip
+from parse.chunker import TokenChunker
+from parse.asset_store import get_asset_store
 
 
 class SupportedFileType(StrEnum):
     PDF = "pdf"
+    TXT = "txt"
+    MD = "md"
+    DOCX = "docx"
 
 
 class Chunk:
     """
     Document chunk object. A chunk can be text paragraph, or a non-text asset,
     i.e., picture or audio.
+
+    Chunks are kept in memory for a whole document and passed between
+    processes, so fields are slotted, text is decoded on first access, and
+    chunks are pickled in the compact binary format of `to_bytes`.
     """
 
+    __slots__ = ('content_type', 'file_name', 'content', 'extra_description',
+                 'content_url', 'uuid', '_text', '_description')
+
     def __init__(
         self,
         content_type: ChunkType,
@@ -33,29 +50,146 @@ class Chunk:
         - content_url: url to the content, set when content is not suitable for
             directly insert into db, for example image / audio data.
         """
-        super().__init__()
-
         self.content_type = content_type
         self.content = content
         self.extra_description = extra_description
         self.content_url = content_url
         self.file_name = file_name
-        self.uuid = get_hash64(
-            file_name.encode('utf-8') + content + extra_description)
+        # same digest as hashing the concatenated bytes, without the copy
+        h = xxhash.xxh64()
+        h.update(file_name.encode('utf-8'))
+        h.update(content)
+        h.update(extra_description)
+        self.uuid = h.hexdigest()
+        self._text = None
+        self._description = None
+
+    @property
+    def text(self) -> str:
+        """
+        Decoded content, not valid for image chunks.
+        """
+        if self._text is None:
+            self._text = self.content.decode('utf-8')
+        return self._text
+
+    @property
+    def description(self) -> str:
+        """
+        Decoded extra description.
+        """
+        if self._description is None:
+            self._description = self.extra_description.decode('utf-8')
+        return self._description
+
+    def release_content(self):
+        """
+        Drop content and extra description of a chunk already stored, uuid and
+        content url are kept.
+        """
+        self.content = b''
+        self.extra_description = b''
+        self._text = None
+        self._description = None
 
     def __str__(self, ):
         if self.content_type == ChunkType.TEXT:
-            return self.content.decode('utf-8')
+            return self.text
         elif self.content_type == ChunkType.IMAGE:
             return 'content is image, below is the image description:\n' \
-                + self.extra_description.decode('utf-8') \
+                + self.description \
                 + f"content url: {self.content_url}"
         elif self.content_type == ChunkType.TABLE:
-            return self.extra_description.decode('utf-8') \
-                + self.content.decode('utf-8')
+            return self.description + self.text
         else:
             return ""
 
+    def to_bytes(self) -> bytes:
+        """
+        Serialize chunk into a compact binary record, a fixed header of content
+        type and field lengths followed by raw field bytes. uuid is stored so
+        that loading needs no hashing.
+        """
+        file_name = self.file_name.encode('utf-8')
+        content_url = self.content_url.encode('utf-8')
+        uuid = self.uuid.encode('ascii')
+        header = _chunk_header.pack(
+            _chunk_types.index(self.content_type),
+            len(file_name),
+            len(self.content),
+            len(self.extra_description),
+            len(content_url),
+            len(uuid),
+        )
+        return b''.join([
+            header, file_name, self.content, self.extra_description,
+            content_url, uuid
+        ])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Chunk':
+        """
+        Load chunk from a record of `to_bytes`.
+        """
+        view = memoryview(data)
+        type_idx, *lengths = _chunk_header.unpack_from(view)
+        fields = []
+        offset = _chunk_header.size
+        for length in lengths:
+            fields.append(bytes(view[offset:offset + length]))
+            offset += length
+        file_name, content, extra_description, content_url, uuid = fields
+
+        chunk = cls.__new__(cls)
+        chunk.content_type = _chunk_types[type_idx]
+        chunk.file_name = file_name.decode('utf-8')
+        chunk.content = content
+        chunk.extra_description = extra_description
+        chunk.content_url = content_url.decode('utf-8')
+        chunk.uuid = uuid.decode('ascii')
+        chunk._text = None
+        chunk._description = None
+        return chunk
+
+    def __reduce__(self):
+        return (Chunk.from_bytes, (self.to_bytes(), ))
+
+
+# chunk record header: content type index, lengths of file name, content,
+# extra description, content url and uuid.
+_chunk_header = struct.Struct('<B5I')
+_chunk_types = tuple(ChunkType)
+_record_length = struct.Struct('<I')
+
+
+def write_chunks(f: BinaryIO, chunks: Iterable[Chunk]) -> int:
+    """
+    Write chunks as length prefixed records of `Chunk.to_bytes`, e.g., to spill
+    chunks of a large document to disk.
+
+    Returns:
+    - Number of chunks written.
+    """
+    num = 0
+    for chunk in chunks:
+        record = chunk.to_bytes()
+        f.write(_record_length.pack(len(record)))
+        f.write(record)
+        num += 1
+    return num
+
+
+def read_chunks(f: BinaryIO) -> Iterator[Chunk]:
+    """
+    Read chunks written by `write_chunks`, one at a time.
+    """
+    while True:
+        prefix = f.read(_record_length.size)
+        if len(prefix) < _record_length.size:
+            return
+        length, = _record_length.unpack(prefix)
+        yield Chunk.from_bytes(f.read(length))
+
 
 class Parser(ABC):
     """
@@ -67,6 +201,7 @@ class Parser(ABC):
         self,
         file_path: str,
         asset_save_dir: str,
+        content_hash: str = None,
     ) -> list[Chunk]:
         """
         parse method.
@@ -74,8 +209,305 @@ class Parser(ABC):
         Args:
         - file_path: path to the file.
         - asset_save_dir: directory for saving parsed assets, for example images.
+        - content_hash: file content hash if already computed by caller,
+            parsers needing it compute it otherwise.
 
         Returns:
         - A list of parsed documents chunks.
         """
         raise NotImplementedError("Not implemented")
+
+    def parse_iter(
+        self,
+        file_path: str,
+        asset_save_dir: str,
+        content_hash: str = None,
+    ) -> Iterator[Chunk]:
+        """
+        Same as `parse`, but yield chunks progressively so that consumers can
+        start indexing before the whole file is parsed. Default implementation
+        yields chunks returned by `parse`.
+
+        Args:
+        - file_path: path to the file.
+        - asset_save_dir: directory for saving parsed assets, for example images.
+        - content_hash: file content hash if already computed by caller.
+
+        Returns:
+        - An iterator of parsed documents chunks, in the same order as `parse`.
+        """
+        yield from self.parse(file_path=file_path,
+                              asset_save_dir=asset_save_dir,
+                              content_hash=content_hash)
+
+
+class ContentListParser(Parser):
+    """
+    Base class of parsers which first parse file into a content list, i.e., a
+    list of [MinerU](https://github.com/opendatalab/MinerU) style content block
+    dict, see `PDFParser.parse_pdf_content` for block keys, and then chunk the
+    content list.
+    """
+
+    def __init__(self, chunker: TokenChunker = None):
+        """
+        Args:
+        - chunker: groups content blocks into chunks, default to a
+            `TokenChunker` with token budget in config.
+        """
+        super().__init__()
+        if chunker is None:
+            chunker = TokenChunker(
+                min_tokens=config.CHUNK_MIN_TOKENS,
+                max_tokens=config.CHUNK_MAX_TOKENS,
+                overlap_tokens=config.CHUNK_OVERLAP_TOKENS,
+            )
+        self.chunker = chunker
+
+    def build_chunks(
+        self,
+        content_list: list[dict],
+        temp_asset_dir: str,
+        asset_save_dir: str,
+    ) -> list[Chunk]:
+        """
+        Drop invalid blocks, chunk content list and filter too short chunks.
+
+        Returns:
+        - List of chunks.
+        """
+        filtered_chunks = list(
+            self.build_chunks_iter(
+                blocks=content_list,
+                temp_asset_dir=temp_asset_dir,
+                asset_save_dir=asset_save_dir,
+            ))
+
+        logging.info(
+            f'{self.file_name}: {len(filtered_chunks)} chunks after filtering')
+
+        return filtered_chunks
+
+    def build_chunks_iter(
+        self,
+        blocks: Iterable[dict],
+        temp_asset_dir: str,
+        asset_save_dir: str,
+    ) -> Iterator[Chunk]:
+        """
+        Streaming version of `build_chunks`, blocks are consumed lazily and
+        chunks are yielded as soon as enough following blocks are available.
+
+        Returns:
+        - An iterator of chunks.
+        """
+
+        def _valid_blocks():
+            all_types = set()
+            for block in blocks:
+                if not self.is_valid_block(block):
+                    logging.info(
+                        f'{self.file_name}: invalid block, ignore {block}')
+                    continue
+                all_types.add(block['type'])
+                yield block
+            logging.info(f"all parsed block types: {sorted(all_types)}")
+
+        chunks = self.chunk_iter(
+            blocks=_valid_blocks(),
+            temp_asset_dir=temp_asset_dir,
+            asset_save_dir=asset_save_dir,
+        )
+        for chunk in chunks:
+            yield from self.filter_chunks([chunk])
+
+    def chunk(
+        self,
+        content_list: list[dict],
+        temp_asset_dir: str,
+        asset_save_dir: str,
+    ) -> list[Chunk]:
+        """
+        Chunk parsed contents. Text blocks are grouped into chunks by token
+        budget and headline boundaries, image / table blocks are independent
+        chunks, see `TokenChunker`.
+
+        Returns:
+        - List of chunks.
+        """
+        return list(
+            self.chunk_iter(
+                blocks=content_list,
+                temp_asset_dir=temp_asset_dir,
+                asset_save_dir=asset_save_dir,
+            ))
+
+    def chunk_iter(
+        self,
+        blocks: Iterable[dict],
+        temp_asset_dir: str,
+        asset_save_dir: str,
+    ) -> Iterator[Chunk]:
+        """
+        Streaming version of `chunk`. Blocks are pulled from `blocks` lazily,
+        a chunk is yielded as soon as its token budget is met.
+
+        Returns:
+        - An iterator of chunks.
+        """
+        for group in self.chunker.iter_groups(blocks):
+            # text blocks of one chunk
+            if isinstance(group, list):
+                yield from self.process_text_blocks(
+                    text_blocks=group,
+                    temp_asset_dir=temp_asset_dir,
+                    asset_save_dir=asset_save_dir,
+                )
+            elif group['type'] == 'table':
+                yield from self.process_table_blocks(
+                    table_blocks=[group],
+                    temp_asset_dir=temp_asset_dir,
+                    asset_save_dir=asset_save_dir,
+                )
+            elif group['type'] == 'image':
+                yield from self.process_image_blocks(
+                    image_blocks=[group],
+                    temp_asset_dir=temp_asset_dir,
+                    asset_save_dir=asset_save_dir,
+                )
+
+    def process_text_blocks(
+        self,
+        text_blocks: list[dict],
+        temp_asset_dir: str,
+        asset_save_dir: str,
+    ) -> list[Chunk]:
+        texts = [str(block['text']) for block in text_blocks]
+        content = self.strip_text_content(texts)
+        return [
+            Chunk(
+                content_type=ChunkType.TEXT,
+                file_name=self.file_name,
+                content=content.encode('utf-8'),
+                extra_description=''.encode('utf-8'),
+            )
+        ]
+
+    def process_image_blocks(
+        self,
+        image_blocks: list[dict],
+        temp_asset_dir: str,
+        asset_save_dir: str,
+    ) -> list[Chunk]:
+
+        asset_store = get_asset_store(asset_save_dir)
+        chunks = []
+        for block in image_blocks:
+            texts = [
+                str(block.get('img_caption', '')),
+                str(block.get('img_footnote', '')),
+            ]
+            extra_description = self.strip_text_content(texts)
+            if len(extra_description) == 0:
+                extra_description = "no caption for this image"
+
+            # NOTE: image bytes are not kept in chunk, chunk content is the
+            # asset key, which also keeps chunk uuid derived from image content.
+            abs_img_path = os.path.join(temp_asset_dir, block['img_path'])
+            asset_path = asset_store.put(abs_img_path)
+
+            chunk = Chunk(
+                content_type=ChunkType.IMAGE,
+                file_name=self.file_name,
+                content=os.path.basename(asset_path).encode('utf-8'),
+                extra_description=(extra_description).encode('utf-8'),
+                content_url=asset_path,
+            )
+            chunks.append(chunk)
+
+        return chunks
+
+    def process_table_blocks(
+        self,
+        table_blocks: list[dict],
+        temp_asset_dir: str,
+        asset_save_dir: str,
+    ) -> list[Chunk]:
+        chunks = []
+        for block in table_blocks:
+            texts = [
+                str(block.get('table_caption', '')),
+                str(block.get('table_footnote', '')),
+            ]
+            extra_description = self.strip_text_content(texts)
+            if len(extra_description) == 0:
+                extra_description = "no caption for this table"
+
+            chunk = Chunk(
+                content_type=ChunkType.TABLE,
+                file_name=self.file_name,
+                content=block['table_body'].encode('utf-8'),
+                extra_description=(extra_description).encode('utf-8'),
+            )
+            chunks.append(chunk)
+
+        return chunks
+
+    def filter_chunks(self, chunks: list[Chunk]) -> list[Chunk]:
+        """
+        Filter too short chunks
+        """
+        filtered_chunks = []
+        for chunk in chunks:
+            content = chunk.text
+            if chunk.content_type != config.ChunkType.TEXT:
+                content = chunk.description
+            content = safe_strip(content)
+            if len(content) < 8 or len(content.split()) < 3:
+                logging.info(
+                    f'{self.file_name}: remove chunk due to too short content: {str(chunk)}'
+                )
+                continue
+
+            filtered_chunks.append(chunk)
+
+        return filtered_chunks
+
+    def strip_text_content(self, texts: list[str]) -> str:
+        """
+        Filter and merge text content
+        """
+        content = ""
+        for text in texts:
+            striped = safe_strip(text)
+            if len(striped) == 0 or striped == '[]':
+                continue
+            content += striped
+            content += "\n\n"
+        return content.strip()
+
+    def is_valid_block(self, block: Dict[str, Any]) -> bool:
+        """
+        There are corner cases where returned blocks dont contain expected keys 
+        or values are empty.
+
+        Returns:
+        - bool: true if block is valid.
+        """
+        # missing key
+        if 'type' not in block:
+            return False
+
+        # text / equation
+        if block['type'] in ['text', 'equation']:
+            return 'text' in block
+
+        # image
+        if block['type'] == 'image':
+            return 'img_path' in block and len(block['img_path']) > 0
+
+        # table
+        if block['type'] == 'table':
+            return 'table_body' in block
+
+        return True
@@ -1,102 +1,467 @@
 import os
+import time
 import tempfile
 import logging
-import shutil
 import pickle
-from typing import Tuple, Dict, Any
+import threading
+import multiprocessing
+from collections import deque
+from typing import Dict, Iterator, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import config
-from utils import singleton, safe_strip, logging_exception
-from parse.parser import Parser, Chunk, ChunkType
-from config import PDF_PARSER_CONFIG_PATH
+from utils import singleton, get_hash64, open_mmap, StepTimer
+from parse.parser import ContentListParser, Chunk
+from parse.chunker import TokenChunker
+from parse.parse_cache import ParseCache, get_parse_cache, get_page_hash
+from parse.pdf_text_layer import is_text_page, extract_page_blocks
+from config import PDF_PARSER_CONFIG_PATH, ParseArtifactMode
 
 
 @singleton
-class PDFParser(Parser):
+class PDFParser(ContentListParser):
     """
     PDF parser implementation, backed by [MinerU](https://github.com/opendatalab/MinerU).
+
+    Wall time of parse steps is recorded in `self.timer` and logged once a
+    document is parsed, times of shards parsed in parallel are summed.
     """
 
     def __init__(
         self,
-        consecutive_block_num=6,
-        block_overlap_num=2,
+        chunker: TokenChunker = None,
+        artifact_mode: ParseArtifactMode = None,
     ):
-        super().__init__()
         """
         Args:
-        - consecutive_block_num: used in chunking, number of consecutive block to be considered as one chunk.
-        - block_overlap_num: used in chunking, number of overlapped block num between two consecutive chunks.
+        - chunker: see `ContentListParser`.
+        - artifact_mode: `ParseArtifactMode.LEAN` only produces content list and
+            images, `ParseArtifactMode.DEBUG` also renders MinerU intermediate
+            results and keeps them under `config.PDF_PARSE_DEBUG_DIR`. Default
+            to `config.PDF_PARSE_ARTIFACT_MODE`.
         """
-        self.consecutive_block_num = consecutive_block_num
-        self.block_overlap_num = block_overlap_num
-        assert block_overlap_num < consecutive_block_num,\
-            f"block overlap num ({block_overlap_num}) be less than consecutive block num ({consecutive_block_num})"
+        super().__init__(chunker=chunker)
+        if artifact_mode is None:
+            artifact_mode = config.PDF_PARSE_ARTIFACT_MODE
+        self.artifact_mode = ParseArtifactMode(artifact_mode)
+        self.timer = StepTimer()
 
         # set environment variable for magic_pdf to load config json file
         os.environ["MINERU_TOOLS_CONFIG_JSON"] = PDF_PARSER_CONFIG_PATH
 
+        self._shard_pool = None
+        self._shard_pool_workers = 0
+        self._shard_pool_lock = threading.Lock()
+
     def parse(
         self,
         file_path: str,
         asset_save_dir: str,
+        content_hash: str = None,
     ) -> list[Chunk]:
+        filtered_chunks = list(
+            self.parse_iter(
+                file_path=file_path,
+                asset_save_dir=asset_save_dir,
+                content_hash=content_hash,
+            ))
+
+        logging.info(
+            f'{self.file_name}: {len(filtered_chunks)} chunks after filtering')
+
+        return filtered_chunks
+
+    def parse_iter(
+        self,
+        file_path: str,
+        asset_save_dir: str,
+        content_hash: str = None,
+    ) -> Iterator[Chunk]:
+        """
+        Parse PDF page window by page window, see `iter_pdf_pages`, chunks are
+        yielded as soon as the blocks they cover are parsed.
+        """
         os.makedirs(asset_save_dir, exist_ok=True)
         self.file_name = os.path.basename(file_path)
+        self.timer.reset()
+        start = time.time()
 
-        # get content list
         temp_dir = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
         logging.info(f'asset directory: {temp_dir.name}')
         temp_asset_dir = temp_dir.name
-        # temp_asset_dir = './parsed_assets'
 
-        content_list = self.parse_pdf_content(
-            file_path=file_path,
-            temp_asset_dir=temp_asset_dir,
-        )
-        # with open(os.path.join(temp_asset_dir, 'content_list.pickle'),
-        #           'wb') as f:
-        #     pickle.dump(content_list, f)
-
-        # with open(os.path.join(temp_asset_dir, 'content_list.pickle'),
-        #           'rb') as f:
-        #     print(f'loading content list from {temp_asset_dir}')
-        #     content_list = pickle.load(f)
-
-        filtered_content_list = []
-        for block in content_list:
-            if not self.is_valid_block(block):
-                logging.info(
-                    f'{self.file_name}: invalid block, ignore {block}')
-                continue
-            filtered_content_list.append(block)
+        # NOTE: file is mapped instead of read, hashing and parsing share the
+        # page cache instead of holding their own copies of the file.
+        try:
+            with open_mmap(file_path) as pdf_bytes:
+                parse_cache = get_parse_cache()
+                if parse_cache is None:
+                    blocks = self.iter_pdf_document(
+                        file_path=file_path,
+                        temp_asset_dir=temp_asset_dir,
+                        pdf_bytes=pdf_bytes,
+                    )
+                else:
+                    blocks = self.iter_pdf_content_cached(
+                        file_path=file_path,
+                        temp_asset_dir=temp_asset_dir,
+                        pdf_bytes=pdf_bytes,
+                        parse_cache=parse_cache,
+                        content_hash=content_hash,
+                    )
+                    # images of cached blocks are relative to cache directory
+                    temp_asset_dir = parse_cache.cache_dir
+
+                yield from self.build_chunks_iter(
+                    blocks=blocks,
+                    temp_asset_dir=temp_asset_dir,
+                    asset_save_dir=asset_save_dir,
+                )
+        finally:
+            temp_dir.cleanup()
+            logging.info(
+                f'{self.file_name}: parse cost {time.time() - start:.2f}s, steps: {self.timer.summary()}'
+            )
 
-        self.content_list = filtered_content_list
-        all_types = sorted(
-            list(set([block['type'] for block in self.content_list])))
-        logging.info(f"all parsed block types: {all_types}")
+    def iter_pdf_document(
+        self,
+        file_path: str,
+        temp_asset_dir: str,
+        pdf_bytes: bytes,
+    ) -> Iterator[dict]:
+        """
+        Parse all pages of a PDF, see `iter_pdf_pages`.
 
-        # get chunk list
-        chunks = self.chunk(
-            content_list=self.content_list,
-            temp_asset_dir=temp_asset_dir,
-            asset_save_dir=asset_save_dir,
+        Returns:
+        - An iterator of parsed content block dict, in page order.
+        """
+        doc = open_pdf(file_path, pdf_bytes)
+        try:
+            for _, blocks in self.iter_pdf_pages(
+                    file_path=file_path,
+                    temp_asset_dir=temp_asset_dir,
+                    pdf_bytes=pdf_bytes,
+                    doc=doc,
+                    page_indices=list(range(doc.page_count)),
+            ):
+                yield from blocks
+        finally:
+            doc.close()
+
+    def iter_pdf_content_cached(
+        self,
+        file_path: str,
+        temp_asset_dir: str,
+        pdf_bytes: bytes,
+        parse_cache: ParseCache,
+        content_hash: str = None,
+    ) -> Iterator[dict]:
+        """
+        Same as `iter_pdf_document`, backed by parse cache. Whole document
+        content list is looked up by content hash first. On miss, pages are
+        looked up by page hash and only uncached pages are parsed, each page
+        entry is saved once the page is parsed. The whole document entry is
+        written block by block as blocks are yielded, and saved once all blocks
+        are consumed, no block is held for it.
+
+        NOTE: blocks of pages analyzed in different runs are not merged across
+        page boundaries.
+
+        Args:
+        - content_hash: hash of `pdf_bytes`, computed if not provided.
+
+        Returns:
+        - An iterator of parsed content block dict, `img_path` is relative to
+            `parse_cache.cache_dir`.
+        """
+        with self.timer.step('cache_lookup'):
+            if content_hash is None:
+                content_hash = get_hash64(pdf_bytes)
+            cached_blocks = parse_cache.iter_file(content_hash)
+        if cached_blocks is not None:
+            logging.info(f'{file_path}: parse cache hit ({content_hash})')
+            yield from cached_blocks
+            return
+
+        doc = open_pdf(file_path, pdf_bytes)
+        file_writer = parse_cache.open_file(content_hash)
+        try:
+            with self.timer.step('cache_lookup'):
+                memo = {}
+                page_hashes = [
+                    get_page_hash(doc, i, memo) for i in range(doc.page_count)
+                ]
+                missing = [
+                    i for i, h in enumerate(page_hashes)
+                    if not parse_cache.has_page(h)
+                ]
+            logging.info(
+                f'{file_path}: {len(page_hashes) - len(missing)} pages cached, {len(missing)} pages to analyze'
+            )
+
+            # missing pages are parsed in page order, merge them with cached
+            # pages as they come, cached pages are loaded once reached.
+            missing_pages = self.iter_pdf_pages(
+                file_path=file_path,
+                temp_asset_dir=temp_asset_dir,
+                pdf_bytes=pdf_bytes,
+                doc=doc,
+                page_indices=missing,
+            )
+            missing = set(missing)
+            for i, page_hash in enumerate(page_hashes):
+                blocks = None
+                if i not in missing:
+                    with self.timer.step('cache_lookup'):
+                        blocks = parse_cache.get_page(page_hash)
+                if blocks is None:
+                    if i in missing:
+                        page_idx, blocks = next(missing_pages)
+                        assert page_idx == i, f'unexpected page {page_idx}, expect {i}'
+                    else:
+                        # evicted since looked up, analyze it alone
+                        _, blocks = next(
+                            self.iter_pdf_pages(
+                                file_path=file_path,
+                                temp_asset_dir=temp_asset_dir,
+                                pdf_bytes=pdf_bytes,
+                                doc=doc,
+                                page_indices=[i],
+                            ))
+                    with self.timer.step('cache_save'):
+                        blocks = parse_cache.put_page(
+                            page_hash=page_hash,
+                            blocks=blocks,
+                            temp_asset_dir=temp_asset_dir,
+                        )
+                for block in blocks:
+                    block = dict(block)
+                    block['page_idx'] = i
+                    file_writer.write(block)
+                    yield block
+            with self.timer.step('cache_save'):
+                file_writer.commit()
+        finally:
+            file_writer.close()
+            doc.close()
+
+    def iter_pdf_pages(
+        self,
+        file_path: str,
+        temp_asset_dir: str,
+        pdf_bytes: bytes,
+        doc,
+        page_indices: list[int],
+    ) -> Iterator[Tuple[int, list[dict]]]:
+        """
+        Parse given pages of a PDF. Pages are split into windows (shards) of
+        `config.PDF_PARSE_SHARD_PAGES` consecutive pages. With one worker, shards
+        are analyzed one by one in current process by `analyze_pdf_pages`. With
+        `config.PDF_PARSE_WORKERS` > 1, each shard is copied into a sub document
+        and parsed by `parse_pdf_shard` in parallel worker processes, sub
+        documents are built lazily, at most two per worker in flight. Shards are
+        the same whatever the number of workers, so parallel parsing gives the
+        same result as sequential parsing.
+
+        Args:
+        - file_path: path to the file.
+        - temp_asset_dir: directory for saving parsed assets.
+        - pdf_bytes: pdf content, bytes or mapped file.
+        - doc: `fitz.Document` opened from `pdf_bytes`.
+        - page_indices: indices of pages to parse.
+
+        Returns:
+        - An iterator of (page index, parsed content blocks of the page), in
+            order of `page_indices`, yielded once the shard of the page is
+            parsed.
+        """
+        shard_pages = config.PDF_PARSE_SHARD_PAGES
+        if shard_pages <= 0:
+            shard_pages = max(1, len(page_indices))
+        shards = [
+            page_indices[i:i + shard_pages]
+            for i in range(0, len(page_indices), shard_pages)
+        ]
+        workers = min(config.PDF_PARSE_WORKERS, len(shards))
+        if workers <= 1:
+            # no copy of shards, pages are analyzed on the opened document
+            for shard in shards:
+                pages = self.analyze_pdf_pages(
+                    file_path=file_path,
+                    temp_asset_dir=temp_asset_dir,
+                    pdf_bytes=pdf_bytes,
+                    doc=doc,
+                    page_indices=shard,
+                )
+                for i in shard:
+                    yield i, pages[i]
+            return
+
+        logging.info(
+            f'{file_path}: parse {len(page_indices)} pages in {len(shards)} shards with {workers} workers'
         )
+        start = time.time()
+        pool = self.get_shard_pool(workers)
+        try:
+            for shard, (shard_result, timings) in zip(
+                    shards,
+                    self._map_shards(pool, workers * 2, file_path,
+                                     temp_asset_dir, doc, shards)):
+                self.timer.merge(timings)
+                # yield shard results back in page order
+                for sub_idx, page_idx in enumerate(shard):
+                    blocks = shard_result[sub_idx]
+                    for block in blocks:
+                        block['page_idx'] = page_idx
+                    yield page_idx, blocks
+        except BrokenProcessPool:
+            # a crashed worker breaks the whole pool, recreate it next time
+            with self._shard_pool_lock:
+                if self._shard_pool is pool:
+                    self._shard_pool = None
+            raise
+        logging.info(
+            f'{file_path}: parse shards done, cost {time.time() - start:.2f}s')
 
-        # filter chunks
-        filtered_chunks = self.filter_chunks(chunks)
+    def _map_shards(
+        self,
+        pool: ProcessPoolExecutor,
+        max_inflight: int,
+        file_path: str,
+        temp_asset_dir: str,
+        doc,
+        shards: list[list[int]],
+    ) -> Iterator[Tuple[Dict[int, list[dict]], Dict[str, float]]]:
+        """
+        Parse shards by `parse_pdf_shard` in `pool`, results in shard order.
+        Unlike `pool.map`, which builds all arguments up front, a shard sub
+        document is only built when less than `max_inflight` shards are
+        submitted and not consumed, so that at most `max_inflight` shard copies
+        are held besides the document.
+        """
+        import fitz
+
+        def _shard_bytes(shard: list[int]) -> bytes:
+            with self.timer.step('split_shards'):
+                sub_doc = fitz.open()
+                for i in shard:
+                    sub_doc.insert_pdf(doc, from_page=i, to_page=i)
+                sub_pdf_bytes = sub_doc.tobytes()
+                sub_doc.close()
+            return sub_pdf_bytes
+
+        futures = deque()
+        shards = iter(shards)
+        try:
+            while True:
+                for shard in shards:
+                    futures.append(
+                        pool.submit(parse_pdf_shard, file_path, temp_asset_dir,
+                                    _shard_bytes(shard)))
+                    if len(futures) >= max_inflight:
+                        break
+                if len(futures) == 0:
+                    return
+                yield futures.popleft().result()
+        finally:
+            # consumer gone, e.g., parse failed, drop shards not started
+            for future in futures:
+                future.cancel()
+
+    def get_shard_pool(self, workers: int) -> ProcessPoolExecutor:
+        """
+        Returns:
+        - The process pool for parsing shards, created on first use and kept,
+            so that models are loaded once per worker process.
+        """
+        with self._shard_pool_lock:
+            if self._shard_pool is not None and \
+                    self._shard_pool_workers < workers:
+                self._shard_pool.shutdown(wait=False)
+                self._shard_pool = None
+            if self._shard_pool is None:
+                # NOTE: spawn instead of fork, forking a process holding model
+                # threads is not safe.
+                self._shard_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+                self._shard_pool_workers = workers
+            return self._shard_pool
+
+    def analyze_pdf_pages(
+        self,
+        file_path: str,
+        temp_asset_dir: str,
+        pdf_bytes: bytes,
+        doc,
+        page_indices: list[int],
+    ) -> Dict[int, list[dict]]:
+        """
+        Parse given pages of a PDF in current process. Pages with a usable text
+        layer are extracted directly with PyMuPDF, the rest, i.e., scanned or
+        image only pages, are put into one sub document and analyzed by MinerU.
 
-        temp_dir.cleanup()
+        Args:
+        - file_path: path to the file.
+        - temp_asset_dir: directory for saving parsed assets.
+        - pdf_bytes: pdf content, bytes or mapped file.
+        - doc: `fitz.Document` opened from `pdf_bytes`.
+        - page_indices: indices of pages to parse.
 
+        Returns:
+        - A dict of page index to parsed content blocks of the page.
+        """
+        import fitz
+
+        pages = {i: [] for i in page_indices}
+        scan_pages = []
+        for i in page_indices:
+            with self.timer.step('text_layer_check'):
+                text_page = config.PDF_TEXT_LAYER_ENABLE and is_text_page(
+                    doc[i], min_chars=config.PDF_TEXT_LAYER_MIN_CHARS)
+            if not text_page:
+                scan_pages.append(i)
+                continue
+            with self.timer.step('text_layer_extract'):
+                pages[i] = extract_page_blocks(
+                    page=doc[i],
+                    page_idx=i,
+                    temp_asset_dir=temp_asset_dir,
+                )
         logging.info(
-            f'{self.file_name}: {len(filtered_chunks)} chunks after filtering')
+            f'{file_path}: {len(page_indices) - len(scan_pages)} text layer pages, {len(scan_pages)} pages to analyze by model'
+        )
+        if len(scan_pages) == 0:
+            return pages
+
+        sub_pdf_bytes = pdf_bytes
+        if len(scan_pages) < doc.page_count:
+            with self.timer.step('split_scan_pages'):
+                sub_doc = fitz.open()
+                for i in scan_pages:
+                    sub_doc.insert_pdf(doc, from_page=i, to_page=i)
+                sub_pdf_bytes = sub_doc.tobytes()
+                sub_doc.close()
+
+        blocks = self.parse_pdf_content(
+            file_path=file_path,
+            temp_asset_dir=temp_asset_dir,
+            pdf_bytes=sub_pdf_bytes,
+        )
+        for block in blocks:
+            page_idx = scan_pages[block.get('page_idx', 0)]
+            block['page_idx'] = page_idx
+            pages[page_idx].append(block)
 
-        return filtered_chunks
+        return pages
 
     def parse_pdf_content(
         self,
         file_path: str,
         temp_asset_dir: str,
+        pdf_bytes: bytes = None,
     ) -> list[dict]:
         """
         Parse PDF content and return content list. The result is a list of json 
@@ -125,295 +490,168 @@ class PDFParser(Parser):
         Refer [MinerU API demo](https://mineru.readthedocs.io/en/latest/user_guide/usage/api.html) 
         for more details.
 
+        Args:
+        - file_path: path to the file.
+        - temp_asset_dir: directory for saving parsed assets.
+        - pdf_bytes: pdf content, read from `file_path` if not provided.
+
         Returns:
         - A list of parsed content block dict.
         """
         # NOTE: magic_pdf package uses singleton design and the model isntance is
         # initialized when the module is imported, so postpone the import statement
         # until parse method is called.
-        from magic_pdf.data.data_reader_writer import FileBasedDataWriter, FileBasedDataReader
-        from magic_pdf.data.dataset import PymuDocDataset
-        from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
-        from magic_pdf.config.enums import SupportedPdfParseMethod
+        with self.timer.step('model_load'):
+            from magic_pdf.data.data_reader_writer import FileBasedDataWriter, FileBasedDataReader
+            from magic_pdf.data.dataset import PymuDocDataset
+            from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
 
         # prepare env
-        name_without_suff = os.path.basename(file_path).split(".")[0]
         local_image_dir = os.path.join(temp_asset_dir, "images")
-        local_md_dir = temp_asset_dir
         image_dir = os.path.basename(local_image_dir)
         os.makedirs(local_image_dir, exist_ok=True)
 
         image_writer = FileBasedDataWriter(local_image_dir)
-        md_writer = FileBasedDataWriter(local_md_dir)
 
         # read bytes
-        reader = FileBasedDataReader("")
-        pdf_bytes = reader.read(file_path)
+        if pdf_bytes is None:
+            reader = FileBasedDataReader("")
+            pdf_bytes = reader.read(file_path)
+        elif not isinstance(pdf_bytes, bytes):
+            # mapped file, MinerU dataset takes bytes only
+            pdf_bytes = bytes(pdf_bytes)
         logging.info(f"{file_path}: read bytes count: {len(pdf_bytes)}")
 
         # process
-        ds = PymuDocDataset(pdf_bytes)
+        with self.timer.step('load_dataset'):
+            ds = PymuDocDataset(pdf_bytes)
 
         # inference
-        infer_result = ds.apply(doc_analyze)
-        pipe_result = infer_result.pipe_txt_mode(image_writer)
-
-        # draw model result on each page
-        infer_result.draw_model(
-            os.path.join(local_md_dir, f"{name_without_suff}_model.pdf"))
-
-        # get model inference result
-        model_inference_result = infer_result.get_infer_res()
-
-        # draw layout result on each page
-        pipe_result.draw_layout(
-            os.path.join(local_md_dir, f"{name_without_suff}_layout.pdf"))
-
-        # draw spans result on each page
-        pipe_result.draw_span(
-            os.path.join(local_md_dir, f"{name_without_suff}_spans.pdf"))
-
-        # get markdown content
-        md_content = pipe_result.get_markdown(image_dir)
-
-        # dump markdown
-        pipe_result.dump_md(md_writer, f"{name_without_suff}.md", image_dir)
-
-        # get content list content
-        content_list = pipe_result.get_content_list(image_dir)
-
-        # dump content list
-        pipe_result.dump_content_list(
-            md_writer, f"{name_without_suff}_content_list.json", image_dir)
-
-        # get middle json
-        middle_json_content = pipe_result.get_middle_json()
-
-        # dump middle json
-        pipe_result.dump_middle_json(md_writer,
-                                     f'{name_without_suff}_middle.json')
+        with self.timer.step('analyze'):
+            infer_result = ds.apply(doc_analyze)
+        with self.timer.step('pipe'):
+            pipe_result = infer_result.pipe_txt_mode(image_writer)
+
+        # get content list content, built in memory
+        with self.timer.step('content_list'):
+            content_list = pipe_result.get_content_list(image_dir)
+
+        if self.artifact_mode == ParseArtifactMode.DEBUG:
+            self.dump_debug_artifacts(
+                file_path=file_path,
+                pdf_bytes=pdf_bytes,
+                infer_result=infer_result,
+                pipe_result=pipe_result,
+                image_dir=image_dir,
+            )
 
         return content_list
 
-    def chunk(
+    def dump_debug_artifacts(
         self,
-        content_list: list[dict],
-        temp_asset_dir: str,
-        asset_save_dir: str,
-    ) -> Chunk:
+        file_path: str,
+        pdf_bytes: bytes,
+        infer_result,
+        pipe_result,
+        image_dir: str,
+    ):
         """
-        Chunk parsed pdf contents.
-
-        Scan `self.consecutive_block_num` consecutive blocks and combine as one
-        chunk.
-        If image / table block is encountered within current consecutive blocks,
-        then make the image / table block as independent chunk and continue scan
-        untile `self.consecutive_block_num` is met.
-
-        Two consecutive chunks have `self.block_overlap_num` overlapped block to
-        ensure semantic coherence.
-
-        Returns:
-        - List of chunks.
+        Render and dump MinerU intermediate results into
+        `{config.PDF_PARSE_DEBUG_DIR}/{file name}_{pdf content hash}`, the
+        directory is kept for inspection. Referenced images stay in the parse
+        asset directory.
         """
-        chunks = []
-        block_buffer = []
-        i = 0
-        # since we apply overlap,i can not exceed len(content_list) - self.block_overlap_num,
-        # otherwise, infinite loop may happen.
-        while i < len(content_list) - self.block_overlap_num:
-            print(f"i = {i}")
-
-            # inner loop start from current block
-            j = i
-            while j < len(content_list) and len(
-                    block_buffer) < self.consecutive_block_num:
-                print(f"\tj = {j}")
-
-                block = content_list[j]
-
-                # text block
-                if block['type'] in ['text', 'equation']:
-                    block_buffer.append(block)
-
-                # image / table block
-                elif block['type'] in ['image', 'table']:
-                    if block['type'] == 'table':
-                        chunks.extend(
-                            self.process_table_blocks(
-                                table_blocks=content_list[j:j + 1],
-                                temp_asset_dir=temp_asset_dir,
-                                asset_save_dir=asset_save_dir,
-                            ))
-                    else:
-                        chunks.extend(
-                            self.process_image_blocks(
-                                image_blocks=content_list[j:j + 1],
-                                temp_asset_dir=temp_asset_dir,
-                                asset_save_dir=asset_save_dir,
-                            ))
-                else:
-                    pass
-
-                # move one step forward
-                j += 1
-
-            # inner loop ends when j == len(content_list)
-            # or len(block_buffer) == self.consecutive_block_num
-            # generate new chunk if buffer is not empty.
-            if len(block_buffer) > 0:
-                chunks.extend(
-                    self.process_text_blocks(
-                        text_blocks=block_buffer,
-                        temp_asset_dir=temp_asset_dir,
-                        asset_save_dir=asset_save_dir,
-                    ))
-                block_buffer.clear()
-
-            # start next iteration
-            i = j - self.block_overlap_num
-
-        return chunks
-
-    def process_text_blocks(
-        self,
-        text_blocks: list[dict],
-        temp_asset_dir: str,
-        asset_save_dir: str,
-    ) -> list[Chunk]:
-        texts = [str(block['text']) for block in text_blocks]
-        content = self.strip_text_content(texts)
-        return [
-            Chunk(
-                content_type=ChunkType.TEXT,
-                file_name=self.file_name,
-                content=content.encode('utf-8'),
-                extra_description=''.encode('utf-8'),
-            )
-        ]
+        from magic_pdf.data.data_reader_writer import FileBasedDataWriter
 
-    def process_image_blocks(
-        self,
-        image_blocks: list[dict],
-        temp_asset_dir: str,
-        asset_save_dir: str,
-    ) -> list[Chunk]:
+        name_without_suff = os.path.basename(file_path).split(".")[0]
+        local_md_dir = os.path.join(
+            config.PDF_PARSE_DEBUG_DIR,
+            f'{name_without_suff}_{get_hash64(pdf_bytes)}')
+        os.makedirs(local_md_dir, exist_ok=True)
+        md_writer = FileBasedDataWriter(local_md_dir)
+        logging.info(f'{file_path}: dump debug artifacts to {local_md_dir}')
 
-        def _load_image(p: str) -> bytes:
-            with open(p, 'rb') as f:
-                image_bytes = f.read()
-            return image_bytes
-
-        def _save_image(src_path: str, dst_dir: str):
-            dst_path = os.path.join(dst_dir, os.path.basename(src_path))
-            shutil.copyfile(src_path, dst_path)
-
-        chunks = []
-        for block in image_blocks:
-            texts = [
-                str(block.get('img_caption', '')),
-                str(block.get('img_footnote', '')),
-            ]
-            extra_description = self.strip_text_content(texts)
-            if len(extra_description) == 0:
-                extra_description = "no caption for this image"
-
-            abs_img_path = os.path.join(temp_asset_dir, block['img_path'])
-            _save_image(abs_img_path, asset_save_dir)
-
-            chunk = Chunk(
-                content_type=ChunkType.IMAGE,
-                file_name=self.file_name,
-                content=_load_image(abs_img_path),
-                extra_description=(extra_description).encode('utf-8'),
-                content_url=os.path.join(asset_save_dir,
-                                         os.path.basename(abs_img_path)),
-            )
-            chunks.append(chunk)
+        # draw model result on each page
+        with self.timer.step('draw_model'):
+            infer_result.draw_model(
+                os.path.join(local_md_dir, f"{name_without_suff}_model.pdf"))
 
-        return chunks
+        # draw layout result on each page
+        with self.timer.step('draw_layout'):
+            pipe_result.draw_layout(
+                os.path.join(local_md_dir, f"{name_without_suff}_layout.pdf"))
 
-    def process_table_blocks(
-        self,
-        table_blocks: list[dict],
-        temp_asset_dir: str,
-        asset_save_dir: str,
-    ) -> list[Chunk]:
-        chunks = []
-        for block in table_blocks:
-            texts = [
-                str(block.get('table_caption', '')),
-                str(block.get('table_footnote', '')),
-            ]
-            extra_description = self.strip_text_content(texts)
-            if len(extra_description) == 0:
-                extra_description = "no caption for this table"
-
-            chunk = Chunk(
-                content_type=ChunkType.TABLE,
-                file_name=self.file_name,
-                content=block['table_body'].encode('utf-8'),
-                extra_description=(extra_description).encode('utf-8'),
-            )
-            chunks.append(chunk)
+        # draw spans result on each page
+        with self.timer.step('draw_span'):
+            pipe_result.draw_span(
+                os.path.join(local_md_dir, f"{name_without_suff}_spans.pdf"))
 
-        return chunks
+        # dump markdown
+        with self.timer.step('dump_md'):
+            pipe_result.dump_md(md_writer, f"{name_without_suff}.md",
+                                image_dir)
 
-    def filter_chunks(self, chunks: list[Chunk]) -> list[Chunk]:
-        """
-        Filter too short chunks
-        """
-        filtered_chunks = []
-        for chunk in chunks:
-            content = chunk.content
-            if chunk.content_type != config.ChunkType.TEXT:
-                content = chunk.extra_description
-            content = safe_strip(content.decode('utf-8'))
-            if len(content) < 8 or len(content.split()) < 3:
-                logging.info(
-                    f'{self.file_name}: remove chunk due to too short content: {str(chunk)}'
-                )
-                continue
+        # dump content list
+        with self.timer.step('dump_content_list'):
+            pipe_result.dump_content_list(
+                md_writer, f"{name_without_suff}_content_list.json",
+                image_dir)
 
-            filtered_chunks.append(chunk)
+        # dump middle json
+        with self.timer.step('dump_middle_json'):
+            pipe_result.dump_middle_json(md_writer,
+                                         f'{name_without_suff}_middle.json')
 
-        return filtered_chunks
 
-    def strip_text_content(self, texts: list[str]) -> str:
-        """
-        Filter and merge text content
-        """
-        content = ""
-        for text in texts:
-            striped = safe_strip(text)
-            if len(striped) == 0 or striped == '[]':
-                continue
-            content += striped
-            content += "\n\n"
-        return content.strip()
+def open_pdf(file_path: str, pdf_bytes: bytes):
+    """
+    Open PDF from content bytes. PyMuPDF copies any other stream into bytes, so
+    a mapped file is opened from `file_path` instead.
 
-    def is_valid_block(self, block: Dict[str, Any]) -> bool:
-        """
-        There are corner cases where returned blocks dont contain expected keys 
-        or values are empty.
+    Returns:
+    - `fitz.Document`.
+    """
+    import fitz
 
-        Returns:
-        - bool: true if block is valid.
-        """
-        # missing key
-        if 'type' not in block:
-            return False
+    if isinstance(pdf_bytes, bytes):
+        return fitz.open(stream=pdf_bytes, filetype='pdf')
+    return fitz.open(file_path, filetype='pdf')
 
-        # text / equation
-        if block['type'] in ['text', 'equation']:
-            return 'text' in block
 
-        # image
-        if block['type'] == 'image':
-            return 'img_path' in block and len(block['img_path']) > 0
+def parse_pdf_shard(
+    file_path: str,
+    temp_asset_dir: str,
+    pdf_bytes: bytes,
+) -> Tuple[Dict[int, list[dict]], Dict[str, float]]:
+    """
+    Parse all pages of a PDF shard, run in shard worker processes.
 
-        # table
-        if block['type'] == 'table':
-            return 'table_body' in block
+    Args:
+    - file_path: path to the original file, for logging and asset naming.
+    - temp_asset_dir: directory for saving parsed assets.
+    - pdf_bytes: content of the shard sub document.
 
-        return True
+    Returns:
+    - A dict of shard page index to parsed content blocks of the page.
+    - A dict of parse step timings of the shard.
+    """
+    import fitz
+
+    # NOTE: parser is a singleton, the shard may run in the process parsing
+    # the whole document, keep shard timings apart.
+    parser = PDFParser()
+    timer = parser.timer
+    parser.timer = StepTimer()
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype='pdf')
+        pages = parser.analyze_pdf_pages(
+            file_path=file_path,
+            temp_asset_dir=temp_asset_dir,
+            pdf_bytes=pdf_bytes,
+            doc=doc,
+            page_indices=list(range(doc.page_count)),
+        )
+        doc.close()
+        return pages, parser.timer.timings
+    finally:
+        parser.timer = timer
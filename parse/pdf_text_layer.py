@@ -0,0 +1,142 @@
+import os
+import re
+import statistics
+
+from utils import get_hash64
+
+# text block starting with below pattern right after an image is taken as the
+# image caption.
+_caption_pattern = re.compile(r'^(fig\.?|figure|图)\s*\d+', re.IGNORECASE)
+
+
+def is_text_page(page, min_chars: int = 200) -> bool:
+    """
+    Check if a PDF page has a usable text layer, so that it can be extracted
+    directly instead of running layout / OCR models.
+
+    A page is considered text page if:
+    - it has at least `min_chars` non-space characters.
+    - less than 5% of the characters are unrecognized glyphs.
+    - it is not dominated by images, i.e., a scanned page with a thin OCR or
+        header text layer.
+
+    Args:
+    - page: `fitz.Page`.
+    - min_chars: min non-space characters.
+    """
+    text = page.get_text('text')
+    chars = [ch for ch in text if not ch.isspace()]
+    if len(chars) < min_chars:
+        return False
+
+    bad_chars = sum(1 for ch in chars if ch == '�')
+    if bad_chars > len(chars) * 0.05:
+        return False
+
+    page_area = abs(page.rect)
+    image_area = 0.0
+    for info in page.get_image_info():
+        image_area += abs(page.rect & info['bbox'])
+    if page_area > 0 and image_area / page_area > 0.6 \
+            and len(chars) < min_chars * 5:
+        return False
+
+    return True
+
+
+def extract_page_blocks(
+    page,
+    page_idx: int,
+    temp_asset_dir: str,
+    min_image_size: int = 50,
+) -> list[dict]:
+    """
+    Extract text layer of a PDF page into MinerU style content blocks, see
+    `PDFParser.parse_pdf_content` for block keys. Lines with font size clearly
+    larger than page body text are taken as headlines, blocks in page top and
+    bottom margins (page header / footer) are dropped, images are saved under
+    `{temp_asset_dir}/images`.
+
+    Args:
+    - page: `fitz.Page`.
+    - page_idx: page index set to blocks.
+    - temp_asset_dir: directory for saving extracted images.
+    - min_image_size: images smaller than this (in pixels) are ignored.
+
+    Returns:
+    - A list of content block dict.
+    """
+    import fitz
+
+    flags = fitz.TEXTFLAGS_DICT | fitz.TEXT_DEHYPHENATE
+    page_dict = page.get_text('dict', flags=flags)
+    height = page.rect.height
+    margin = height * 0.06
+
+    # body font size, weighted by text length
+    sizes = []
+    for block in page_dict['blocks']:
+        for line in block.get('lines', []):
+            for span in line['spans']:
+                sizes.extend([round(span['size'], 1)] * len(span['text']))
+    body_size = statistics.median(sizes) if len(sizes) > 0 else 0
+
+    blocks = []
+    for block in page_dict['blocks']:
+        x0, y0, x1, y1 = block['bbox']
+
+        # image block
+        if block['type'] == 1:
+            if block['width'] < min_image_size or \
+                    block['height'] < min_image_size:
+                continue
+            image_bytes = block['image']
+            img_path = os.path.join(
+                'images', f"{get_hash64(image_bytes)}.{block['ext']}")
+            abs_img_path = os.path.join(temp_asset_dir, img_path)
+            os.makedirs(os.path.dirname(abs_img_path), exist_ok=True)
+            with open(abs_img_path, 'wb') as f:
+                f.write(image_bytes)
+            blocks.append({
+                'type': 'image',
+                'img_path': img_path,
+                'img_caption': [],
+                'img_footnote': [],
+                'page_idx': page_idx,
+            })
+            continue
+
+        # text block, drop page header / footer
+        if y1 < margin or y0 > height - margin:
+            continue
+        lines = []
+        block_size = 0
+        for line in block.get('lines', []):
+            text = ''.join(span['text'] for span in line['spans']).strip()
+            if len(text) == 0:
+                continue
+            lines.append(text)
+            block_size = max([block_size] +
+                             [span['size'] for span in line['spans']])
+        if len(lines) == 0:
+            continue
+        text = ' '.join(lines)
+
+        # caption of previous image
+        if len(blocks) > 0 and blocks[-1]['type'] == 'image' \
+                and len(blocks[-1]['img_caption']) == 0 \
+                and _caption_pattern.match(text) is not None:
+            blocks[-1]['img_caption'] = [text]
+            continue
+
+        content_block = {
+            'type': 'text',
+            'text': text,
+            'page_idx': page_idx,
+        }
+        # short block with large font is taken as headline
+        if body_size > 0 and block_size >= body_size * 1.2 and len(lines) <= 2:
+            content_block['text_level'] = 1
+        blocks.append(content_block)
+
+    return blocks
@@ -0,0 +1,124 @@
+import os
+import re
+import logging
+from typing import Iterator
+
+from parse.parser import ContentListParser, Chunk
+
+
+class TextParser(ContentListParser):
+    """
+    Plain text parser. File is read line by line and split into paragraph
+    blocks on blank lines, no model is involved.
+    """
+
+    def parse(
+        self,
+        file_path: str,
+        asset_save_dir: str,
+        content_hash: str = None,
+    ) -> list[Chunk]:
+        self.file_name = os.path.basename(file_path)
+
+        content_list = list(self.iter_blocks(file_path))
+        logging.info(f'{self.file_name}: total {len(content_list)} blocks')
+
+        return self.build_chunks(
+            content_list=content_list,
+            temp_asset_dir='',
+            asset_save_dir=asset_save_dir,
+        )
+
+    def parse_iter(
+        self,
+        file_path: str,
+        asset_save_dir: str,
+        content_hash: str = None,
+    ) -> Iterator[Chunk]:
+        self.file_name = os.path.basename(file_path)
+
+        yield from self.build_chunks_iter(
+            blocks=self.iter_blocks(file_path),
+            temp_asset_dir='',
+            asset_save_dir=asset_save_dir,
+        )
+
+    def iter_blocks(self, file_path: str) -> Iterator[dict]:
+        """
+        Yield paragraph blocks, a paragraph is consecutive non-blank lines.
+        """
+        lines = []
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if len(line.strip()) == 0:
+                    if len(lines) > 0:
+                        yield self.text_block(lines)
+                        lines = []
+                    continue
+                lines.append(line.rstrip())
+        if len(lines) > 0:
+            yield self.text_block(lines)
+
+    def text_block(self, lines: list[str], text_level: int = None) -> dict:
+        block = {'type': 'text', 'text': '\n'.join(lines)}
+        if text_level is not None:
+            block['text_level'] = text_level
+        return block
+
+
+class MarkdownParser(TextParser):
+    """
+    Markdown parser. Besides paragraphs, ATX headings (`# title`) are emitted as
+    separated blocks with `text_level` set to heading level, and fenced code
+    blocks are kept as one block even if they contain blank lines.
+    """
+
+    heading_pattern = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+    fence_pattern = re.compile(r'^\s*(```|~~~)')
+
+    def iter_blocks(self, file_path: str) -> Iterator[dict]:
+        lines = []
+        fence = None
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line_no, line in enumerate(f):
+                line = line.rstrip()
+
+                # skip yaml front matter
+                if line_no == 0 and line == '---':
+                    for line in f:
+                        if line.rstrip() in ['---', '...']:
+                            break
+                    continue
+
+                # inside fenced code block
+                if fence is not None:
+                    lines.append(line)
+                    if line.strip().startswith(fence):
+                        fence = None
+                    continue
+
+                m = self.fence_pattern.match(line)
+                if m is not None:
+                    fence = m.group(1)
+                    lines.append(line)
+                    continue
+
+                m = self.heading_pattern.match(line)
+                if m is not None:
+                    if len(lines) > 0:
+                        yield self.text_block(lines)
+                        lines = []
+                    yield self.text_block([m.group(2)],
+                                          text_level=len(m.group(1)))
+                    continue
+
+                if len(line.strip()) == 0:
+                    if len(lines) > 0:
+                        yield self.text_block(lines)
+                        lines = []
+                    continue
+                lines.append(line)
+
+        if len(lines) > 0:
+            yield self.text_block(lines)
+
@@ -14,14 +14,16 @@ class MockEmbedingModel(EmbeddingModel):
         import numpy as np
         from scipy.sparse import csr_array
 
-        dense_vector = np.random.uniform(low=0.0,
-                                         high=1.0,
-                                         size=self.dense_embed_dim),
-
-        row = np.array([0, 1, 2, 0])
-        col = np.array([0, 1, 1, 0])
-        data = np.array([1, 2, 4, 8])
-        sparse_vector = csr_array((data, (row, col)), shape=(3, 3))
+        # one row per text
+        dense_vector = [
+            np.random.uniform(low=0.0, high=1.0, size=self.dense_embed_dim)
+            for _ in texts
+        ]
+
+        row = np.repeat(np.arange(len(texts)), 2)
+        col = np.tile(np.array([0, 1]), len(texts))
+        data = np.tile(np.array([1, 2]), len(texts))
+        sparse_vector = csr_array((data, (row, col)), shape=(len(texts), 3))
 
         return {
             'dense': dense_vector,
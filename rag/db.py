@@ -3,14 +3,16 @@ import traceback
 import json
 import sqlite3
 import os
+import threading
 
 from typing import Union, Dict, List, Any
 from abc import ABC, abstractmethod
 from strenum import StrEnum
 
 import config
-from utils import singleton, run_once
+from utils import singleton, run_once, logging_exception
 from . import get_embed_model
+from .embed_cache import cached_encode
 from parse.parser import Chunk
 
 
@@ -42,6 +44,39 @@ class VectorDB(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    @abstractmethod
+    def insert_many(self, data: list[Chunk]) -> list[bool]:
+        """
+        Insert or update records in bulk.
+
+        Returns:
+        - A list of bool, aligned with `data`, true if the record is successfully
+            inserted.
+        """
+        raise NotImplementedError("Not implemented")
+
+    @abstractmethod
+    def build_records(self, data: list[Chunk]) -> list[Dict[str, Any]]:
+        """
+        Embed chunks and build db records, used when embedding and writing are
+        run in separated stages.
+
+        Returns:
+        - A list of records, aligned with `data`.
+        """
+        raise NotImplementedError("Not implemented")
+
+    @abstractmethod
+    def upsert_records(self, records: list[Dict[str, Any]]) -> list[bool]:
+        """
+        Insert or update records built by `build_records`.
+
+        Returns:
+        - A list of bool, aligned with `records`, true if the record is
+            successfully inserted.
+        """
+        raise NotImplementedError("Not implemented")
+
     @abstractmethod
     def delete(self, keys: list[str]) -> int:
         """
@@ -62,6 +97,19 @@ class VectorDB(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    @abstractmethod
+    def rekey_records(self, keys: list[str], file_name: str) -> list[str]:
+        """
+        Copy records to the uuids they would have under `file_name`, keeping
+        their embeddings. Records under old uuids are left to the caller to
+        delete.
+
+        Returns:
+        - A list of new uuids, aligned with `keys`, None if the record is not
+            found or fails to be copied.
+        """
+        raise NotImplementedError("Not implemented")
+
     @abstractmethod
     def search(self, query: str, params: Dict[str,
                                               Any]) -> list[Dict[str, Any]]:
@@ -77,32 +125,183 @@ class MilvusLiteDB(VectorDB):
         self.client = MilvusClient(conn_url)
 
     def insert(self, data: Chunk) -> int:
-        # embed chunks
-        embed_model = get_embed_model(name=config.EMBED_MODEL_NAME)
-        content = data.content
+        return sum(self.insert_many([data]))
+
+    def insert_many(self, data: list[Chunk]) -> list[bool]:
+        """
+        Embed chunks in size bounded batches and upsert each batch in one round
+        trip. A batch is marked as failed as a whole if the upsert count does
+        not match the batch size, upsert is idempotent so it is safe to retry.
+        """
+        ret = []
+        for batch in self.split_batches(data):
+            try:
+                records = self.build_records(batch)
+            except Exception as e:
+                logging_exception(e)
+                ret.extend([False] * len(batch))
+                continue
+            ret.extend(self.upsert_records(records))
+        return ret
 
+    def upsert_records(self, records: list[Dict[str, Any]]) -> list[bool]:
+        ret = []
+        for i in range(0, len(records), config.EMBED_BATCH_SIZE):
+            batch = records[i:i + config.EMBED_BATCH_SIZE]
+            try:
+                stats = self.client.upsert(self.collection_name, batch)
+                logging.info(f'insert stats: {stats}')
+                success = stats['upsert_count'] == len(batch)
+            except Exception as e:
+                logging_exception(e)
+                success = False
+            ret.extend([success] * len(batch))
+        return ret
+
+    def split_batches(self, data: list[Chunk]) -> list[list[Chunk]]:
+        """
+        Split chunks into batches bounded by `config.EMBED_BATCH_SIZE` chunks
+        and `config.EMBED_BATCH_MAX_CHARS` embedded characters.
+        """
+        batches = []
+        batch = []
+        batch_chars = 0
+        for chunk in data:
+            chunk_chars = len(self.embed_content(chunk))
+            if len(batch) > 0 and (
+                    len(batch) >= config.EMBED_BATCH_SIZE
+                    or batch_chars + chunk_chars > config.EMBED_BATCH_MAX_CHARS):
+                batches.append(batch)
+                batch = []
+                batch_chars = 0
+            batch.append(chunk)
+            batch_chars += chunk_chars
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def embed_content(self, data: Chunk) -> str:
+        """
+        The text used for embedding, non-text chunks are embedded by their
+        description.
+        """
         if data.content_type != config.ChunkType.TEXT:
-            content = data.extra_description
-        content = content.decode('utf-8')
-
-        meta = {'file_name': data.file_name}
-        if data.content_type == config.ChunkType.IMAGE:
-            meta['content_url'] = data.content_url
-        if data.content_type == config.ChunkType.TABLE:
-            meta['table_content'] = data.content.decode('utf-8')
-
-        embeddings = embed_model.encode([content])
-        record = {
-            'uuid': data.uuid,
-            'content': content,
-            'meta': json.dumps(meta, indent=4),
-            'sparse_vector': embeddings['sparse'][[0]],
-            'dense_vector': embeddings['dense'][0],
-        }
+            return data.description
+        return data.text
 
-        stats = self.client.upsert(self.collection_name, record)
-        logging.info(f'insert stats: {stats}')
-        return stats['upsert_count']
+    def build_records(self, data: list[Chunk]) -> list[Dict[str, Any]]:
+        """
+        Embed chunks with one model call and build milvus records. Texts found
+        in embedding cache are not embedded again.
+        """
+        embed_model = get_embed_model(name=config.EMBED_MODEL_NAME)
+        contents = [self.embed_content(chunk) for chunk in data]
+        embeddings = cached_encode(
+            embed_model=embed_model,
+            model_name=config.EMBED_MODEL_NAME,
+            texts=contents,
+        )
+
+        records = []
+        for i, chunk in enumerate(data):
+            meta = {
+                'file_name': chunk.file_name,
+                'content_type': chunk.content_type,
+            }
+            if chunk.content_type == config.ChunkType.IMAGE:
+                meta['content_url'] = chunk.content_url
+            if chunk.content_type == config.ChunkType.TABLE:
+                meta['table_content'] = chunk.text
+
+            records.append({
+                'uuid': chunk.uuid,
+                'content': contents[i],
+                'meta': json.dumps(meta, indent=4),
+                'sparse_vector': embeddings['sparse'][[i]],
+                'dense_vector': embeddings['dense'][i],
+            })
+        return records
+
+    def rekey_records(self, keys: list[str], file_name: str) -> list[str]:
+        """
+        Chunk uuid is derived from file name, a renamed document gets new uuids
+        while contents and embeddings stay the same. The chunk of each record
+        is rebuilt from stored fields to derive its new uuid, and the record is
+        upserted under it with embeddings read back from db.
+        """
+        new_keys = {}
+        for i in range(0, len(keys), config.EMBED_BATCH_SIZE):
+            batch = keys[i:i + config.EMBED_BATCH_SIZE]
+            records = self.client.get(
+                collection_name=self.collection_name,
+                ids=batch,
+                output_fields=[
+                    'uuid', 'content', 'meta', 'dense_vector', 'sparse_vector'
+                ],
+            )
+            # (old uuid, record under new uuid)
+            rekeyed = []
+            for record in records:
+                record = dict(record)
+                meta = record['meta']
+                if isinstance(meta, str):
+                    meta = json.loads(meta)
+                chunk = self.record_to_chunk(record['content'], meta,
+                                             file_name)
+                meta['file_name'] = file_name
+                rekeyed.append((record['uuid'], {
+                    **record,
+                    'uuid': chunk.uuid,
+                    'meta': json.dumps(meta, indent=4),
+                }))
+
+            ret = self.upsert_records([r for _, r in rekeyed])
+            for (key, record), success in zip(rekeyed, ret):
+                if success:
+                    new_keys[key] = record['uuid']
+        return [new_keys.get(key) for key in keys]
+
+    def record_to_chunk(
+        self,
+        content: str,
+        meta: Dict[str, Any],
+        file_name: str,
+    ) -> Chunk:
+        """
+        Rebuild chunk of a record under `file_name`, reverse of
+        `build_records`. Records without `content_type` in meta are typed by
+        their meta keys.
+        """
+        content_type = meta.get('content_type')
+        if content_type is None:
+            if 'content_url' in meta:
+                content_type = config.ChunkType.IMAGE
+            elif 'table_content' in meta:
+                content_type = config.ChunkType.TABLE
+            else:
+                content_type = config.ChunkType.TEXT
+
+        if content_type == config.ChunkType.IMAGE:
+            return Chunk(
+                content_type=content_type,
+                file_name=file_name,
+                content=os.path.basename(meta['content_url']).encode('utf-8'),
+                extra_description=content.encode('utf-8'),
+                content_url=meta['content_url'],
+            )
+        if content_type == config.ChunkType.TABLE:
+            return Chunk(
+                content_type=content_type,
+                file_name=file_name,
+                content=meta['table_content'].encode('utf-8'),
+                extra_description=content.encode('utf-8'),
+            )
+        return Chunk(
+            content_type=content_type,
+            file_name=file_name,
+            content=content.encode('utf-8'),
+            extra_description=b'',
+        )
 
     def delete(self, keys: list[str]) -> Any:
         stats = self.client.delete(
@@ -325,6 +524,12 @@ class RationalDB(ABC):
 
 @singleton
 class SQLiteDB(RationalDB):
+    """
+    SQLite document db. One connection is shared by ingestion workers, watcher
+    and http threads, every call holds `_lock` so that statements and commits
+    of different threads never interleave, e.g., a commit or rollback of one
+    thread applying to a half done statement of another.
+    """
 
     def __init__(self, conn_url: str, token: str = None, **kwargs):
         """
@@ -334,109 +539,195 @@ class SQLiteDB(RationalDB):
         """
         super().__init__()
         import sqlite3
+        self._lock = threading.RLock()
         self.conn = sqlite3.connect(conn_url, check_same_thread=False)
         for k, v in kwargs.items():
             setattr(self, k, v)
 
     def insert_document(self, data: Dict[str, Any]) -> int:
         import sqlite3
-        cur = self.conn.cursor()
         key_col = 'name'
 
-        cur.execute(f"SELECT id FROM {self.document_table} WHERE name = ?",
-                    (data[key_col], ))
-        record_exists = cur.fetchone() is not None
-
-        try:
-            if record_exists:
-                # update
-                update_query = f"UPDATE {self.document_table} SET "
-                update_query_values = []
-                for column, value in data.items():
-                    update_query += f"{column} = ?, "
-                    update_query_values.append(value)
-                update_query = update_query.rstrip(', ')
-                update_query += f" WHERE {key_col} = ?"
-                update_query_values.append(data[key_col])
-                cur.execute(update_query, update_query_values)
-            else:
-                # insert
-                columns = []
-                values = []
-                for column, value in data.items():
-                    columns.append(column)
-                    values.append(value)
-
-                columns = ', '.join(columns)
-                placeholders = ', '.join(['?'] * len(data))
-                insert_query = f"INSERT INTO {self.document_table} ({columns}) VALUES ({placeholders})"
-                cur.execute(insert_query, tuple(values))
-            self.conn.commit()
-        except sqlite3.Error as e:
-            if self.conn:
-                self.conn.rollback()
-
-            logging.info(f"Exception: {type(e).__name__} - {e}")
+        # select and insert in one critical section, concurrent inserts of the
+        # same name would add duplicate records otherwise.
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                f"SELECT id FROM {self.document_table} WHERE name = ?",
+                (data[key_col], ))
+            record_exists = cur.fetchone() is not None
 
-            formatted_traceback = traceback.format_exc()
-            logging.info(formatted_traceback)
-            return 0
-        finally:
-            return 1
+            try:
+                if record_exists:
+                    # update
+                    update_query = f"UPDATE {self.document_table} SET "
+                    update_query_values = []
+                    for column, value in data.items():
+                        update_query += f"{column} = ?, "
+                        update_query_values.append(value)
+                    update_query = update_query.rstrip(', ')
+                    update_query += f" WHERE {key_col} = ?"
+                    update_query_values.append(data[key_col])
+                    cur.execute(update_query, update_query_values)
+                else:
+                    # insert
+                    columns = []
+                    values = []
+                    for column, value in data.items():
+                        columns.append(column)
+                        values.append(value)
+
+                    columns = ', '.join(columns)
+                    placeholders = ', '.join(['?'] * len(data))
+                    insert_query = f"INSERT INTO {self.document_table} ({columns}) VALUES ({placeholders})"
+                    cur.execute(insert_query, tuple(values))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                if self.conn:
+                    self.conn.rollback()
+
+                logging.info(f"Exception: {type(e).__name__} - {e}")
+
+                formatted_traceback = traceback.format_exc()
+                logging.info(formatted_traceback)
+                return 0
+            finally:
+                return 1
 
     def get_document(self, name: str):
-        cur = self.conn.cursor()
         query = f"SELECT * FROM {self.document_table} WHERE name = ?"
 
-        ret = cur.execute(query, (name, ))
-        res = ret.fetchall()
+        with self._lock:
+            cur = self.conn.cursor()
+            ret = cur.execute(query, (name, ))
+            res = ret.fetchall()
+            columns = [d[0] for d in ret.description]
         if len(res) < 1:
             return None
-        res = res[0]
-        return {
-            'name': res[1],
-            'chunks': res[2],
-            'created_date': res[3],
-            'content_hash': res[4],
-        }
+        record = dict(zip(columns, res[0]))
+        record.pop('id', None)
+        return record
 
     def delete_document(self, name: str) -> int:
         import sqlite3
 
-        cur = self.conn.cursor()
         query = f"DELETE FROM {self.document_table} WHERE name = ?"
         logging.info(f'delete document: {name}')
 
-        try:
-            res = cur.execute(query, (name, ))
-            self.conn.commit()
-        except sqlite3.Error as e:
-            if self.conn:
-                self.conn.rollback()
+        with self._lock:
+            cur = self.conn.cursor()
+            try:
+                res = cur.execute(query, (name, ))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                if self.conn:
+                    self.conn.rollback()
 
-            logging.info(
-                f"Initial delete fail, exception: {type(e).__name__} - {e}")
+                logging.info(
+                    f"Initial delete fail, exception: {type(e).__name__} - {e}"
+                )
 
-            formatted_traceback = traceback.format_exc()
-            logging.info(formatted_traceback)
+                formatted_traceback = traceback.format_exc()
+                logging.info(formatted_traceback)
+
+                return 0
+
+            finally:
+                return 1
 
-            return 0
+    def rename_document(self, name: str, data: Dict[str, Any]) -> int:
+        """
+        Rename document record `name` to `data['name']` and update other
+        columns in `data`, in one statement.
 
-        finally:
-            return 1
+        Returns:
+        - An int counting how many records are updated.
+        """
+        columns = ', '.join(f'{column} = ?' for column in data)
+        query = f"UPDATE {self.document_table} SET {columns} WHERE name = ?"
+        with self._lock:
+            try:
+                cur = self.conn.execute(query, list(data.values()) + [name])
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                logging_exception(e)
+                return 0
+        return cur.rowcount
 
     def get_all_documents(self, ) -> list[str]:
         query = f"SELECT name FROM {self.document_table}"
-        cur = self.conn.cursor()
 
-        ret = cur.execute(query, ())
-        res = ret.fetchall()
+        with self._lock:
+            cur = self.conn.cursor()
+            res = cur.execute(query, ()).fetchall()
         if len(res) < 1:
             return []
 
         names = [r[0] for r in res]
         return names
 
+    def get_document_names(self, prefix: str) -> list[str]:
+        """
+        Get names of documents starting with `prefix`, i.e., documents in a
+        directory, by a range scan on name index.
+        """
+        # smallest string greater than any string starting with prefix
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        query = f"SELECT name FROM {self.document_table} WHERE name >= ? AND name < ?"
+
+        with self._lock:
+            cur = self.conn.cursor()
+            res = cur.execute(query, (prefix, upper)).fetchall()
+        return [r[0] for r in res]
+
+    def get_all_document_states(self, ) -> Dict[str, Dict[str, str]]:
+        """
+        Get content hash and fingerprint of all documents in one query.
+
+        Returns:
+        - A dict, key is document name, value is a dict with `content_hash` and
+            `fingerprint`.
+        """
+        query = f"SELECT name, content_hash, fingerprint FROM {self.document_table}"
+
+        with self._lock:
+            cur = self.conn.cursor()
+            res = cur.execute(query, ()).fetchall()
+        return {
+            r[0]: {
+                'content_hash': r[1],
+                'fingerprint': r[2],
+            }
+            for r in res
+        }
+
+    def update_fingerprints(self, fingerprints: Dict[str, str]) -> int:
+        """
+        Update fingerprint of documents in one transaction.
+
+        Args:
+        - fingerprints: dict of document name to fingerprint.
+
+        Returns:
+        - An int counting how many records are updated.
+        """
+        import sqlite3
+
+        query = f"UPDATE {self.document_table} SET fingerprint = ? WHERE name = ?"
+        with self._lock:
+            cur = self.conn.cursor()
+            try:
+                cur.executemany(query,
+                                [(v, k) for k, v in fingerprints.items()])
+                self.conn.commit()
+            except sqlite3.Error as e:
+                if self.conn:
+                    self.conn.rollback()
+                logging_exception(e)
+                return 0
+        return len(fingerprints)
+
 
 @run_once
 def create_sqlite_table(
@@ -459,10 +750,18 @@ def create_sqlite_table(
         name TEXT NOT NULL,
         chunks TEXT NOT NULL,
         created_date TEXT NOT NULL,
-        content_hash TEXT NOT NULL
+        content_hash TEXT NOT NULL,
+        fingerprint TEXT NOT NULL DEFAULT ''
     )
     """
     sql_create_index = f"CREATE INDEX idx_name ON {table_name} (name)"
+    # columns added after the table is first released, added to existing tables
+    # on startup.
+    sql_added_columns = {
+        # file stat fingerprint `size:mtime_ns:inode`, used to skip content
+        # hashing of unchanged files.
+        'fingerprint': "TEXT NOT NULL DEFAULT ''",
+    }
     # NOTE: assume local file path
     os.makedirs(os.path.dirname(conn_url), exist_ok=True)
 
@@ -476,6 +775,16 @@ def create_sqlite_table(
                 logging.info(
                     f'table {table_name} found in {conn_url}, skip table creation'
                 )
+                ret = cur.execute(f"PRAGMA table_info({table_name})")
+                columns = [r[1] for r in ret.fetchall()]
+                for column, definition in sql_added_columns.items():
+                    if column in columns:
+                        continue
+                    logging.info(f'table {table_name}: add column {column}')
+                    cur.execute(
+                        f"ALTER TABLE {table_name} ADD COLUMN {column} {definition}"
+                    )
+                conn.commit()
                 return
             cur.execute(sql_create_table)
             cur.execute(sql_create_index)
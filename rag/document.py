@@ -1,113 +1,202 @@
 import traceback
 import logging
 import os
-from typing import Dict, Any
-from concurrent.futures import ThreadPoolExecutor
+import time
+from typing import Union, Tuple, Iterator
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import watchdog.events as events
 from watchdog.events import FileSystemEventHandler, FileSystemEvent
 
-from utils import now_in_utc, get_hash64, logging_exception, run_once
+import config
+from utils import (now_in_utc, get_hash64, get_file_hash64,
+                   get_file_fingerprint, open_mmap, logging_exception,
+                   run_once)
 from .db import get_vector_db, get_rational_db
+from parse.parser import Chunk, SupportedFileType
+from parse.asset_store import get_asset_store
 
 
-def process_new_file(file_path: str) -> Dict[str, bool]:
+def check_file_change(file_path: str) -> Union[Tuple[str, str], None]:
     """
-    Process new file, parse and save chunks into db.
-    Steps:
-    - check if file content is changed by content hash.
-    - clean up previous document record if any once file content change detected.
-    - run file content parse.
-    - save chunks and document record
-
-    Args:
-    - file_path: path to the file.
+    Check if file content is changed. File stat fingerprint is compared with the
+    stored document record first, file content is only read and hashed when
+    the fingerprint differs.
 
     Returns:
-    - A list containing all successfuly inserted chunks' uuid, the order is aligned
-        with the chunks' original order in source file.
+    - A tuple of file content hash and file fingerprint if file is new or
+        changed, None if file is unchanged or can not be processed.
     """
-    from parse import get_parser
-    from config import PARSED_ASSET_DATA_DIR
-
-    if ignore_file(file_path):
-        logging.info(f'{file_path}: ignore')
-        return
-
-    logging.info(f'{file_path}: process new file')
-
-    parser = get_parser()
-
-    vector_db = get_vector_db()
     sql_db = get_rational_db()
 
-    logging.info(f'{file_path}: begin processing')
+    file_name = get_document_name(file_path)
+    try:
+        fingerprint = get_file_fingerprint(os.stat(file_path))
+    except Exception as e:
+        logging_exception(e)
+        return None
+
+    # get document record
+    document_record = sql_db.get_document(name=file_name)
+    stored_content_hash = None
+    stored_fingerprint = None
+    if document_record is not None:
+        stored_content_hash = document_record['content_hash']
+        stored_fingerprint = document_record.get('fingerprint')
+    if stored_fingerprint == fingerprint:
+        logging.info(
+            f'{file_path}: fingerprint ({fingerprint}) unchanged, ignore')
+        return None
 
-    # check if file content is changed
-    file_name = os.path.basename(file_path)
-    file_bytes = None
     try:
-        with open(file_path, 'rb') as f:
-            file_bytes = f.read()
+        with open_mmap(file_path) as buf:
+            file_size = len(buf)
+            file_content_hash = get_hash64(buf)
     except Exception as e:
         logging_exception(e)
-        return
+        return None
 
-    if len(file_bytes) == 0:
+    if file_size == 0:
         logging.info(f'{file_path}: empty content, skip')
-        return
+        return None
 
-    file_content_hash = get_hash64(file_bytes)
     logging.info(
-        f'{file_path}: total {len(file_bytes)} bytes loaded, content hash: {file_content_hash}'
+        f'{file_path}: total {file_size} bytes mapped, content hash: {file_content_hash}'
     )
 
-    # get document record
-    document_record = sql_db.get_document(name=file_name)
-    stored_content_hash = None
-    if document_record is not None:
-        stored_content_hash = document_record['content_hash']
     if stored_content_hash == file_content_hash:
         logging.info(
             f'{file_path}: content hash ({file_content_hash}) unchanged, ignore'
         )
-        return
+        # only stat changed, i.e., touched or copied over, save fingerprint so
+        # that next check can skip hashing.
+        sql_db.insert_document({'name': file_name, 'fingerprint': fingerprint})
+        return None
     logging.info(f'{file_path}: file content chnaged or new file')
 
-    # delete document record if any
-    process_delete_file(file_path=file_path)
+    return file_content_hash, fingerprint
+
+
+def parse_file(file_path: str,
+               content_hash: str = None,
+               file_name: str = None) -> list[Chunk]:
+    """
+    Parse file into chunks. Module level function so that it can be run in a
+    worker process.
+
+    Args:
+    - file_path: path to the file.
+    - content_hash: file content hash if already computed, so that parser needs
+        not to hash the file again.
+    - file_name: document name chunks are keyed by, default to
+        `get_document_name(file_path)`.
+    """
+    from parse import get_file_parser
+    from config import PARSED_ASSET_DATA_DIR
 
-    # parse file
+    parser = get_file_parser(file_path)
     chunks = parser.parse(
         file_path=file_path,
         asset_save_dir=PARSED_ASSET_DATA_DIR,
+        content_hash=content_hash,
     )
     logging.info(f'{file_path}: total {len(chunks)} chunks')
-    if len(chunks) == 0:
-        return
+    return list(
+        rename_chunks(chunks, file_name or get_document_name(file_path)))
 
-    # save parsed chunks into vector db
-    failed_chunks = []
-    success_chunks = {}
+
+def parse_file_iter(file_path: str,
+                    content_hash: str = None,
+                    file_name: str = None) -> Iterator[Chunk]:
+    """
+    Same as `parse_file`, yield chunks as the parser produces them.
+    """
+    from parse import get_file_parser
+    from config import PARSED_ASSET_DATA_DIR
+
+    parser = get_file_parser(file_path)
+    yield from rename_chunks(
+        parser.parse_iter(
+            file_path=file_path,
+            asset_save_dir=PARSED_ASSET_DATA_DIR,
+            content_hash=content_hash,
+        ), file_name or get_document_name(file_path))
+
+
+def rename_chunks(chunks: Iterator[Chunk], file_name: str) -> Iterator[Chunk]:
+    """
+    Parsers name chunks by file base name, chunks of a file in sub directory
+    are renamed to its document name, see `get_document_name`.
+    """
     for chunk in chunks:
-        try:
-            insert_cnt = vector_db.insert(chunk)
-            if insert_cnt == 1:
-                success_chunks[chunk.uuid] = True
-            else:
-                failed_chunks.append(chunk)
+        if chunk.file_name != file_name:
+            chunk = Chunk(
+                content_type=chunk.content_type,
+                file_name=file_name,
+                content=chunk.content,
+                extra_description=chunk.extra_description,
+                content_url=chunk.content_url,
+            )
+        yield chunk
+
+
+def get_stored_chunk_uuids(file_path: str) -> set[str]:
+    """
+    Returns:
+    - Set of chunk uuids in stored document record, empty if no record.
+    """
+    sql_db = get_rational_db()
 
-        except Exception as e:
-            logging_exception(e)
+    document_record = sql_db.get_document(name=get_document_name(file_path))
+    if document_record is None or len(document_record['chunks']) == 0:
+        return set()
+    return set(document_record['chunks'].split('\x07'))
+
+
+def save_document(
+    file_path: str,
+    content_hash: str,
+    fingerprint: str,
+    chunks: list[Chunk],
+    inserted: list[bool],
+    removed: list[str] = None,
+) -> list[str]:
+    """
+    Retry chunks failed to insert into vector db and save document record.
+    Chunks no longer in the document are deleted after the record is saved.
+
+    Args:
+    - file_path: path to the file.
+    - content_hash: file content hash.
+    - fingerprint: file stat fingerprint, see `utils.get_file_fingerprint`.
+    - chunks: all parsed chunks.
+    - inserted: list of bool aligned with `chunks`, true if the chunk is already
+        inserted into vector db.
+    - removed: uuids of previously stored chunks not found in `chunks`.
+
+    Returns:
+    - A list containing all successfuly inserted chunks' uuid, the order is aligned
+        with the chunks' original order in source file.
+    """
+    vector_db = get_vector_db()
+    sql_db = get_rational_db()
+
+    success_chunks = {}
+    failed_chunks = []
+    for chunk, success in zip(chunks, inserted):
+        if success:
+            success_chunks[chunk.uuid] = True
+        else:
             failed_chunks.append(chunk)
 
-    for chunk in failed_chunks:
-        try:
-            insert_cnt = vector_db.insert(chunk)
-            if insert_cnt == 1:
+    if len(failed_chunks) > 0:
+        logging.info(
+            f'{file_path}: fail to insert {len(failed_chunks)} chunks, retrying...'
+        )
+        inserted = vector_db.insert_many(failed_chunks)
+        for chunk, success in zip(failed_chunks, inserted):
+            if success:
                 success_chunks[chunk.uuid] = True
-        except Exception as e:
-            logging_exception(e)
 
     logging.info(
         f'successfully insert {len(success_chunks)} records into vector db')
@@ -117,16 +206,31 @@ def process_new_file(file_path: str) -> Dict[str, bool]:
 
     # save document record
     document_record = {
-        'name': os.path.basename(file_path),
+        'name': get_document_name(file_path),
         'chunks': '\x07'.join(saved_chunks),
         'created_date': now_in_utc(),
-        'content_hash': get_hash64(file_bytes),
+        'content_hash': content_hash,
+        'fingerprint': fingerprint,
     }
     insert_cnt = sql_db.insert_document(document_record)
     if insert_cnt < 1:
         logging.info(f'{file_path}: fail to insert document, retrying...')
         sql_db.insert_document(document_record)
 
+    asset_store = get_asset_store()
+    asset_store.add_refs({
+        chunk.uuid: chunk.content_url
+        for chunk in chunks if chunk.content_type == config.ChunkType.IMAGE
+        and chunk.uuid in success_chunks
+    })
+
+    if removed:
+        delete_cnt = vector_db.delete(keys=removed)
+        logging.info(f'{file_path}: delete {delete_cnt} removed chunks')
+        asset_store.release(removed)
+    # also reclaims assets put by failed or superseded jobs
+    asset_store.gc()
+
     return saved_chunks
 
 
@@ -145,7 +249,7 @@ def process_delete_file(file_path: str):
     vector_db = get_vector_db()
     sql_db = get_rational_db()
 
-    file_name = os.path.basename(file_path)
+    file_name = get_document_name(file_path)
 
     # get document record
     document_record = sql_db.get_document(name=file_name)
@@ -167,6 +271,133 @@ def process_delete_file(file_path: str):
     delete_cnt = vector_db.delete(keys=uuids)
     logging.info(f'delete {delete_cnt} chunks from vector db')
 
+    # delete assets no longer referenced
+    asset_store = get_asset_store()
+    asset_store.release(uuids)
+    asset_store.gc()
+
+
+def process_move_file(src_path: str, dest_path: str) -> bool:
+    """
+    Move document record and chunks of a renamed / moved file to its new name,
+    the file is neither parsed nor embedded again. `dest_path` is taken as
+    `src_path` moved if its fingerprint is the stored one, i.e., renamed on the
+    same file system, or else its content hash is the stored one.
+
+    Args:
+    - src_path: path the file is moved from.
+    - dest_path: path the file is moved to.
+
+    Returns:
+    - bool, false if `dest_path` is not `src_path` moved or the move fails,
+        caller should delete `src_path` and process `dest_path` as a new file.
+    """
+    if ignore_file(src_path) or ignore_file(dest_path):
+        return False
+    logging.info(f'{src_path}: process move file to {dest_path}')
+
+    vector_db = get_vector_db()
+    sql_db = get_rational_db()
+
+    src_name = get_document_name(src_path)
+    dest_name = get_document_name(dest_path)
+    document_record = sql_db.get_document(name=src_name)
+    if document_record is None:
+        logging.info(f'{src_path}: document record not found')
+        return False
+
+    try:
+        fingerprint = get_file_fingerprint(os.stat(dest_path))
+        if fingerprint != document_record.get('fingerprint'):
+            with open_mmap(dest_path) as buf:
+                content_hash = get_hash64(buf)
+            if content_hash != document_record['content_hash']:
+                logging.info(f'{dest_path}: content changed, not a move')
+                return False
+    except Exception as e:
+        logging_exception(e)
+        return False
+
+    if src_name == dest_name:
+        # moved outside of file directory, records are keyed by file name
+        sql_db.insert_document({'name': dest_name, 'fingerprint': fingerprint})
+        return True
+
+    # an indexed file is replaced
+    if sql_db.get_document(name=dest_name) is not None:
+        process_delete_file(file_path=dest_path)
+
+    # chunk uuids are derived from document name, copy chunks to new uuids, then
+    # switch document record to them and delete old chunks.
+    uuids = []
+    if len(document_record['chunks']) > 0:
+        uuids = document_record['chunks'].split('\x07')
+    new_uuids = vector_db.rekey_records(keys=uuids, file_name=dest_name)
+    if None in new_uuids:
+        logging.info(
+            f'{src_path}: fail to rekey {new_uuids.count(None)} chunks')
+        vector_db.delete(keys=[k for k in new_uuids if k is not None])
+        return False
+
+    update_cnt = sql_db.rename_document(name=src_name,
+                                        data={
+                                            'name': dest_name,
+                                            'chunks': '\x07'.join(new_uuids),
+                                            'fingerprint': fingerprint,
+                                        })
+    if update_cnt < 1:
+        logging.info(f'{src_path}: fail to rename document record')
+        vector_db.delete(keys=new_uuids)
+        return False
+
+    get_asset_store().rekey_refs(dict(zip(uuids, new_uuids)))
+    delete_cnt = vector_db.delete(keys=uuids)
+    logging.info(
+        f'{dest_path}: {len(new_uuids)} chunks moved from {src_name}, delete {delete_cnt} old chunks'
+    )
+    return True
+
+
+def get_document_name(file_path: str) -> str:
+    """
+    Name of the document record of a file, chunks are keyed by it as well.
+    Files under `RAG_FILE_DIR` are named by relative path with `/` separator,
+    so that same named files in different directories do not collide, files
+    directly under it keep their file name. Files elsewhere are named by file
+    name.
+    """
+    rel_path = _relative_path(file_path)
+    if rel_path is None:
+        return os.path.basename(file_path)
+    return rel_path
+
+
+def _relative_path(file_path: str) -> Union[str, None]:
+    """
+    Returns:
+    - Path relative to `RAG_FILE_DIR` with `/` separator, None if not under it.
+    """
+    rel_path = os.path.relpath(os.path.abspath(file_path),
+                               os.path.abspath(config.RAG_FILE_DIR))
+    if rel_path in [os.curdir, os.pardir] or rel_path.startswith(os.pardir +
+                                                                 os.sep):
+        return None
+    return rel_path.replace(os.sep, '/')
+
+
+def get_document_paths(dir_path: str) -> list[str]:
+    """
+    Returns:
+    - Paths of documents stored under directory `dir_path` of `RAG_FILE_DIR`.
+    """
+    dir_name = _relative_path(dir_path)
+    if dir_name is None:
+        return []
+    names = get_rational_db().get_document_names(prefix=f'{dir_name}/')
+    return [
+        os.path.join(config.RAG_FILE_DIR, *name.split('/')) for name in names
+    ]
+
 
 def ignore_file(file_path: str):
     """
@@ -181,91 +412,218 @@ def ignore_file(file_path: str):
         return True
 
     # ignore non-supported file postfix
-    postifx = file_name.split('.')[-1]
-    if postifx not in ['pdf', 'docx', 'ppt', 'md', 'txt']:
+    postifx = file_name.split('.')[-1].lower()
+    if postifx not in [t.value for t in SupportedFileType]:
         return True
 
-    return False
-
-
-_job_executor = None
-
+    # ignore file in hidden directory
+    dir_names = get_document_name(file_path).split('/')[:-1]
+    if any(d.startswith('.') for d in dir_names):
+        return True
 
-def get_job_executor():
-    global _job_executor
-    if _job_executor is None:
-        # NOTE: set only 1 thread to force sequencial job schedule.
-        _job_executor = ThreadPoolExecutor(max_workers=1)
+    return False
 
-    return _job_executor
 
+def ignore_dir(dir_path: str):
+    """
+    Rules on ignore directory when scanning file directory recursively.
 
-def on_process_new_file(file_path: str):
-    try:
-        process_new_file(file_path=file_path)
-    except Exception as e:
-        logging_exception(e)
+    Returns:
+    - bool, true if dir_path and its sub directories should be ignored.
+    """
+    # ignore hidden directory
+    if os.path.basename(dir_path).startswith('.'):
+        return True
 
+    # ignore parsed assets saved in file directory
+    if os.path.abspath(dir_path) == os.path.abspath(
+            config.PARSED_ASSET_DATA_DIR):
+        return True
 
-def on_process_delete_file(file_path: str):
-    try:
-        process_delete_file(file_path=file_path)
-    except Exception as e:
-        logging_exception(e)
+    return False
 
 
 class FileHandler(FileSystemEventHandler):
 
     def on_any_event(self, event: FileSystemEvent) -> None:
+        from .pipeline import get_path_debouncer, JobType
 
-        job_executor = get_job_executor()
+        pipeline = get_path_debouncer()
         src_path = event.src_path
         dest_path = event.dest_path
 
         if event.event_type == events.EVENT_TYPE_MOVED:
-            if not os.path.isdir(src_path):
-                job_executor.submit(on_process_delete_file, file_path=src_path)
-
-            if not os.path.isdir(dest_path):
-                job_executor.submit(on_process_new_file, file_path=src_path)
+            if os.path.isdir(dest_path):
+                pass
+            elif ignore_file(dest_path):
+                pipeline.submit(JobType.DELETE, file_path=src_path)
+            else:
+                pipeline.submit(JobType.MOVE,
+                                file_path=dest_path,
+                                src_path=src_path)
 
         elif event.event_type == events.EVENT_TYPE_DELETED:
-            if not os.path.isdir(src_path):
-                job_executor.submit(on_process_delete_file, file_path=src_path)
+            if event.is_directory:
+                # files of a directory moved out of file directory are not
+                # reported one by one, delete documents under it.
+                for file_path in get_document_paths(src_path):
+                    pipeline.submit(JobType.DELETE, file_path=file_path)
+            elif not os.path.isdir(src_path):
+                pipeline.submit(JobType.DELETE, file_path=src_path)
 
         elif event.event_type == events.EVENT_TYPE_CREATED:
             if not os.path.isdir(src_path):
-                job_executor.submit(on_process_new_file, file_path=src_path)
+                pipeline.submit(JobType.NEW, file_path=src_path)
 
         elif event.event_type == events.EVENT_TYPE_MODIFIED:
             if not os.path.isdir(src_path):
-                job_executor.submit(on_process_new_file, file_path=src_path)
+                pipeline.submit(JobType.NEW, file_path=src_path)
 
         else:
             pass
 
 
+def scan_file_dir(file_dir: str,
+                  max_workers: int = 1) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Scan `file_dir` recursively, sub directories are scanned in parallel.
+    Ignored files and directories are skipped.
+
+    Args:
+    - file_dir: root directory.
+    - max_workers: number of threads scanning directories.
+
+    Returns:
+    - An iterator of file path and its stat, stat is None if it fails.
+    """
+
+    def _scan(dir_path: str) -> Tuple[list, list[str]]:
+        files = []
+        sub_dirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not ignore_dir(entry.path):
+                            sub_dirs.append(entry.path)
+                        continue
+                    if not entry.is_file() or ignore_file(entry.path):
+                        continue
+                    try:
+                        files.append((entry.path, entry.stat()))
+                    except OSError as e:
+                        logging_exception(e)
+                        files.append((entry.path, None))
+        except OSError as e:
+            logging_exception(e)
+        return files, sub_dirs
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_scan, file_dir)}
+        while len(futures) > 0:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, sub_dirs = future.result()
+                futures.update(executor.submit(_scan, d) for d in sub_dirs)
+                yield from files
+
+
+def reconcile_file_dir(file_dir: str) -> Tuple[list[str], list[str]]:
+    """
+    Diff files in `file_dir` and its sub directories against stored document
+    records.
+    Steps:
+    - scan directory tree, compare each file's stat fingerprint with stored
+        one, see `scan_file_dir`.
+    - hash fingerprint-changed candidates in a thread pool, files whose content
+        hash is unchanged only get their fingerprint refreshed.
+    - documents not found in directory are to be deleted.
+
+    Returns:
+    - A list of file paths to process.
+    - A list of file paths to delete.
+    """
+    from config import STARTUP_HASH_WORKERS
+
+    sql_db = get_rational_db()
+
+    begin = time.time()
+    document_states = sql_db.get_all_document_states()
+
+    # document name -> file path
+    candidates = {}
+    file_names = set()
+    for file_path, st in scan_file_dir(file_dir,
+                                       max_workers=STARTUP_HASH_WORKERS):
+        file_name = get_document_name(file_path)
+        file_names.add(file_name)
+        if st is None:
+            continue
+        fingerprint = get_file_fingerprint(st)
+        state = document_states.get(file_name)
+        if state is not None and state['fingerprint'] == fingerprint:
+            continue
+        candidates[file_name] = (file_path, fingerprint)
+    scan_time = time.time() - begin
+    logging.info(
+        f'{file_dir}: scan {len(file_names)} files in {scan_time:.3f}s, {len(candidates)} fingerprint changed'
+    )
+
+    def _hash(file_name: str) -> Union[str, None]:
+        try:
+            return get_file_hash64(candidates[file_name][0])
+        except Exception as e:
+            logging_exception(e)
+            return None
+
+    to_process = []
+    refreshed = {}
+    hash_candidates = [n for n in candidates if n in document_states]
+    with ThreadPoolExecutor(max_workers=STARTUP_HASH_WORKERS) as executor:
+        hashes = executor.map(_hash, hash_candidates)
+        for file_name, content_hash in zip(hash_candidates, hashes):
+            if content_hash is not None and \
+                    content_hash == document_states[file_name]['content_hash']:
+                refreshed[file_name] = candidates[file_name][1]
+            else:
+                to_process.append(candidates[file_name][0])
+    # new files, no need to hash
+    to_process.extend(
+        [p for n, (p, _) in candidates.items() if n not in document_states])
+    if len(refreshed) > 0:
+        sql_db.update_fingerprints(refreshed)
+    logging.info(
+        f'{file_dir}: hash {len(hash_candidates)} files in {time.time() - begin - scan_time:.3f}s, {len(refreshed)} content unchanged'
+    )
+
+    to_delete = [
+        os.path.join(file_dir, *n.split('/')) for n in document_states
+        if n not in file_names
+    ]
+    return to_process, to_delete
+
+
 @run_once
 def initial_file_process(file_dir: str):
     """
-    Submit initial file content check.
+    Reconcile file directory with stored documents and submit jobs for changed
+    and deleted files.
     """
-    job_executor = get_job_executor()
-    sql_db = get_rational_db()
+    from .pipeline import get_ingestion_pipeline, JobType
 
-    # get all documents
-    all_documents = sql_db.get_all_documents()
-    file_names = os.listdir(file_dir)
+    begin = time.time()
+    pipeline = get_ingestion_pipeline()
+    to_process, to_delete = reconcile_file_dir(file_dir)
 
-    # delete documents that are not found in file_dir
-    to_delete = list(set(all_documents) - set(file_names))
     logging.info(
         f"Below files are founded in db but not in file folder, delete: {to_delete}"
     )
-    for file_name in to_delete:
-        job_executor.submit(on_process_delete_file,
-                            file_path=os.path.join(file_dir, file_name))
+    for file_path in to_delete:
+        pipeline.submit(JobType.DELETE, file_path=file_path)
 
-    for file_name in file_names:
-        job_executor.submit(on_process_new_file,
-                            file_path=os.path.join(file_dir, file_name))
+    logging.info(f'{file_dir}: {len(to_process)} new or changed files')
+    for file_path in to_process:
+        pipeline.submit(JobType.NEW, file_path=file_path)
+
+    logging.info(
+        f'{file_dir}: initial file process done in {time.time() - begin:.3f}s')
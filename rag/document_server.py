@@ -0,0 +1,164 @@
+import os
+import logging
+import tempfile
+
+from flask import (
+    request,
+    Blueprint,
+    jsonify,
+)
+from werkzeug.formparser import parse_form_data
+
+import config
+from .document import ignore_file, get_document_name
+from .pipeline import JobType, get_ingestion_pipeline, get_path_debouncer
+
+bp = Blueprint('documents', __name__, url_prefix='/')
+
+
+def _response(data: dict = None, code: int = 0, message: str = ''):
+    status = 200 if code == 0 else code
+    return jsonify({
+        'code': code,
+        'message': message,
+        'data': data or {},
+    }), status
+
+
+def upload_path(file_name: str, dir_name: str = '') -> str:
+    """
+    Path in `RAG_FILE_DIR` an uploaded file is saved to. Path components are
+    split by `/` or `\\`, `.` and `..` are dropped so that uploads never escape
+    `RAG_FILE_DIR`.
+
+    Args:
+    - file_name: uploaded file name, may be a relative path, e.g., `a/b.pdf`.
+    - dir_name: directory relative to `RAG_FILE_DIR` to save into.
+
+    Returns:
+    - A file path, None if the file name is invalid.
+    """
+    names = []
+    for name in f'{dir_name}/{file_name}'.replace('\\', '/').split('/'):
+        name = name.strip().replace('\x00', '')
+        if name not in ['', os.curdir, os.pardir]:
+            names.append(name)
+    base_name = file_name.replace('\\', '/').split('/')[-1].strip()
+    if len(names) == 0 or names[-1] != base_name:
+        return None
+    return os.path.join(config.RAG_FILE_DIR, *names)
+
+
+@bp.route('/documents', methods=['POST'])
+def upload_documents():
+    """
+    Upload documents and submit them for ingestion at once, without waiting for
+    file events.
+
+    Input multipart form:
+    - `files`: one or more files, file name may be a relative path, e.g.,
+        `papers/a.pdf`, to save into sub directory.
+    - `dir`: optional, directory relative to `RAG_FILE_DIR` to save into.
+
+    Uploads are streamed into hidden temporary files in `RAG_FILE_DIR`, which
+    are ignored by watchers, and renamed into place once complete.
+
+    Output json:
+    - `code`: 0 for success.
+    - `message`: error message if any.
+    - `data`:
+        - `jobs`: list of `file_name`, `job_id` of submitted files, see
+            `GET /documents/jobs/<job_id>`.
+        - `errors`: list of `file_name`, `message` of rejected files.
+    """
+    os.makedirs(config.RAG_FILE_DIR, exist_ok=True)
+    temp_paths = []
+
+    def _stream_factory(total_content_length,
+                        content_type,
+                        filename,
+                        content_length=None):
+        f = tempfile.NamedTemporaryFile(dir=config.RAG_FILE_DIR,
+                                        prefix='.upload-',
+                                        suffix='.tmp',
+                                        delete=False)
+        temp_paths.append(f.name)
+        return f
+
+    pipeline = get_ingestion_pipeline()
+    debouncer = get_path_debouncer()
+    jobs = []
+    errors = []
+    try:
+        _, form, files = parse_form_data(request.environ,
+                                         stream_factory=_stream_factory)
+        uploads = files.getlist('files')
+        if len(uploads) == 0:
+            return _response(code=400, message='no file uploaded')
+
+        for upload in uploads:
+            file_path = upload_path(upload.filename or '',
+                                    form.get('dir', ''))
+            if file_path is None or ignore_file(file_path):
+                errors.append({
+                    'file_name': upload.filename,
+                    'message': 'invalid or not supported file name',
+                })
+                continue
+
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            upload.stream.close()
+            os.replace(upload.stream.name, file_path)
+            # events of the renamed file are dropped by debouncer
+            debouncer.expect(file_path)
+            job_id = pipeline.submit(JobType.NEW, file_path=file_path)
+            jobs.append({
+                'file_name': get_document_name(file_path),
+                'job_id': job_id,
+            })
+    finally:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    logging.info(
+        f'upload {len(jobs)} documents, reject {len(errors)} documents')
+    return _response({'jobs': jobs, 'errors': errors})
+
+
+@bp.route('/documents/jobs/<int:job_id>', methods=['GET'])
+def get_document_job(job_id: int):
+    """
+    Output json:
+    - `code`: 0 for success, 404 if job is unknown.
+    - `message`: error message if any.
+    - `data`: job status, see `IngestionPipeline.get_job_status`.
+    """
+    status = get_ingestion_pipeline().get_job_status(job_id)
+    if status is None:
+        return _response(code=404, message=f'job {job_id} not found')
+    return _response(status)
+
+
+@bp.route('/documents/jobs', methods=['GET'])
+def get_document_jobs():
+    """
+    Input query:
+    - `ids`: comma separated job ids.
+
+    Output json:
+    - `code`: 0 for success.
+    - `message`: error message if any.
+    - `data`:
+        - `jobs`: list of job status, None for unknown jobs, aligned with
+            `ids`.
+    """
+    try:
+        job_ids = [
+            int(i) for i in request.args.get('ids', '').split(',') if i.strip()
+        ]
+    except ValueError:
+        return _response(code=400, message='invalid job ids')
+
+    pipeline = get_ingestion_pipeline()
+    return _response({'jobs': [pipeline.get_job_status(i) for i in job_ids]})
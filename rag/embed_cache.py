@@ -0,0 +1,278 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+import numpy as np
+from typing import Dict, Any, Tuple, Union
+from scipy.sparse import csr_array
+
+import config
+from utils import get_hash64
+from .nlp import EmbeddingModel
+
+
+class EmbeddingCache:
+    """
+    Persistent content addressed embedding cache of one embedding model.
+
+    Dense vectors are stored in a fixed size memory mapped float32 array, one
+    row per cached text. Sparse vectors are stored as packed (indices, values)
+    blobs in a SQLite index table, which also maps text hash to dense row and
+    tracks last used time. Once all rows are taken, least recently used entries
+    are evicted.
+
+    Evictions are committed before their rows are reused, and each entry keeps
+    a checksum of its dense row, so that an entry never returns a row written
+    for another text, even if the process crashes halfway through a write.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Args:
+        - cache_dir: directory for cache files, one directory per model.
+        - max_bytes: size limit of dense vector file, which determines the max
+            number of cached entries.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'index.db'),
+                                    check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entry (
+                key TEXT PRIMARY KEY,
+                slot INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                sparse BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self.conn.commit()
+
+        self.dense = None
+        self.meta = dict(self.conn.execute("SELECT name, value FROM meta"))
+        if 'dense_dim' in self.meta:
+            self._open_dense(self.meta['dense_dim'])
+
+    def _open_dense(self, dense_dim: int):
+        capacity = max(1, self.max_bytes // (dense_dim * 4))
+        dense_path = os.path.join(self.cache_dir, 'dense.f32')
+        if self.meta.get('capacity') != capacity and os.path.exists(dense_path):
+            # size limit changed, start over
+            logging.info(
+                f'{self.cache_dir}: cache capacity changed to {capacity}, reset')
+            self.conn.execute("DELETE FROM entry")
+            self.conn.execute("DELETE FROM meta WHERE name = 'next_slot'")
+            os.remove(dense_path)
+
+        mode = 'r+' if os.path.exists(dense_path) else 'w+'
+        self.dense = np.memmap(dense_path,
+                               dtype=np.float32,
+                               mode=mode,
+                               shape=(capacity, dense_dim))
+        self._set_meta('dense_dim', dense_dim)
+        self._set_meta('capacity', capacity)
+        self.conn.commit()
+
+    def _set_meta(self, name: str, value: int):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+            (name, value))
+        self.meta[name] = value
+
+    def get_many(
+        self,
+        keys: list[str],
+    ) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Returns:
+        - A dict of cached entries, key is the text hash, value is a tuple of
+            dense vector, sparse indices and sparse values.
+        """
+        if self.dense is None or len(keys) == 0:
+            return {}
+
+        ret = {}
+        with self.lock:
+            placeholders = ', '.join(['?'] * len(keys))
+            rows = self.conn.execute(
+                f"SELECT key, slot, checksum, sparse FROM entry WHERE key IN ({placeholders})",
+                list(keys)).fetchall()
+            corrupted = []
+            for key, slot, checksum, sparse in rows:
+                dense = np.array(self.dense[slot])
+                if get_hash64(dense.tobytes()) != checksum:
+                    # row overwritten by an interrupted write
+                    corrupted.append(key)
+                    continue
+                sparse = np.frombuffer(sparse, dtype=np.uint32)
+                n = len(sparse) // 2
+                ret[key] = (
+                    dense,
+                    sparse[:n].astype(np.int64),
+                    sparse[n:].view(np.float32),
+                )
+            if len(corrupted) > 0:
+                logging.info(
+                    f'{self.cache_dir}: drop {len(corrupted)} corrupted entries'
+                )
+                self.conn.executemany("DELETE FROM entry WHERE key = ?",
+                                      [(key, ) for key in corrupted])
+            self.conn.executemany(
+                "UPDATE entry SET last_used = ? WHERE key = ?",
+                [(time.time(), key) for key in ret])
+            self.conn.commit()
+        return ret
+
+    def put_many(
+        self,
+        entries: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]],
+        sparse_dim: int,
+    ):
+        """
+        Args:
+        - entries: dict of text hash to tuple of dense vector, sparse indices
+            and sparse values.
+        - sparse_dim: sparse vector dimension.
+        """
+        if len(entries) == 0:
+            return
+
+        with self.lock:
+            if self.dense is None:
+                dense_dim = len(next(iter(entries.values()))[0])
+                self._open_dense(dense_dim)
+            self._set_meta('sparse_dim', sparse_dim)
+
+            existing = set(r[0] for r in self.conn.execute(
+                f"SELECT key FROM entry WHERE key IN ({', '.join(['?'] * len(entries))})",
+                list(entries)))
+            keys = [k for k in entries if k not in existing]
+            keys = keys[:len(self.dense)]
+            slots = self._alloc_slots(len(keys))
+
+            rows = []
+            now = time.time()
+            for key, slot in zip(keys, slots):
+                dense, indices, values = entries[key]
+                self.dense[slot] = dense
+                sparse = np.concatenate([
+                    np.asarray(indices, dtype=np.uint32),
+                    np.asarray(values, dtype=np.float32).view(np.uint32),
+                ])
+                rows.append((key, slot, get_hash64(self.dense[slot].tobytes()),
+                             sparse.tobytes(), now))
+            self.dense.flush()
+            self.conn.executemany(
+                "INSERT INTO entry (key, slot, checksum, sparse, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows)
+            self.conn.commit()
+
+    def _alloc_slots(self, n: int) -> list[int]:
+        """
+        Allocate unused dense rows, evict least recently used entries if there
+        are not enough unused rows. The allocation is committed before the rows
+        are written, so that a crash never leaves an entry on a reused row.
+        """
+        capacity = len(self.dense)
+        next_slot = self.meta.get('next_slot', 0)
+        slots = list(range(next_slot, min(capacity, next_slot + n)))
+        self._set_meta('next_slot', next_slot + len(slots))
+
+        evict_num = n - len(slots)
+        if evict_num > 0:
+            evicted = self.conn.execute(
+                "SELECT key, slot FROM entry ORDER BY last_used LIMIT ?",
+                (evict_num, )).fetchall()
+            self.conn.executemany("DELETE FROM entry WHERE key = ?",
+                                  [(r[0], ) for r in evicted])
+            logging.info(f'{self.cache_dir}: evict {len(evicted)} entries')
+            slots.extend([r[1] for r in evicted])
+        self.conn.commit()
+        return slots
+
+
+_embed_caches = {}
+_embed_caches_lock = threading.Lock()
+
+
+def get_embed_cache(model_name: str) -> Union[EmbeddingCache, None]:
+    """
+    Returns:
+    - Embedding cache of the model, None if cache is disabled.
+    """
+    if config.EMBED_CACHE_MAX_MB <= 0:
+        return None
+    with _embed_caches_lock:
+        if model_name not in _embed_caches:
+            _embed_caches[model_name] = EmbeddingCache(
+                cache_dir=os.path.join(config.EMBED_CACHE_DIR, model_name),
+                max_bytes=config.EMBED_CACHE_MAX_MB * 1024 * 1024,
+            )
+    return _embed_caches[model_name]
+
+
+def cached_encode(
+    embed_model: EmbeddingModel,
+    model_name: str,
+    texts: list[str],
+) -> Dict[str, Any]:
+    """
+    Same as `embed_model.encode` but only texts not found in embedding cache
+    are encoded by the model.
+
+    Returns:
+    - Encoded vector dict with `dense` and `sparse`.
+    """
+    cache = get_embed_cache(model_name)
+    if cache is None or len(texts) == 0:
+        return embed_model.encode(texts)
+
+    keys = [get_hash64(text.encode('utf-8')) for text in texts]
+    entries = cache.get_many(list(set(keys)))
+
+    # encode missing texts, duplicated texts are encoded once
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in entries and key not in missing:
+            missing[key] = text
+    sparse_dim = cache.meta.get('sparse_dim')
+    if len(missing) > 0:
+        output = embed_model.encode(list(missing.values()))
+        sparse = csr_array(output['sparse'])
+        sparse_dim = sparse.shape[1]
+        new_entries = {}
+        for i, key in enumerate(missing):
+            start, end = sparse.indptr[i], sparse.indptr[i + 1]
+            new_entries[key] = (
+                np.asarray(output['dense'][i], dtype=np.float32),
+                sparse.indices[start:end],
+                sparse.data[start:end],
+            )
+        cache.put_many(new_entries, sparse_dim=sparse_dim)
+        entries.update(new_entries)
+    logging.info(
+        f'embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses'
+    )
+
+    dense = [entries[key][0] for key in keys]
+    rows, cols, values = [], [], []
+    for i, key in enumerate(keys):
+        _, indices, data = entries[key]
+        rows.append(np.full(len(indices), i))
+        cols.append(indices)
+        values.append(np.asarray(data, dtype=np.float32))
+    sparse = csr_array(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(texts), sparse_dim),
+    )
+    return {
+        'dense': dense,
+        'sparse': sparse,
+    }
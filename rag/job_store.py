@@ -0,0 +1,261 @@
+import os
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Union
+from strenum import StrEnum
+
+import config
+from utils import now_in_utc, logging_exception
+from parse.parser import Chunk, write_chunks, read_chunks
+
+
+class JobState(StrEnum):
+    # submitted, not parsed yet
+    PENDING = "pending"
+    # chunks saved in checkpoint file
+    PARSED = "parsed"
+    # chunks embedded, embeddings are kept by embed cache
+    EMBEDDED = "embedded"
+    # failed, kept for inspection and its checkpoint for retry
+    FAILED = "failed"
+
+
+class JobStore:
+    """
+    Persistent ingestion jobs, so that jobs survive restarts and a restarted
+    job resumes from its last checkpoint instead of parsing the file again.
+
+    A job row is created on submit and deleted once the job is committed, i.e.,
+    document record is saved. Parsed chunks are checkpointed into
+    `{checkpoint_dir}/{job_id}.chunks`, a checkpoint is found by file path and
+    content hash, so it is reused by any later job of the same file content.
+
+    Uuids of chunks a job writes into vector db are recorded before they are
+    written, so that chunks of an interrupted job not resumed, e.g., its file
+    has changed since, are found and deleted, see `add_written`.
+    """
+
+    def __init__(self, db_path: str, checkpoint_dir: str):
+        self.db_path = db_path
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS ingest_job ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'job_type TEXT NOT NULL, '
+                           'file_path TEXT NOT NULL, '
+                           'src_path TEXT, '
+                           'state TEXT NOT NULL, '
+                           'attempts INTEGER NOT NULL DEFAULT 0, '
+                           'content_hash TEXT, '
+                           'fingerprint TEXT, '
+                           'checkpoint TEXT, '
+                           'error TEXT, '
+                           'created_date TEXT NOT NULL, '
+                           'updated_date TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ingest_job_file_path '
+                           'ON ingest_job (file_path)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS ingest_job_chunk ('
+                           'job_id INTEGER NOT NULL, '
+                           'uuid TEXT NOT NULL, '
+                           'PRIMARY KEY (job_id, uuid))')
+        self._conn.commit()
+
+    def add(self, job_type: str, file_path: str, src_path: str = None) -> int:
+        """
+        Returns:
+        - Job id.
+        """
+        now = now_in_utc()
+        with self._lock:
+            cur = self._conn.execute(
+                'INSERT INTO ingest_job (job_type, file_path, src_path, state, '
+                'created_date, updated_date) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_type, file_path, src_path, JobState.PENDING, now, now))
+            self._conn.commit()
+        return cur.lastrowid
+
+    def start(self, job_id: int) -> int:
+        """
+        Count a run of the job.
+
+        Returns:
+        - Number of runs of the job, including this one.
+        """
+        with self._lock:
+            self._conn.execute(
+                'UPDATE ingest_job SET attempts = attempts + 1, '
+                'updated_date = ? WHERE id = ?', (now_in_utc(), job_id))
+            self._conn.commit()
+            row = self._conn.execute(
+                'SELECT attempts FROM ingest_job WHERE id = ?',
+                (job_id, )).fetchone()
+        return 0 if row is None else row['attempts']
+
+    def update(self, job_id: int, **fields):
+        """
+        Update job columns, e.g., `state`, `content_hash`.
+        """
+        fields['updated_date'] = now_in_utc()
+        columns = ', '.join(f'{k} = ?' for k in fields)
+        with self._lock:
+            self._conn.execute(
+                f'UPDATE ingest_job SET {columns} WHERE id = ?',
+                list(fields.values()) + [job_id])
+            self._conn.commit()
+
+    def fail(self, job_id: int, error: str):
+        self.update(job_id, state=JobState.FAILED, error=error)
+
+    def discard(self, job_id: int):
+        """
+        Delete a job never run, e.g., superseded by a newer job.
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM ingest_job WHERE id = ?',
+                               (job_id, ))
+            self._conn.execute('DELETE FROM ingest_job_chunk WHERE job_id = ?',
+                               (job_id, ))
+            self._conn.commit()
+
+    def add_written(self, job_id: int, uuids: list[str]):
+        """
+        Record uuids of chunks about to be written by a job.
+        """
+        if len(uuids) == 0:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO ingest_job_chunk (job_id, uuid) '
+                'VALUES (?, ?)', [(job_id, uuid) for uuid in uuids])
+            self._conn.commit()
+
+    def get_written(self, job_id: int) -> list[str]:
+        """
+        Returns:
+        - Uuids of chunks written by a job, including runs interrupted.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT uuid FROM ingest_job_chunk WHERE job_id = ?',
+                (job_id, )).fetchall()
+        return [r['uuid'] for r in rows]
+
+    def clear_written(self, job_id: int):
+        """
+        Forget chunks written by a job, once they are deleted.
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM ingest_job_chunk WHERE job_id = ?',
+                               (job_id, ))
+            self._conn.commit()
+
+    def commit(self, job_id: int, file_path: str):
+        """
+        Delete a committed job, together with earlier jobs of the same file and
+        their checkpoints, which are all obsolete.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT checkpoint FROM ingest_job '
+                'WHERE file_path = ? AND id <= ?',
+                (file_path, job_id)).fetchall()
+            self._conn.execute(
+                'DELETE FROM ingest_job_chunk WHERE job_id IN (SELECT id FROM '
+                'ingest_job WHERE file_path = ? AND id <= ?)',
+                (file_path, job_id))
+            self._conn.execute(
+                'DELETE FROM ingest_job WHERE file_path = ? AND id <= ?',
+                (file_path, job_id))
+            self._conn.commit()
+            # checkpoint may be shared with a later job of the same file
+            in_use = set(r['checkpoint'] for r in self._conn.execute(
+                'SELECT checkpoint FROM ingest_job WHERE file_path = ?',
+                (file_path, )).fetchall())
+        for checkpoint in set(r['checkpoint'] for r in rows):
+            if checkpoint is None or checkpoint in in_use:
+                continue
+            try:
+                os.remove(checkpoint)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logging_exception(e)
+
+    def get(self, job_id: int) -> Union[Dict[str, Any], None]:
+        """
+        Returns:
+        - Job row, None if not found, e.g., committed.
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM ingest_job WHERE id = ?',
+                                     (job_id, )).fetchone()
+        return None if row is None else dict(row)
+
+    def unfinished(self) -> list[Dict[str, Any]]:
+        """
+        Returns:
+        - Jobs not committed nor failed, in submission order.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM ingest_job WHERE state != ? ORDER BY id',
+                (JobState.FAILED, )).fetchall()
+        return [dict(r) for r in rows]
+
+    def save_chunks(self, job_id: int, chunks: list[Chunk]):
+        """
+        Checkpoint parsed chunks of a job, the job state becomes `PARSED`.
+        """
+        path = os.path.join(self.checkpoint_dir, f'{job_id}.chunks')
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as f:
+            write_chunks(f, chunks)
+        os.replace(temp_path, path)
+        self.update(job_id, state=JobState.PARSED, checkpoint=path)
+
+    def load_chunks(self, file_path: str,
+                    content_hash: str) -> Union[list[Chunk], None]:
+        """
+        Load checkpointed chunks of any job of the same file content.
+
+        Returns:
+        - A list of chunks, None if no checkpoint is found.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT checkpoint FROM ingest_job WHERE file_path = ? '
+                'AND content_hash = ? AND checkpoint IS NOT NULL '
+                'ORDER BY id DESC', (file_path, content_hash)).fetchall()
+        for row in rows:
+            try:
+                with open(row['checkpoint'], 'rb') as f:
+                    chunks = list(read_chunks(f))
+            except Exception as e:
+                logging_exception(e)
+                continue
+            logging.info(
+                f'{file_path}: {len(chunks)} chunks loaded from checkpoint')
+            return chunks
+        return None
+
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    global _job_store
+    with _job_store_lock:
+        if _job_store is None:
+            _job_store = JobStore(
+                db_path=config.INGEST_JOB_DB_PATH,
+                checkpoint_dir=config.INGEST_CHECKPOINT_DIR,
+            )
+        return _job_store
@@ -0,0 +1,351 @@
+import os
+import json
+import atexit
+import weakref
+import time
+import signal
+import logging
+import tempfile
+import threading
+import multiprocessing
+from typing import Callable, Iterator
+
+import config
+from utils import (now_in_utc, get_child_pids, get_process_rss,
+                   logging_exception)
+
+
+class ParseWorkerError(Exception):
+    """
+    Parse worker process crashed, timed out or exceeded the memory limit. The
+    task may succeed in a fresh worker, unlike exceptions raised by the parser.
+    """
+    pass
+
+
+# live workers, killed on exit. NOTE: workers are not daemonic so that they can
+# start shard parse processes, multiprocessing joins them on exit, which would
+# block forever on idle workers.
+_live_workers = weakref.WeakSet()
+
+
+@atexit.register
+def _kill_live_workers():
+    for worker in list(_live_workers):
+        if worker.process.is_alive():
+            worker.kill()
+
+
+def _parse_worker_main(conn, target: Callable):
+    """
+    Parse worker process main loop, run `target` on each received arguments
+    and stream the items it yields, as `(None, batch)` messages of
+    `batch_size` items followed by `(True, last batch)` or
+    `(False, error message)`.
+    """
+    # NOTE: ctrl-c is handled by the server process, which kills workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            args, batch_size = conn.recv()
+        except (EOFError, OSError):
+            # server process exited
+            return
+
+        try:
+            batch = []
+            for item in target(*args):
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    conn.send((None, batch))
+                    batch = []
+            ret = (True, batch)
+        except Exception as e:
+            logging_exception(e)
+            ret = (False, f'{type(e).__name__} - {e}')
+        conn.send(ret)
+
+
+class ParseWorker:
+    """
+    A dedicated parse subprocess, tasks are sent and results received over a
+    pipe, so that the parent can watch the task and kill the process at any
+    time.
+    """
+
+    def __init__(self, target: Callable):
+        # NOTE: spawn instead of fork, forking a process holding model threads
+        # and db connections is not safe.
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_parse_worker_main,
+            args=(child_conn, target),
+            name='parse_worker',
+        )
+        self.process.start()
+        child_conn.close()
+        self.task_num = 0
+        # seconds spent waiting for the running task
+        self._task_seconds = 0
+        _live_workers.add(self)
+
+    def run_iter(
+        self,
+        args: tuple,
+        batch_size: int,
+        timeout: float,
+        max_rss: int,
+        poll_seconds: float = 0.5,
+    ) -> Iterator[list]:
+        """
+        Run one task in the worker process, worker target is a generator whose
+        items are received in batches as they are produced. Time spent by the
+        caller on a batch is not counted in `timeout`. The worker is killed if
+        the caller stops iterating before the task is finished.
+
+        Args:
+        - args: arguments of worker target.
+        - batch_size: max number of items per batch.
+        - timeout: max seconds of the task, 0 for no limit.
+        - max_rss: max rss in bytes of the worker and its children, 0 for no
+            limit.
+        - poll_seconds: interval of checking task state.
+
+        Returns:
+        - Generator of item batches.
+
+        Raises:
+        - ParseWorkerError: worker crashed, timed out or exceeded `max_rss`. The
+            worker is killed and must not be used any more.
+        - Exception: exception raised by worker target.
+        Items received before the error are already yielded.
+        """
+        self._send(args, batch_size)
+        finished = False
+        try:
+            while True:
+                try:
+                    success, batch = self._recv(timeout, max_rss,
+                                                poll_seconds)
+                except ParseWorkerError:
+                    finished = True
+                    raise
+                if success is False:
+                    finished = True
+                    raise Exception(batch)
+                finished = success is True
+                if len(batch) > 0:
+                    yield batch
+                if finished:
+                    return
+        finally:
+            if not finished:
+                # the worker is still producing items nobody will receive
+                self.kill()
+
+    def _send(self, args: tuple, batch_size: int):
+        self.task_num += 1
+        self._task_seconds = 0
+        try:
+            self._conn.send((args, batch_size))
+        except OSError as e:
+            self.kill()
+            raise ParseWorkerError(f'worker crashed, {type(e).__name__}')
+
+    def _recv(self, timeout: float, max_rss: int, poll_seconds: float) -> tuple:
+        """
+        Wait for the next message of the running task, see `run_iter`.
+        """
+        start = time.time()
+        try:
+            while not self._conn.poll(poll_seconds):
+                if not self.process.is_alive():
+                    raise ParseWorkerError(
+                        f'worker crashed, exit code {self.process.exitcode}')
+                if timeout > 0 and \
+                        self._task_seconds + time.time() - start > timeout:
+                    raise ParseWorkerError(f'timeout after {timeout}s')
+                rss = self.rss()
+                if max_rss > 0 and rss > max_rss:
+                    raise ParseWorkerError(
+                        f'rss {rss >> 20}MB exceeds {max_rss >> 20}MB')
+            msg = self._conn.recv()
+        except (EOFError, OSError) as e:
+            self.kill()
+            raise ParseWorkerError(f'worker crashed, {type(e).__name__}')
+        except ParseWorkerError:
+            self.kill()
+            raise
+        finally:
+            self._task_seconds += time.time() - start
+        return msg
+
+    def rss(self) -> int:
+        return get_process_rss(self.process.pid)
+
+    def kill(self):
+        """
+        Kill the worker and processes started by it, e.g., shard parse workers.
+        """
+        children = get_child_pids(self.process.pid)
+        self.process.kill()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.join()
+        self._conn.close()
+
+    def close(self):
+        """
+        Stop the worker gracefully, it exits on pipe EOF.
+        """
+        self._conn.close()
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.kill()
+
+
+class ParseWorkerPool:
+    """
+    Pool of dedicated parse worker processes. Parser models are loaded in the
+    workers only, so they never grow the server process. Workers are recycled:
+    - after `max_tasks_per_child` tasks.
+    - when rss of the worker (including its children) exceeds 3/4 of
+        `max_rss_mb` after a task, the worker is killed at once if `max_rss_mb`
+        is exceeded during a task.
+    - when a task runs longer than `timeout`.
+    """
+
+    def __init__(
+        self,
+        target: Callable,
+        max_tasks_per_child: int = 20,
+        max_rss_mb: int = 8192,
+        timeout: float = 1800,
+    ):
+        """
+        Args:
+        - target: module level function run in workers, must be picklable.
+        - max_tasks_per_child: tasks run by a worker before it is replaced, 0
+            for no limit.
+        - max_rss_mb: memory ceiling of a worker, 0 for no limit.
+        - timeout: max seconds of a task, 0 for no limit.
+        """
+        self.target = target
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_rss = max_rss_mb << 20
+        self.timeout = timeout
+
+        self._idle_workers = []
+        self._lock = threading.Lock()
+
+    def run_iter(self, *args, batch_size: int) -> Iterator[list]:
+        """
+        Run a generator task in an idle worker, a new worker is started if
+        there is no idle one. See `ParseWorker.run_iter`.
+        """
+        worker = self._acquire()
+        try:
+            yield from worker.run_iter(args,
+                                       batch_size=batch_size,
+                                       timeout=self.timeout,
+                                       max_rss=self.max_rss)
+        except ParseWorkerError as e:
+            logging.info(f'parse worker {worker.process.pid} killed: {e}')
+            raise
+        except Exception:
+            self._release(worker)
+            raise
+        # NOTE: a worker left by a closed generator is killed, not released.
+        self._release(worker)
+
+    def _acquire(self) -> ParseWorker:
+        with self._lock:
+            worker = self._idle_workers.pop() if len(
+                self._idle_workers) > 0 else None
+        if worker is None:
+            worker = ParseWorker(target=self.target)
+            logging.info(f'start parse worker {worker.process.pid}')
+        return worker
+
+    def _release(self, worker: ParseWorker):
+        rss = worker.rss()
+        if self.max_tasks_per_child > 0 and \
+                worker.task_num >= self.max_tasks_per_child:
+            logging.info(
+                f'recycle parse worker {worker.process.pid} after {worker.task_num} tasks'
+            )
+            worker.close()
+        elif self.max_rss > 0 and rss > self.max_rss * 3 // 4:
+            logging.info(
+                f'recycle parse worker {worker.process.pid}, rss {rss >> 20}MB'
+            )
+            worker.close()
+        else:
+            with self._lock:
+                self._idle_workers.append(worker)
+
+    def close(self):
+        with self._lock:
+            workers = self._idle_workers
+            self._idle_workers = []
+        for worker in workers:
+            worker.close()
+
+
+class ParseQuarantine:
+    """
+    Files which keep crashing or hanging parse workers. A quarantined file is
+    skipped until its content changes, entries are kept in a json file so that
+    they survive restarts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except Exception as e:
+                logging_exception(e)
+
+    def contains(self, file_path: str, content_hash: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(file_path)
+        return entry is not None and entry['content_hash'] == content_hash
+
+    def add(self, file_path: str, content_hash: str, reason: str):
+        logging.info(f'{file_path}: quarantined, {reason}')
+        with self._lock:
+            self._entries[file_path] = {
+                'content_hash': content_hash,
+                'reason': reason,
+                'created_date': now_in_utc(),
+            }
+            self._dump()
+
+    def _dump(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+
+
+_parse_quarantine = None
+_parse_quarantine_lock = threading.Lock()
+
+
+def get_parse_quarantine() -> ParseQuarantine:
+    global _parse_quarantine
+    with _parse_quarantine_lock:
+        if _parse_quarantine is None:
+            _parse_quarantine = ParseQuarantine(
+                path=config.PARSE_QUARANTINE_PATH)
+        return _parse_quarantine
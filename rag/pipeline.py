@@ -0,0 +1,1033 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque, OrderedDict
+from typing import Any, Dict, Union
+from strenum import StrEnum
+
+import config
+from utils import logging_exception
+from parse.parser import Chunk
+from parse.asset_store import get_asset_store
+from .db import get_vector_db
+from .parse_worker import ParseWorkerPool, ParseWorkerError, get_parse_quarantine
+from .job_store import JobStore, JobState, get_job_store
+from .scheduler import ParseScheduler
+from .document import (
+    check_file_change,
+    get_document_name,
+    parse_file_iter,
+    get_stored_chunk_uuids,
+    save_document,
+    process_delete_file,
+    process_move_file,
+    ignore_file,
+)
+
+
+class JobType(StrEnum):
+    NEW = "new"
+    DELETE = "delete"
+    # file moved from `src_path`, re-keyed without parsing if content is
+    # unchanged, see `process_move_file`.
+    MOVE = "move"
+
+
+def supersede(
+    job_type: JobType,
+    src_path: str,
+    old_job_type: JobType,
+    old_src_path: str,
+) -> tuple[JobType, str, str]:
+    """
+    Merge a job of a path into the newer job of the same path superseding it.
+    A file moved in and then modified is still a move, so that the move source
+    is deleted; a move source dropped otherwise must be deleted separately.
+
+    Returns:
+    - Job type and src path of the merged job.
+    - Move source path to delete, None if there is none.
+    """
+    if old_job_type != JobType.MOVE or old_src_path == src_path:
+        return job_type, src_path, None
+    if job_type == JobType.NEW:
+        return JobType.MOVE, old_src_path, None
+    return job_type, src_path, old_src_path
+
+
+class JobStatus(StrEnum):
+    # waiting for the in-flight job of the same path
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    # dropped, replaced by a newer job of the same path
+    SUPERSEDED = "superseded"
+
+
+class JobStage(StrEnum):
+    WAIT = "wait"
+    HASH = "hash"
+    PARSE = "parse"
+    EMBED = "embed"
+    WRITE = "write"
+
+
+class MemoryBudget:
+    """
+    Budget of bytes held by jobs in flight. Acquiring blocks until enough
+    budget is released, a request larger than the whole budget is granted once
+    nothing else is held, so that an oversized job runs alone instead of never.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int) -> int:
+        """
+        Returns:
+        - Bytes charged, to be released later.
+        """
+        size = min(size, self.capacity)
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.used == 0 or self.used + size <= self.capacity)
+            self.used += size
+        return size
+
+    def resize(self, old_size: int, new_size: int) -> int:
+        """
+        Adjust a charge to the actual bytes held, never blocks since the bytes
+        are already held.
+
+        Returns:
+        - Bytes charged.
+        """
+        with self._cond:
+            self.used += new_size - old_size
+            self._cond.notify_all()
+        return new_size
+
+    def release(self, size: int):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+# approximate bytes held per chunk besides its content, mainly dense and sparse
+# vectors of its milvus record.
+_CHUNK_OVERHEAD = 8 * 1024
+
+
+def estimate_chunk_bytes(chunks: list[Chunk]) -> int:
+    return sum(
+        len(c.content) + len(c.extra_description) + _CHUNK_OVERHEAD
+        for c in chunks)
+
+
+class IngestJob:
+    """
+    Ingestion job, carries stage results from one stage to the next.
+    """
+
+    def __init__(self,
+                 job_type: JobType,
+                 file_path: str,
+                 src_path: str = None):
+        """
+        Args:
+        - job_type: job type.
+        - file_path: path to the file.
+        - src_path: path the file is moved from, for move jobs.
+        """
+        self.job_type = job_type
+        self.file_path = file_path
+        self.src_path = src_path
+        # id in job store
+        self.job_id: int = None
+        self.stage = JobStage.WAIT
+        # oversized file, charged a fixed budget and not checkpointed, chunk
+        # content is dropped once written.
+        self.stream = False
+        # file size in bytes
+        self.size = 0
+        # bytes charged to memory budget
+        self.charge = 0
+        self.content_hash = None
+        self.fingerprint = None
+        # chunks parsed so far, appended by parse stage as the parser yields
+        # them.
+        self.chunks: list[Chunk] = []
+        # aligned with chunks, true if chunk is already stored in vector db.
+        self.stored: list[bool] = []
+        # aligned with chunks written so far, true if chunk is in vector db.
+        self.inserted: list[bool] = []
+        # uuids of stored chunks no longer in the document.
+        self.removed: list[str] = []
+        # error of parse or write stage, the job fails once all its chunks
+        # reach the writer.
+        self.error: str = None
+        # seconds parse stage is blocked passing chunks on to embed stage.
+        self.put_seconds = 0.0
+
+    def __str__(self):
+        return f'{self.job_type} job: {self.file_path}'
+
+
+class ChunkRange:
+    """
+    Chunks `start` to `end` of a job, the unit passed from parse stage to embed
+    and write stages, so that chunks are embedded and written while the file is
+    still being parsed. The last range of a job is `final`, possibly empty.
+    """
+
+    def __init__(self,
+                 job: IngestJob,
+                 start: int,
+                 end: int,
+                 final: bool = False):
+        self.job = job
+        self.start = start
+        self.end = end
+        self.final = final
+        # milvus records aligned with chunks of the range, None if chunk is
+        # already stored or chunk embedding failed.
+        self.records: list = []
+
+    def new_chunk_indices(self) -> list[int]:
+        """
+        Returns:
+        - Indices of chunks in the range not stored in vector db yet.
+        """
+        return [
+            i for i in range(self.start, self.end) if not self.job.stored[i]
+        ]
+
+
+class IngestionPipeline:
+    """
+    Multi-stage ingestion pipeline. Each stage runs in its own workers and
+    stages are connected by bounded queues:
+    - hash: read file and check content change, `hash_workers` threads.
+    - parse: parse file in dedicated worker processes, `parse_workers` threads
+        each driving one worker at a time, see `ParseWorkerPool`. Jobs wait
+        for parse in priority order, see `ParseScheduler`. Chunks are passed
+        on in ranges as the parser yields them, see `ChunkRange`.
+    - embed: one thread, chunk ranges are embedded in batches.
+    - write: one thread, the only one writing vector db and document records,
+        the document record is saved once the last range of a job is written.
+
+    Backpressure: `submit` blocks once `max_pending_jobs` jobs are unfinished,
+    which in turn blocks the debouncer and startup scan. Parse waits while
+    content of jobs in flight exceeds `memory_budget` bytes. Files larger than
+    `stream_file_size` are indexed in streaming mode: charged
+    `stream_file_size` bytes, not checkpointed, and content of written chunks
+    is dropped, since chunks reach the writer while the file is parsed.
+
+    Jobs of the same path are applied in submission order, a job is only
+    dispatched after the previous job of the same path is finished. Since every
+    job re-checks the file, only the latest waiting job of a path is kept, older
+    waiting jobs are superseded and dropped.
+
+    Jobs are persisted in `JobStore` until committed, parsed chunks are
+    checkpointed there, unfinished jobs are resumed by `recover`.
+    """
+
+    def __init__(
+        self,
+        hash_workers: int = 2,
+        parse_workers: int = 2,
+        queue_size: int = 8,
+        job_store: JobStore = None,
+        max_pending_jobs: int = 1000,
+        memory_budget: int = 1024 * 1024 * 1024,
+        stream_file_size: int = 64 * 1024 * 1024,
+    ):
+        """
+        Args:
+        - hash_workers: number of threads reading and hashing files.
+        - parse_workers: number of parser processes.
+        - queue_size: max number of jobs waiting between two stages.
+        - job_store: where jobs are persisted, default to `get_job_store()`.
+        - max_pending_jobs: max number of unfinished jobs before `submit` blocks.
+        - memory_budget: max bytes of parsed content in flight.
+        - stream_file_size: files larger than this are indexed in streaming
+            mode.
+        """
+        self.hash_workers = hash_workers
+        self.parse_workers = parse_workers
+        self.queue_size = queue_size
+        self.max_pending_jobs = max_pending_jobs
+        self.stream_file_size = stream_file_size
+        self._job_store = job_store or get_job_store()
+        self._memory_budget = MemoryBudget(memory_budget)
+
+        # NOTE: entry queue is unbounded, finished jobs dispatch the next job
+        # of the same path from the writer thread, which must never block.
+        self._hash_queue = queue.Queue()
+        # NOTE: jobs waiting for parse hold no content, the queue is not
+        # bounded so that small files are never stuck behind large ones.
+        self._parse_queue = ParseScheduler(
+            workers=parse_workers,
+            large_seconds=config.INGEST_LARGE_JOB_SECONDS,
+            recent_seconds=config.INGEST_RECENT_SECONDS,
+        )
+        self._embed_queue = queue.Queue(maxsize=queue_size)
+        self._write_queue = queue.Queue(maxsize=queue_size)
+
+        # path -> jobs waiting for the in-flight job of the same path. A path
+        # key exists as long as a job of the path is in flight.
+        self._path_jobs = {}
+        # path -> in-flight job
+        self._inflight = {}
+        # job id -> unfinished job
+        self._jobs = {}
+        # job id -> status of finished jobs, latest `max_finished_jobs` kept
+        self._finished = OrderedDict()
+        self.max_finished_jobs = 10000
+        self._unfinished = 0
+        self._cond = threading.Condition()
+
+        self._parse_pool = ParseWorkerPool(
+            target=parse_file_iter,
+            max_tasks_per_child=config.PARSE_WORKER_MAX_TASKS,
+            max_rss_mb=config.PARSE_WORKER_MAX_RSS_MB,
+            timeout=config.PARSE_TIMEOUT_SECONDS,
+        )
+        self._quarantine = get_parse_quarantine()
+
+        self._threads = []
+        self._start_workers()
+
+    def _start_workers(self):
+        workers = [(self._hash_worker, self.hash_workers),
+                   (self._parse_worker, self.parse_workers),
+                   (self._embed_worker, 1), (self._write_worker, 1)]
+        for target, num in workers:
+            for i in range(num):
+                t = threading.Thread(
+                    target=target,
+                    name=f'ingest{target.__name__}_{i}',
+                    daemon=True,
+                )
+                t.start()
+                self._threads.append(t)
+
+    def submit(
+        self,
+        job_type: JobType,
+        file_path: str,
+        src_path: str = None,
+        job_id: int = None,
+        block: bool = True,
+    ):
+        """
+        Submit a job, jobs of ignored files are dropped.
+
+        Args:
+        - job_type: job type.
+        - file_path: path to the file.
+        - src_path: path the file is moved from, for move jobs.
+        - job_id: id of a persisted job being resumed, a new job is persisted if
+            not set.
+        - block: wait while `max_pending_jobs` jobs are unfinished, must be
+            false when called from pipeline workers.
+
+        Returns:
+        - Job id, see `get_job_status`, None if the file is ignored.
+        """
+        if ignore_file(file_path):
+            logging.info(f'{file_path}: ignore')
+            return None
+
+        if block:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._unfinished < self.max_pending_jobs)
+
+        job = IngestJob(job_type=job_type,
+                        file_path=file_path,
+                        src_path=src_path)
+        job.job_id = job_id
+        if job.job_id is None:
+            job.job_id = self._job_store.add(job_type=job_type,
+                                             file_path=file_path,
+                                             src_path=src_path)
+        orphans = []
+        dispatch = False
+        with self._cond:
+            self._unfinished += 1
+            self._jobs[job.job_id] = job
+            if file_path in self._path_jobs:
+                pending = self._path_jobs[file_path]
+                if len(pending) > 0:
+                    logging.info(
+                        f'{file_path}: drop {len(pending)} superseded jobs')
+                    self._unfinished -= len(pending)
+                    for old_job in pending:
+                        job.job_type, job.src_path, orphan = supersede(
+                            job.job_type, job.src_path, old_job.job_type,
+                            old_job.src_path)
+                        if orphan is not None:
+                            orphans.append(orphan)
+                        self._job_store.discard(old_job.job_id)
+                        del self._jobs[old_job.job_id]
+                        self._add_finished(old_job,
+                                           JobStatus.SUPERSEDED,
+                                           superseded_by=job.job_id)
+                    self._job_store.update(job.job_id,
+                                           job_type=job.job_type,
+                                           src_path=job.src_path)
+                    pending.clear()
+                pending.append(job)
+            else:
+                self._path_jobs[file_path] = deque()
+                self._inflight[file_path] = job
+                dispatch = True
+        if dispatch:
+            self._hash_queue.put(job)
+
+        for orphan in orphans:
+            self.submit(JobType.DELETE, file_path=orphan, block=block)
+        return job.job_id
+
+    def recover(self):
+        """
+        Resubmit jobs left unfinished by last run. A job interrupted too many
+        times is marked failed instead, it may be what crashed the server.
+        Resumed jobs are admitted without waiting for `max_pending_jobs`, they
+        were admitted by last run already.
+        """
+        jobs = self._job_store.unfinished()
+        for job in jobs:
+            if job['attempts'] >= config.INGEST_JOB_MAX_ATTEMPTS:
+                logging.info(
+                    f"{job['file_path']}: {job['job_type']} job interrupted {job['attempts']} times, mark failed"
+                )
+                try:
+                    self._drop_written(job['id'], job['file_path'])
+                except Exception as e:
+                    logging_exception(e)
+                self._job_store.fail(job['id'], 'too many attempts')
+                continue
+            logging.info(
+                f"{job['file_path']}: resume {job['job_type']} job, state {job['state']}"
+            )
+            self.submit(JobType(job['job_type']),
+                        file_path=job['file_path'],
+                        src_path=job['src_path'],
+                        job_id=job['id'],
+                        block=False)
+
+    def get_job_status(self, job_id: int) -> Union[Dict[str, Any], None]:
+        """
+        Returns:
+        - Status of a job, None if unknown, e.g., finished long ago:
+            - job_id, job_type, file_path: the job.
+            - status: see `JobStatus`.
+            - stage: for running job, stage the job is in.
+            - position: for job in parse stage, position in parse queue, 0 if
+                being parsed.
+            - eta_seconds: for job in parse stage, estimated seconds until
+                parsed.
+            - error: for failed job, error message.
+            - superseded_by: for superseded job, id of the job replacing it.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                status = self._finished.get(job_id)
+                if status is not None:
+                    return dict(status)
+            running = job is not None and self._inflight.get(
+                job.file_path) is job
+
+        if job is None:
+            # failed in previous run
+            row = self._job_store.get(job_id)
+            if row is None or row['state'] != JobState.FAILED:
+                return None
+            return {
+                'job_id': job_id,
+                'job_type': row['job_type'],
+                'file_path': row['file_path'],
+                'status': JobStatus.FAILED,
+                'error': row['error'],
+            }
+
+        status = {
+            'job_id': job_id,
+            'job_type': job.job_type,
+            'file_path': job.file_path,
+            'status': JobStatus.RUNNING if running else JobStatus.QUEUED,
+        }
+        if running:
+            status['stage'] = job.stage
+            if job.stage == JobStage.PARSE:
+                status.update(self._parse_queue.status(job) or {})
+        return status
+
+    def _add_finished(self, job: IngestJob, status: JobStatus, **fields):
+        """
+        Keep status of a finished job, caller must hold `_cond`.
+        """
+        self._finished[job.job_id] = {
+            'job_id': job.job_id,
+            'job_type': job.job_type,
+            'file_path': job.file_path,
+            'status': status,
+            **fields,
+        }
+        while len(self._finished) > self.max_finished_jobs:
+            self._finished.popitem(last=False)
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        """
+        Block until all submitted jobs are finished.
+
+        Returns:
+        - bool, false if timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._unfinished == 0,
+                                       timeout=timeout)
+
+    def _finish(self, job: IngestJob, error: str = None):
+        """
+        Mark job finished and dispatch next job of the same path if any.
+
+        Args:
+        - job: the finished job.
+        - error: error message if the job failed.
+        """
+        if error is None:
+            self._job_store.commit(job.job_id, job.file_path)
+        else:
+            self._job_store.fail(job.job_id, error)
+        if job.charge > 0:
+            self._memory_budget.release(job.charge)
+            job.charge = 0
+
+        next_job = None
+        with self._cond:
+            self._unfinished -= 1
+            del self._jobs[job.job_id]
+            if error is None:
+                self._add_finished(job, JobStatus.DONE)
+            else:
+                self._add_finished(job, JobStatus.FAILED, error=error)
+            pending = self._path_jobs[job.file_path]
+            if len(pending) > 0:
+                next_job = pending.popleft()
+                self._inflight[job.file_path] = next_job
+            else:
+                del self._path_jobs[job.file_path]
+                del self._inflight[job.file_path]
+            self._cond.notify_all()
+
+        if next_job is not None:
+            self._hash_queue.put(next_job)
+
+    # ======================================================================== #
+    # stages
+    def _hash_worker(self):
+        while True:
+            job = self._hash_queue.get()
+            job.stage = JobStage.HASH
+            try:
+                self._job_store.start(job.job_id)
+                # content hash a run of this job interrupted by last shutdown
+                # has parsed, if any.
+                last_hash = (self._job_store.get(job.job_id)
+                             or {}).get('content_hash')
+                if job.job_type in [JobType.DELETE, JobType.MOVE]:
+                    self._drop_written(job.job_id, job.file_path)
+                    job.stage = JobStage.WRITE
+                    self._write_queue.put(ChunkRange(job, 0, 0, final=True))
+                    continue
+
+                logging.info(f'{job.file_path}: process new file')
+                file_change = check_file_change(job.file_path)
+                if file_change is None:
+                    self._drop_written(job.job_id, job.file_path)
+                    self._finish(job)
+                    continue
+                job.content_hash, job.fingerprint = file_change
+                if job.content_hash != last_hash:
+                    # chunks written by the interrupted run are stale, a
+                    # resumed run of the same content writes them again.
+                    self._drop_written(job.job_id, job.file_path)
+                self._job_store.update(job.job_id,
+                                       content_hash=job.content_hash,
+                                       fingerprint=job.fingerprint)
+                if self._quarantine.contains(job.file_path, job.content_hash):
+                    logging.info(f'{job.file_path}: quarantined, skip')
+                    self._drop_written(job.job_id, job.file_path)
+                    self._finish(job)
+                    continue
+
+                try:
+                    job.size = os.path.getsize(job.file_path)
+                except OSError:
+                    job.size = 0
+                if job.size > self.stream_file_size:
+                    logging.info(
+                        f'{job.file_path}: {job.size} bytes, index in streaming mode'
+                    )
+                    job.stream = True
+                job.stage = JobStage.PARSE
+                self._parse_queue.put(job, file_path=job.file_path)
+            except Exception as e:
+                logging_exception(e)
+                error = f'{type(e).__name__} - {e}'
+                try:
+                    self._drop_written(job.job_id, job.file_path)
+                except Exception as e:
+                    logging_exception(e)
+                self._finish(job, error=error)
+
+    def _parse_worker(self):
+        while True:
+            job = self._parse_queue.get()
+            # parse throughput is learned from parsed jobs only, not from jobs
+            # resumed from checkpoint.
+            parsed = False
+            parse_seconds = None
+            try:
+                # file size as an estimate before parse, then actual bytes. A
+                # streamed file holds no more than the largest job not
+                # streamed, its content is dropped as chunks are written.
+                job.charge = self._memory_budget.acquire(
+                    min(job.size, self.stream_file_size))
+                self._parse_queue.start(job)
+                stored_uuids = get_stored_chunk_uuids(job.file_path)
+                chunks = None
+                if not job.stream:
+                    chunks = self._job_store.load_chunks(
+                        file_path=job.file_path,
+                        content_hash=job.content_hash,
+                    )
+                if chunks is None:
+                    start_time = time.monotonic()
+                    self._run_parse(job, stored_uuids)
+                    parse_seconds = time.monotonic() - start_time - \
+                        job.put_seconds
+                    parsed = True
+                    if not job.stream:
+                        self._job_store.save_chunks(job.job_id, job.chunks)
+                else:
+                    self._job_store.update(job.job_id, state=JobState.PARSED)
+                    for i in range(0, len(chunks), config.EMBED_BATCH_SIZE):
+                        self._add_chunks(
+                            job, chunks[i:i + config.EMBED_BATCH_SIZE],
+                            stored_uuids)
+                if not job.stream:
+                    job.charge = self._memory_budget.resize(
+                        job.charge, estimate_chunk_bytes(job.chunks))
+                job.removed = list(stored_uuids -
+                                   set(chunk.uuid for chunk in job.chunks))
+                logging.info(
+                    f'{job.file_path}: {len(job.chunks) - sum(job.stored)} new chunks, {sum(job.stored)} unchanged chunks, {len(job.removed)} removed chunks'
+                )
+            except Exception as e:
+                logging_exception(e)
+                job.error = f'{type(e).__name__} - {e}'
+            finally:
+                self._parse_queue.done(job,
+                                       success=parsed,
+                                       seconds=parse_seconds)
+            # the writer finishes the job, including a failed one whose
+            # chunks already written must be dropped.
+            job.stage = JobStage.EMBED
+            self._embed_queue.put(
+                ChunkRange(job, len(job.chunks), len(job.chunks), final=True))
+
+    def _add_chunks(self, job: IngestJob, chunks: list[Chunk],
+                    stored_uuids: set[str]):
+        """
+        Append parsed chunks to job and pass them on to embed stage.
+        """
+        start = len(job.chunks)
+        job.chunks.extend(chunks)
+        job.stored.extend(chunk.uuid in stored_uuids for chunk in chunks)
+        put_time = time.monotonic()
+        self._embed_queue.put(ChunkRange(job, start, len(job.chunks)))
+        job.put_seconds += time.monotonic() - put_time
+
+    def _run_parse(self, job: IngestJob, stored_uuids: set[str]):
+        """
+        Parse file in a worker process, chunks are added to job in batches as
+        the parser yields them, see `_add_chunks`. Crashed, hung or oversized
+        parses are retried in fresh workers, chunks already added by failed
+        attempts are skipped. The file is quarantined when all retries fail.
+        """
+        for i in range(config.PARSE_MAX_RETRIES + 1):
+            try:
+                offset = 0
+                for chunks in self._parse_pool.run_iter(
+                        job.file_path,
+                        job.content_hash,
+                        get_document_name(job.file_path),
+                        batch_size=config.EMBED_BATCH_SIZE):
+                    skip = min(len(job.chunks) - offset, len(chunks))
+                    if any(chunk.uuid != job.chunks[offset + j].uuid
+                           for j, chunk in enumerate(chunks[:skip])):
+                        raise Exception('parse result changed on retry')
+                    offset += len(chunks)
+                    if skip < len(chunks):
+                        self._add_chunks(job, chunks[skip:], stored_uuids)
+                return
+            except ParseWorkerError as e:
+                logging.info(
+                    f'{job.file_path}: parse attempt {i + 1} failed, {e}')
+                error = e
+        self._quarantine.add(
+            file_path=job.file_path,
+            content_hash=job.content_hash,
+            reason=str(error),
+        )
+        raise error
+
+    def _embed_worker(self):
+        vector_db = get_vector_db()
+        while True:
+            ranges = [self._embed_queue.get()]
+            # coalesce ready ranges so that small documents share batches,
+            # chunks already stored are not embedded again.
+            targets = [(ranges[0], i) for i in ranges[0].new_chunk_indices()]
+            while len(targets) < config.EMBED_BATCH_SIZE:
+                try:
+                    chunk_range = self._embed_queue.get_nowait()
+                except queue.Empty:
+                    break
+                ranges.append(chunk_range)
+                targets.extend(
+                    (chunk_range, i) for i in chunk_range.new_chunk_indices())
+
+            for chunk_range in ranges:
+                chunk_range.records = [None] * (chunk_range.end -
+                                                chunk_range.start)
+            # (range, chunk index) of chunks to embed
+            chunks = [r.job.chunks[i] for r, i in targets]
+            offset = 0
+            for batch in vector_db.split_batches(chunks):
+                try:
+                    records = vector_db.build_records(batch)
+                    for (r, i), record in zip(
+                            targets[offset:offset + len(batch)], records):
+                        r.records[i - r.start] = record
+                except Exception as e:
+                    logging_exception(e)
+                offset += len(batch)
+
+            for chunk_range in ranges:
+                if chunk_range.final:
+                    job = chunk_range.job
+                    self._job_store.update(job.job_id, state=JobState.EMBEDDED)
+                    job.stage = JobStage.WRITE
+                self._write_queue.put(chunk_range)
+
+    def _write_worker(self):
+        while True:
+            chunk_range = self._write_queue.get()
+            job = chunk_range.job
+            try:
+                # ranges of a failed job are not written
+                if job.error is None:
+                    self._write(chunk_range)
+            except Exception as e:
+                logging_exception(e)
+                job.error = f'{type(e).__name__} - {e}'
+            if not chunk_range.final:
+                continue
+
+            if job.error is not None:
+                try:
+                    self._drop_written(job.job_id, job.file_path)
+                except Exception as e:
+                    logging_exception(e)
+            self._finish(job, error=job.error)
+
+    def _write(self, chunk_range: ChunkRange):
+        vector_db = get_vector_db()
+        job = chunk_range.job
+
+        if job.job_type == JobType.MOVE:
+            if not process_move_file(src_path=job.src_path,
+                                     dest_path=job.file_path):
+                # not a pure move, index moved file as a new file
+                process_delete_file(file_path=job.src_path)
+                self.submit(JobType.NEW, file_path=job.file_path, block=False)
+            return
+
+        if job.job_type == JobType.DELETE:
+            process_delete_file(file_path=job.file_path)
+            return
+
+        inserted = job.stored[chunk_range.start:chunk_range.end]
+        embedded = [
+            i for i, r in enumerate(chunk_range.records) if r is not None
+        ]
+        if len(embedded) > 0:
+            # recorded first, so that chunks are found if the job never
+            # finishes.
+            self._job_store.add_written(
+                job.job_id,
+                [job.chunks[chunk_range.start + i].uuid for i in embedded])
+            ret = vector_db.upsert_records(
+                [chunk_range.records[i] for i in embedded])
+            for i, success in zip(embedded, ret):
+                inserted[i] = success
+        job.inserted.extend(inserted)
+        if job.stream:
+            # only uuid and content url of written chunks are needed to save
+            # the document, failed chunks keep content to be retried.
+            for i, success in enumerate(inserted, start=chunk_range.start):
+                if success:
+                    job.chunks[i].release_content()
+        if not chunk_range.final:
+            return
+
+        if len(job.chunks) == 0:
+            # delete document record if any
+            process_delete_file(file_path=job.file_path)
+            return
+
+        save_document(
+            file_path=job.file_path,
+            content_hash=job.content_hash,
+            fingerprint=job.fingerprint,
+            chunks=job.chunks,
+            inserted=job.inserted,
+            removed=job.removed,
+        )
+
+    def _drop_written(self, job_id: int, file_path: str):
+        """
+        Delete chunks written by a failed or stale job, including runs
+        interrupted by a shutdown, except chunks of the stored document record.
+        """
+        uuids = self._job_store.get_written(job_id)
+        if len(uuids) == 0:
+            return
+        uuids = list(set(uuids) - get_stored_chunk_uuids(file_path))
+        if len(uuids) > 0:
+            logging.info(
+                f'{file_path}: delete {len(uuids)} chunks written by job {job_id}'
+            )
+            get_vector_db().delete(keys=uuids)
+            asset_store = get_asset_store()
+            asset_store.release(uuids)
+            asset_store.gc()
+        self._job_store.clear_written(job_id)
+
+
+class PendingEvent:
+    """
+    File event waiting for the file to settle.
+    """
+
+    def __init__(self,
+                 job_type: JobType,
+                 due_time: float,
+                 stat: tuple,
+                 src_path: str = None):
+        self.job_type = job_type
+        self.due_time = due_time
+        self.stat = stat
+        self.src_path = src_path
+
+
+class PathDebouncer:
+    """
+    Coalesce file events per path before submitting to the pipeline. Events of
+    a path are merged into the latest one, and the job is only submitted once
+    no new event arrives within `settle_seconds` and, for new file and move
+    jobs, file size and mtime stop changing, so that a file being copied is
+    parsed once after the copy is finished.
+
+    At most `max_events` paths are pending, `submit` of a new path blocks the
+    file watcher beyond that, while settled jobs wait for the pipeline.
+    """
+
+    def __init__(self,
+                 pipeline: IngestionPipeline,
+                 settle_seconds: float,
+                 max_events: int = 1000):
+        """
+        Args:
+        - pipeline: where settled jobs are submitted to.
+        - settle_seconds: settle window.
+        - max_events: max number of pending paths.
+        """
+        self.pipeline = pipeline
+        self.settle_seconds = settle_seconds
+        self.max_events = max_events
+
+        # path -> PendingEvent
+        self._events = {}
+        # path -> (stat, deadline), files already submitted by others, in
+        # deadline order
+        self._expected = OrderedDict()
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name='ingest_debouncer',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def submit(self, job_type: JobType, file_path: str, src_path: str = None):
+        if ignore_file(file_path):
+            return
+
+        stat = self._stat(file_path) if job_type != JobType.DELETE else None
+        with self._cond:
+            # event of a pending path is merged, costs nothing
+            self._cond.wait_for(lambda: file_path in self._events or len(
+                self._events) < self.max_events)
+            due_time = time.monotonic() + self.settle_seconds
+            if job_type == JobType.MOVE:
+                # pending event of move source is stale, a file moved twice
+                # is moved from the first source.
+                src_event = self._events.pop(src_path, None)
+                if src_event is not None and src_event.job_type == JobType.MOVE:
+                    src_path = src_event.src_path
+
+            orphan = None
+            event = self._events.get(file_path)
+            if event is not None:
+                job_type, src_path, orphan = supersede(
+                    job_type, src_path, event.job_type, event.src_path)
+            self._events[file_path] = PendingEvent(
+                job_type=job_type,
+                due_time=due_time,
+                stat=stat,
+                src_path=src_path,
+            )
+            if orphan is not None:
+                self._events[orphan] = PendingEvent(
+                    job_type=JobType.DELETE,
+                    due_time=due_time,
+                    stat=None,
+                )
+            self._cond.notify_all()
+
+    def expect(self, file_path: str):
+        """
+        Expect events of a file already submitted to pipeline by the caller,
+        e.g., uploaded. Its events are dropped if the file is unchanged when
+        settled.
+        """
+        stat = self._stat(file_path)
+        now = time.monotonic()
+        with self._cond:
+            while len(self._expected) > 0:
+                _, (_, deadline) = next(iter(self._expected.items()))
+                if deadline > now:
+                    break
+                self._expected.popitem(last=False)
+            self._expected.pop(file_path, None)
+            self._expected[file_path] = (stat,
+                                         now + max(60, 10 * self.settle_seconds))
+
+    def _stat(self, file_path: str) -> tuple:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                ready = [(path, event) for path, event in self._events.items()
+                         if event.due_time <= now]
+                if len(ready) == 0:
+                    timeout = None
+                    if len(self._events) > 0:
+                        timeout = min(e.due_time
+                                      for e in self._events.values()) - now
+                    self._cond.wait(timeout=timeout)
+                    continue
+
+            for path, event in ready:
+                self._settle(path, event)
+
+    def _settle(self, file_path: str, event: PendingEvent):
+        stat = None
+        if event.job_type != JobType.DELETE:
+            stat = self._stat(file_path)
+
+        with self._cond:
+            # superseded by a newer event
+            if self._events.get(file_path) is not event:
+                return
+
+            if event.job_type != JobType.DELETE and stat != event.stat:
+                # still being written, wait for another settle window
+                event.stat = stat
+                event.due_time = time.monotonic() + self.settle_seconds
+                return
+            del self._events[file_path]
+            self._cond.notify_all()
+            expected = self._expected.pop(file_path, None)
+
+        if event.job_type != JobType.DELETE and expected is not None \
+                and expected[0] == stat:
+            logging.info(f'{file_path}: already submitted, skip')
+            return
+
+        if event.job_type == JobType.NEW and stat is None:
+            logging.info(f'{file_path}: file disappeared before settled')
+            return
+        if event.job_type == JobType.MOVE and stat is None:
+            logging.info(f'{file_path}: file disappeared before settled')
+            self.pipeline.submit(JobType.DELETE, file_path=event.src_path)
+            return
+        self.pipeline.submit(event.job_type,
+                             file_path=file_path,
+                             src_path=event.src_path)
+
+
+_ingestion_pipeline = None
+_ingestion_pipeline_lock = threading.Lock()
+
+
+def get_ingestion_pipeline() -> IngestionPipeline:
+    global _ingestion_pipeline
+    with _ingestion_pipeline_lock:
+        if _ingestion_pipeline is None:
+            _ingestion_pipeline = IngestionPipeline(
+                hash_workers=config.INGEST_HASH_WORKERS,
+                parse_workers=config.INGEST_PARSE_WORKERS,
+                queue_size=config.INGEST_QUEUE_SIZE,
+                max_pending_jobs=config.INGEST_MAX_PENDING_JOBS,
+                memory_budget=config.INGEST_MEMORY_BUDGET_MB * 1024 * 1024,
+                stream_file_size=config.INGEST_STREAM_FILE_SIZE_MB * 1024 *
+                1024,
+            )
+            _ingestion_pipeline.recover()
+    return _ingestion_pipeline
+
+
+_path_debouncer = None
+
+
+def get_path_debouncer() -> PathDebouncer:
+    global _path_debouncer
+    pipeline = get_ingestion_pipeline()
+    with _ingestion_pipeline_lock:
+        if _path_debouncer is None:
+            _path_debouncer = PathDebouncer(
+                pipeline=pipeline,
+                settle_seconds=config.INGEST_SETTLE_SECONDS,
+                max_events=config.INGEST_MAX_PENDING_JOBS,
+            )
+    return _path_debouncer
@@ -0,0 +1,269 @@
+import os
+import time
+import logging
+import threading
+
+from utils import logging_exception
+from .document import ignore_file, ignore_dir
+from .pipeline import JobType
+
+
+class DirectoryPoller:
+    """
+    Poll file directory tree for changes, a fallback of filesystem events which
+    are lost on some mounts, e.g., docker bind mounts of macos host.
+
+    An in-memory snapshot of directory and file stats is kept and diffed on each
+    scan, only real changes are submitted, as the same jobs as `FileHandler`
+    submits. Scan cost is bounded regardless of tree size:
+    - a directory is only listed when its mtime changes, i.e., files created,
+        deleted or renamed in it. Each scan stats directories recently changed
+        and the next `stat_batch` directories in round robin.
+    - modified files are found by stat, each scan stats files recently changed
+        and the next `stat_batch` files in round robin.
+    so that a full sweep of a large tree is spread over several scans.
+
+    Scan interval drops to `min_interval` once changes are found and doubles
+    up to `max_interval` while nothing changes.
+    """
+
+    # seconds a changed file or directory is stat on every scan
+    HOT_SECONDS = 60
+
+    def __init__(
+        self,
+        file_dir: str,
+        debouncer,
+        min_interval: float = 1.0,
+        max_interval: float = 30.0,
+        stat_batch: int = 2000,
+    ):
+        """
+        Args:
+        - file_dir: root directory to poll, recursively.
+        - debouncer: where jobs of changed files are submitted to, see
+            `PathDebouncer`.
+        - min_interval: min seconds between two scans.
+        - max_interval: max seconds between two scans.
+        - stat_batch: max number of files, and of directories, stat in round
+            robin per scan.
+        """
+        self.file_dir = file_dir
+        self.debouncer = debouncer
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.stat_batch = stat_batch
+        self.interval = min_interval
+
+        # file path -> (inode, size, mtime_ns)
+        self._files = {}
+        # directory path -> mtime_ns of last listing, None if never listed
+        self._dirs = {file_dir: None}
+        # directories to list on next scan regardless of mtime
+        self._relist = set([file_dir])
+        # directory path -> (file paths, sub directory paths) of last listing
+        self._entries = {}
+        # round robin cursors, path -> monotonic time last changed
+        self._file_cursor = RoundRobin()
+        self._dir_cursor = RoundRobin()
+        self._hot = {}
+
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.scan(submit=False)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name='file_dir_poller',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(timeout=self.interval):
+            try:
+                changes = self.scan()
+            except Exception as e:
+                logging_exception(e)
+                changes = 0
+            if changes > 0:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+
+    def _stat(self, path: str) -> tuple:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def scan(self, submit: bool = True) -> int:
+        """
+        Scan once and submit jobs of changed files.
+
+        Args:
+        - submit: false to only take the snapshot.
+
+        Returns:
+        - Number of changes found.
+        """
+        now = time.monotonic()
+        self._hot = {
+            p: t
+            for p, t in self._hot.items()
+            if now - t < self.HOT_SECONDS and (p in self._files or p in
+                                                self._dirs)
+        }
+
+        # list changed directories for created, deleted and renamed files
+        gone = {}
+        created = {}
+        dirs = self._dir_cursor.next(self._dirs, self.stat_batch)
+        dirs.update(p for p in self._hot if p in self._dirs)
+        relist, self._relist = self._relist, set()
+        dirs.update(relist)
+        for dir_path in dirs:
+            if dir_path in self._dirs:
+                self._check_dir(dir_path,
+                                gone,
+                                created,
+                                force=dir_path in relist)
+
+        # a file gone and a file created with the same inode and size is moved
+        jobs = []
+        created_by_key = {(s[0], s[1]): p for p, s in created.items()}
+        for file_path, old_stat in gone.items():
+            dest_path = created_by_key.pop((old_stat[0], old_stat[1]), None)
+            if dest_path is None:
+                jobs.append((JobType.DELETE, file_path, None))
+            else:
+                jobs.append((JobType.MOVE, dest_path, file_path))
+                del created[dest_path]
+        jobs.extend((JobType.NEW, p, None) for p in created)
+
+        # stat hot files and next batch in round robin for modified files
+        files = self._file_cursor.next(self._files, self.stat_batch)
+        files.update(p for p in self._hot if p in self._files)
+        for file_path in files:
+            old_stat = self._files.get(file_path)
+            if old_stat is None:
+                continue
+            stat = self._stat(file_path)
+            # deleted files are found by listing
+            if stat is None or stat == old_stat:
+                continue
+            self._files[file_path] = stat
+            jobs.append((JobType.NEW, file_path, None))
+
+        for _, file_path, _ in jobs:
+            self._hot[file_path] = now
+            self._hot[os.path.dirname(file_path)] = now
+        if submit:
+            for job_type, file_path, src_path in jobs:
+                self.debouncer.submit(job_type,
+                                      file_path=file_path,
+                                      src_path=src_path)
+        if len(jobs) > 0:
+            logging.info(f'{self.file_dir}: poll {len(jobs)} changes')
+        return len(jobs)
+
+    def _check_dir(self,
+                   dir_path: str,
+                   gone: dict,
+                   created: dict,
+                   force: bool = False):
+        """
+        List directory if its mtime changed, diff its entries with snapshot.
+        New sub directories are listed as well, removed sub directories are
+        dropped with all files under them.
+
+        Args:
+        - dir_path: directory to check.
+        - gone: file path -> stat of files gone, updated in place.
+        - created: file path -> stat of files created, updated in place.
+        - force: list directory even if its mtime is unchanged.
+        """
+        try:
+            mtime = os.stat(dir_path).st_mtime_ns
+        except OSError as e:
+            if dir_path == self.file_dir:
+                logging_exception(e)
+            else:
+                # dropped together with its files when parent is listed
+                self._relist.add(os.path.dirname(dir_path))
+            return
+        if not force and mtime == self._dirs[dir_path]:
+            return
+
+        file_paths = set()
+        sub_dirs = set()
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not ignore_dir(entry.path):
+                            sub_dirs.add(entry.path)
+                    elif entry.is_file() and not ignore_file(entry.path):
+                        file_paths.add(entry.path)
+        except OSError as e:
+            logging_exception(e)
+            return
+        self._dirs[dir_path] = mtime
+        # mtime granularity of some filesystems is coarse, a change within the
+        # same tick would be missed, so list again until it is old.
+        if time.time_ns() - mtime < 2 * 10**9:
+            self._relist.add(dir_path)
+
+        old_files, old_dirs = self._entries.get(dir_path, (set(), set()))
+        for file_path in old_files - file_paths:
+            gone[file_path] = self._files.pop(file_path)
+        for file_path in file_paths - old_files:
+            stat = self._stat(file_path)
+            if stat is not None:
+                self._files[file_path] = stat
+                created[file_path] = stat
+        self._entries[dir_path] = (
+            set(p for p in file_paths if p in self._files),
+            sub_dirs,
+        )
+        for sub_dir in old_dirs - sub_dirs:
+            self._drop_dir(sub_dir, gone)
+        for sub_dir in sub_dirs:
+            if sub_dir not in self._dirs:
+                self._dirs[sub_dir] = None
+                self._check_dir(sub_dir, gone, created)
+
+    def _drop_dir(self, dir_path: str, gone: dict):
+        self._dirs.pop(dir_path, None)
+        file_paths, sub_dirs = self._entries.pop(dir_path, (set(), set()))
+        for file_path in file_paths:
+            gone[file_path] = self._files.pop(file_path)
+        for sub_dir in sub_dirs:
+            self._drop_dir(sub_dir, gone)
+
+
+class RoundRobin:
+    """
+    Cursor taking the next batch of keys of a changing dict in round robin.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._cursor = 0
+
+    def next(self, items: dict, batch: int) -> set:
+        if self._cursor >= len(self._keys):
+            # a sweep is finished, take keys of the next sweep
+            self._keys = list(items)
+            self._cursor = 0
+        keys = self._keys[self._cursor:self._cursor + batch]
+        self._cursor += batch
+        return set(keys)
@@ -0,0 +1,193 @@
+import os
+import time
+import threading
+from typing import Any, Dict, Union
+
+# initial parse throughput in bytes per second by file type, refined by
+# finished parses. Scanned PDFs go through layout / OCR models, orders of
+# magnitude slower than text formats.
+_default_throughput = {
+    'pdf': 200 * 1024,
+    'docx': 5 * 1024 * 1024,
+    'md': 50 * 1024 * 1024,
+    'txt': 50 * 1024 * 1024,
+}
+
+
+class _Entry:
+
+    def __init__(self, item: Any, file_type: str, size: int, cost: float,
+                 recent: bool):
+        self.item = item
+        self.file_type = file_type
+        self.size = size
+        # estimated parse seconds
+        self.cost = cost
+        self.recent = recent
+        self.submit_time = time.monotonic()
+        self.start_time = None
+
+
+class ParseScheduler:
+    """
+    Priority queue in front of parse workers, replacing FIFO order so that a
+    small document is not parsed after a burst of large scanned PDFs.
+
+    - a job is scored by its estimated parse seconds, from file size and the
+        observed parse throughput of its file type. Lower score runs first.
+    - jobs of files modified within `recent_seconds` are boosted, their score
+        is divided by `recent_boost`.
+    - score decreases by `aging` per second waited, so a large job is delayed
+        but never starved.
+    - jobs estimated longer than `large_seconds` are large, with more than one
+        worker at most `workers - 1` large jobs run at a time, so that one
+        worker is always left for small jobs.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        large_seconds: float = 60,
+        recent_seconds: float = 600,
+        recent_boost: float = 10,
+        aging: float = 1.0,
+    ):
+        self.workers = workers
+        self.large_seconds = large_seconds
+        self.recent_seconds = recent_seconds
+        self.recent_boost = recent_boost
+        self.aging = aging
+
+        self._throughput = dict(_default_throughput)
+        self._waiting = []
+        # id(item) -> entry
+        self._running = {}
+        self._cond = threading.Condition()
+
+    def estimate(self, file_path: str) -> tuple[str, int, float, bool]:
+        """
+        Returns:
+        - File type, file size, estimated parse seconds and whether the file
+            is recently modified.
+        """
+        file_type = file_path.split('.')[-1].lower()
+        try:
+            st = os.stat(file_path)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = 0, 0
+        with self._cond:
+            throughput = self._throughput.get(file_type, 1024 * 1024)
+        recent = time.time() - mtime < self.recent_seconds
+        return file_type, size, size / throughput, recent
+
+    def put(self, item: Any, file_path: str):
+        file_type, size, cost, recent = self.estimate(file_path)
+        with self._cond:
+            self._waiting.append(
+                _Entry(item=item,
+                       file_type=file_type,
+                       size=size,
+                       cost=cost,
+                       recent=recent))
+            self._cond.notify_all()
+
+    def get(self) -> Any:
+        """
+        Take the next job to parse, block until one is eligible.
+        """
+        with self._cond:
+            while True:
+                entry = self._next()
+                if entry is not None:
+                    break
+                self._cond.wait()
+            self._waiting.remove(entry)
+            entry.start_time = time.monotonic()
+            self._running[id(entry.item)] = entry
+        return entry.item
+
+    def start(self, item: Any):
+        """
+        Mark parse of a job taken by `get` started, once the worker is done
+        waiting for resources. Running time and ETA count from here.
+        """
+        with self._cond:
+            entry = self._running.get(id(item))
+            if entry is not None:
+                entry.start_time = time.monotonic()
+
+    def done(self, item: Any, success: bool = True, seconds: float = None):
+        """
+        Mark job finished, throughput of its file type is updated from
+        successful parses.
+
+        Args:
+        - item: job taken by `get`.
+        - success: whether the job is parsed.
+        - seconds: parse seconds, excluding time the worker is blocked on
+            downstream stages. Seconds since `start` if not given.
+        """
+        with self._cond:
+            entry = self._running.pop(id(item), None)
+            self._cond.notify_all()
+            if entry is None or not success or entry.size == 0:
+                return
+            if seconds is None:
+                seconds = time.monotonic() - entry.start_time
+            seconds = max(seconds, 1e-3)
+            throughput = self._throughput.get(entry.file_type, 1024 * 1024)
+            self._throughput[entry.file_type] = 0.8 * throughput \
+                + 0.2 * entry.size / seconds
+
+    def _score(self, entry: _Entry, now: float) -> float:
+        cost = entry.cost / self.recent_boost if entry.recent else entry.cost
+        return cost - self.aging * (now - entry.submit_time)
+
+    def _ordered(self) -> list[_Entry]:
+        now = time.monotonic()
+        return sorted(self._waiting, key=lambda e: self._score(e, now))
+
+    def _next(self) -> Union[_Entry, None]:
+        running_large = sum(1 for e in self._running.values()
+                            if e.cost >= self.large_seconds)
+        large_allowed = self.workers <= 1 or \
+            running_large < self.workers - 1
+        for entry in self._ordered():
+            if entry.cost < self.large_seconds or large_allowed:
+                return entry
+        return None
+
+    def status(self, item: Any) -> Union[Dict[str, Any], None]:
+        """
+        Returns:
+        - Queue position of a waiting job, 0 for a running job, and estimated
+            seconds until it is parsed. None if the job is not in scheduler.
+        """
+        with self._cond:
+            now = time.monotonic()
+            # remaining seconds of running jobs
+            busy = sum(
+                max(0, e.cost - (now - e.start_time))
+                for e in self._running.values())
+            entry = self._running.get(id(item))
+            if entry is not None:
+                return {
+                    'position': 0,
+                    'eta_seconds': max(0, entry.cost - (now - entry.start_time)),
+                }
+
+            ahead = 0
+            for i, entry in enumerate(self._ordered()):
+                if entry.item is item:
+                    return {
+                        'position': i + 1,
+                        'eta_seconds': (busy + ahead) / max(1, self.workers) +
+                        entry.cost,
+                    }
+                ahead += entry.cost
+        return None
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._waiting)
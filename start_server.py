@@ -2,6 +2,7 @@ import logging
 import traceback
 import os
 import time
+import threading
 
 from flask import Flask
 from watchdog.observers import Observer
@@ -9,6 +10,8 @@ from watchdog.observers import Observer
 import config
 from rag.document import FileHandler, initial_file_process
 from rag.db import create_milvus_collection, create_sqlite_table
+from rag.pipeline import get_path_debouncer
+from rag.poller import DirectoryPoller
 
 if __name__ == '__main__':
     # set up db
@@ -22,20 +25,43 @@ if __name__ == '__main__':
         table_name=config.SQLITE_DOCUMENT_TABLE_NAME,
     )
 
-    # initial file direcory process
-    initial_file_process(config.RAG_FILE_DIR)
-
     # start file monitor
-    event_handler = FileHandler()
-    observer = Observer()
-    observer.schedule(event_handler, config.RAG_FILE_DIR, recursive=False)
-    observer.start()
+    polling = config.FILE_WATCH_POLLING
+    if not polling:
+        event_handler = FileHandler()
+        observer = Observer()
+        observer.schedule(event_handler, config.RAG_FILE_DIR, recursive=True)
+        try:
+            observer.start()
+        except OSError as e:
+            # e.g., inotify watch limit reached by a large directory tree
+            logging.info(f'fail to watch file events, fallback to polling: {e}')
+            polling = True
+    if polling:
+        poller = DirectoryPoller(
+            file_dir=config.RAG_FILE_DIR,
+            debouncer=get_path_debouncer(),
+            min_interval=config.FILE_WATCH_POLL_MIN_SECONDS,
+            max_interval=config.FILE_WATCH_POLL_MAX_SECONDS,
+            stat_batch=config.FILE_WATCH_POLL_STAT_BATCH,
+        )
+        poller.start()
+
+    # initial file directory process, in background so that the server is up
+    # while jobs of a large directory wait for the pipeline.
+    threading.Thread(
+        target=initial_file_process,
+        args=(config.RAG_FILE_DIR, ),
+        name='initial_file_process',
+        daemon=True,
+    ).start()
 
     # http server
     # NOTE: debug=True cause milvus start failure, no idea why.
     app = Flask(__name__)
-    from rag import rag_server
+    from rag import rag_server, document_server
     app.register_blueprint(rag_server.bp)
+    app.register_blueprint(document_server.bp)
     app.run(
         debug=False,
         host='0.0.0.0',
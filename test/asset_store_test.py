@@ -0,0 +1,115 @@
+import unittest
+import os
+import tempfile
+
+
+class TestAssetStore(unittest.TestCase):
+
+    def test_put_and_gc(self):
+        from parse.asset_store import AssetStore
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = AssetStore(root_dir=os.path.join(temp_dir, 'assets'),
+                               gc_grace_seconds=0)
+            src_a = os.path.join(temp_dir, 'a.png')
+            src_b = os.path.join(temp_dir, 'b.png')
+            for p in [src_a, src_b]:
+                with open(p, 'wb') as f:
+                    f.write(b'same image bytes')
+
+            # same content is stored once, source file is kept
+            path_a = store.put(src_a)
+            path_b = store.put(src_b)
+            self.assertEqual(path_a, path_b)
+            self.assertTrue(os.path.exists(src_a))
+            with open(path_a, 'rb') as f:
+                self.assertEqual(f.read(), b'same image bytes')
+
+            # asset is deleted when the last reference is released
+            store.add_refs({'chunk_1': path_a, 'chunk_2': path_b})
+            self.assertEqual(store.release(['chunk_1']), 0)
+            self.assertEqual(store.gc(), 0)
+            self.assertTrue(os.path.exists(path_a))
+            self.assertEqual(store.release(['chunk_2', 'unknown']), 1)
+            self.assertEqual(store.gc(), 1)
+            self.assertFalse(os.path.exists(path_a))
+
+            # orphan referenced again is not deleted
+            path_a = store.put(src_a)
+            store.add_refs({'chunk_1': path_a})
+            store.release(['chunk_1'])
+            store.add_refs({'chunk_3': path_a})
+            self.assertEqual(store.gc(), 0)
+            self.assertTrue(os.path.exists(path_a))
+
+            # orphan within grace period is kept
+            store.gc_grace_seconds = 3600
+            store.release(['chunk_3'])
+            self.assertEqual(store.gc(), 0)
+            self.assertTrue(os.path.exists(path_a))
+
+    def test_gc_unreferenced(self):
+        from parse.asset_store import AssetStore
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = AssetStore(root_dir=os.path.join(temp_dir, 'assets'),
+                               gc_grace_seconds=3600)
+            src = os.path.join(temp_dir, 'a.png')
+            with open(src, 'wb') as f:
+                f.write(b'image of a failed job')
+
+            # asset put but never referenced, e.g., its job failed
+            path = store.put(src)
+            self.assertEqual(store.gc(), 0)
+            self.assertTrue(os.path.exists(path))
+            store.gc_grace_seconds = 0
+            self.assertEqual(store.gc(), 1)
+            self.assertFalse(os.path.exists(path))
+
+            # referenced asset put again is not an orphan
+            path = store.put(src)
+            store.add_refs({'chunk_1': path})
+            store.put(src)
+            self.assertEqual(store.gc(), 0)
+            self.assertTrue(os.path.exists(path))
+
+            # orphans survive restart
+            store.release(['chunk_1'])
+            store.gc_grace_seconds = 3600
+            self.assertEqual(store.gc(), 0)
+            store = AssetStore(root_dir=os.path.join(temp_dir, 'assets'),
+                               gc_grace_seconds=0)
+            self.assertEqual(store.gc(), 1)
+
+    def test_image_chunk(self):
+        from parse.pdf_parser import PDFParser
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.makedirs(os.path.join(temp_dir, 'images'))
+            with open(os.path.join(temp_dir, 'images', 'fig.jpg'), 'wb') as f:
+                f.write(b'image bytes')
+
+            parser = PDFParser()
+            parser.file_name = 'test.pdf'
+            chunks = parser.process_image_blocks(
+                image_blocks=[{
+                    'type': 'image',
+                    'img_path': 'images/fig.jpg',
+                    'img_caption': ['figure 1'],
+                }],
+                temp_asset_dir=temp_dir,
+                asset_save_dir=os.path.join(temp_dir, 'assets'),
+            )
+            self.assertEqual(len(chunks), 1)
+            # chunk keeps a reference instead of image bytes
+            self.assertNotEqual(chunks[0].content, b'image bytes')
+            self.assertTrue(
+                chunks[0].content_url.startswith(
+                    os.path.join(temp_dir, 'assets')))
+            with open(chunks[0].content_url, 'rb') as f:
+                self.assertEqual(f.read(), b'image bytes')
+
+
+if __name__ == '__main__':
+
+    unittest.main()
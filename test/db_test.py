@@ -16,12 +16,13 @@ class TestMilvusDB(unittest.TestCase):
 
         from rag.db import get_vector_db
         from start_server import create_milvus_collection
+        from test.helper import use_mock_embed_model
 
         dense_embed_dim = 10
         collection_name = 'test_milvus_collection'
 
         # mock embed func
-        config.EMBED_MODEL_NAME = 'mock_for_test'
+        use_mock_embed_model()
 
         # create collection
         config.MILVUS_DB_NAME = './test_milvus.db'
@@ -74,6 +75,39 @@ class TestMilvusDB(unittest.TestCase):
         )
         self.assertTrue(len(ret) == 0)
 
+    def test_insert_many(self):
+        from rag.db import get_vector_db
+        from test.helper import setup_test_db
+
+        setup_test_db()
+        db = get_vector_db()
+
+        chunks = [
+            Chunk(
+                content_type=config.ChunkType.TEXT,
+                file_name='fake_file_name',
+                content=f'bulk chunk {i}'.encode('utf-8'),
+                extra_description=''.encode('utf-8'),
+            ) for i in range(5)
+        ]
+
+        # small batch size to force multiple batches
+        batch_size = config.EMBED_BATCH_SIZE
+        config.EMBED_BATCH_SIZE = 2
+        batches = db.split_batches(chunks)
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+        inserted = db.insert_many(chunks)
+        self.assertEqual(inserted, [True] * 5)
+
+        uuids = [chunk.uuid for chunk in chunks]
+        ret = db.get(keys=uuids)
+        self.assertEqual(len(ret), 5)
+
+        delete_cnt = db.delete(keys=uuids)
+        self.assertEqual(delete_cnt, 5)
+        config.EMBED_BATCH_SIZE = batch_size
+
 
 class TestSQLiteDB(unittest.TestCase):
 
@@ -112,6 +146,7 @@ class TestSQLiteDB(unittest.TestCase):
             'chunks': chunks,
             'created_date': now_in_utc(),
             'content_hash': get_hash64('test'.encode('utf-8')),
+            'fingerprint': '4:1700000000000000000:42',
         }
 
         insert_cnt = db.insert_document(data=data)
@@ -123,6 +158,7 @@ class TestSQLiteDB(unittest.TestCase):
         self.assertEqual(ret['chunks'], chunks)
         self.assertEqual(ret['content_hash'],
                          get_hash64('test'.encode('utf-8')))
+        self.assertEqual(ret['fingerprint'], '4:1700000000000000000:42')
 
         # delete
         delete_cnt = db.delete_document(name=file_name)
@@ -130,6 +166,38 @@ class TestSQLiteDB(unittest.TestCase):
         ret = db.get_document(name=file_name)
         self.assertTrue(ret is None)
 
+    def test_concurrent_insert(self, ):
+        from concurrent.futures import ThreadPoolExecutor
+
+        from rag.db import get_rational_db
+        from utils import now_in_utc
+        from start_server import create_sqlite_table
+
+        config.SQLITE_DB_NAME = './test_sql_lite.db'
+        config.SQLITE_DOCUMENT_TABLE_NAME = 'document'
+        create_sqlite_table(
+            conn_url=config.SQLITE_DB_NAME,
+            table_name=config.SQLITE_DOCUMENT_TABLE_NAME,
+        )
+        db = get_rational_db()
+
+        def _insert(i: int):
+            return db.insert_document({
+                'name': f'concurrent_{i % 4}.md',
+                'chunks': str(i),
+                'created_date': now_in_utc(),
+                'content_hash': str(i),
+            })
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            self.assertEqual(sum(executor.map(_insert, range(200))), 200)
+
+        # one record per name, never duplicated by racing inserts
+        names = [n for n in db.get_all_documents() if n.startswith('concurrent_')]
+        self.assertCountEqual(names, [f'concurrent_{i}.md' for i in range(4)])
+        for i in range(4):
+            db.delete_document(name=f'concurrent_{i}.md')
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,111 @@
+import unittest
+import io
+import time
+import os
+import tempfile
+
+
+class TestDocumentServer(unittest.TestCase):
+
+    def test_upload_path(self):
+        import config
+        from rag.document_server import upload_path
+
+        root = config.RAG_FILE_DIR
+        self.assertEqual(upload_path('a.pdf'), os.path.join(root, 'a.pdf'))
+        self.assertEqual(upload_path('b/a.pdf', dir_name='c'),
+                         os.path.join(root, 'c', 'b', 'a.pdf'))
+        self.assertEqual(upload_path('../../etc/a.pdf'),
+                         os.path.join(root, 'etc', 'a.pdf'))
+        self.assertEqual(upload_path('..\\a.pdf'), os.path.join(root, 'a.pdf'))
+        self.assertTrue(upload_path('a/..') is None)
+        self.assertTrue(upload_path('') is None)
+
+    def test_upload(self):
+        import config
+        import rag.pipeline as pipeline_module
+        from flask import Flask
+        from rag.db import get_rational_db
+        from rag.pipeline import IngestionPipeline, PathDebouncer, JobType
+        from rag.job_store import JobStore
+        from rag.document_server import bp
+        from test.helper import setup_test_db
+
+        setup_test_db()
+        sql_db = get_rational_db()
+
+        app = Flask(__name__)
+        app.register_blueprint(bp)
+        client = app.test_client()
+
+        rag_file_dir = config.RAG_FILE_DIR
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config.RAG_FILE_DIR = os.path.join(temp_dir, 'files')
+            job_store = JobStore(
+                db_path=os.path.join(temp_dir, 'jobs', 'jobs.db'),
+                checkpoint_dir=os.path.join(temp_dir, 'jobs', 'checkpoint'))
+            pipeline = IngestionPipeline(hash_workers=1,
+                                         parse_workers=1,
+                                         queue_size=2,
+                                         job_store=job_store)
+            debouncer = PathDebouncer(pipeline=pipeline, settle_seconds=0.1)
+            pipeline_module._ingestion_pipeline = pipeline
+            pipeline_module._path_debouncer = debouncer
+            try:
+                files = [
+                    (io.BytesIO(b'uploaded file with enough words'),
+                     'upload_a.md'),
+                    (io.BytesIO(b'uploaded file in sub directory'),
+                     'sub/upload_b.md'),
+                    (io.BytesIO(b'not supported'), 'upload_c.exe'),
+                ]
+                resp = client.post('/documents',
+                                   data={'files': files},
+                                   content_type='multipart/form-data')
+                self.assertEqual(resp.status_code, 200)
+                data = resp.get_json()['data']
+                self.assertEqual([j['file_name'] for j in data['jobs']],
+                                 ['upload_a.md', 'sub/upload_b.md'])
+                self.assertEqual([e['file_name'] for e in data['errors']],
+                                 ['upload_c.exe'])
+                # no temporary file left
+                self.assertEqual(sorted(os.listdir(config.RAG_FILE_DIR)),
+                                 ['sub', 'upload_a.md'])
+
+                self.assertTrue(pipeline.wait_idle(timeout=120))
+                job_ids = [j['job_id'] for j in data['jobs']]
+                resp = client.get(f'/documents/jobs/{job_ids[0]}')
+                self.assertEqual(resp.get_json()['data']['status'], 'done')
+                resp = client.get('/documents/jobs?ids=' +
+                                  ','.join(str(i) for i in job_ids + [-1]))
+                statuses = resp.get_json()['data']['jobs']
+                self.assertEqual([s['status'] for s in statuses[:2]],
+                                 ['done', 'done'])
+                self.assertTrue(statuses[2] is None)
+                self.assertEqual(client.get('/documents/jobs/0').status_code,
+                                 404)
+
+                for name in ['upload_a.md', 'sub/upload_b.md']:
+                    self.assertTrue(sql_db.get_document(name=name) is not None)
+                # file events of uploaded files are not submitted again
+                finished = len(pipeline._finished)
+                for name in ['upload_a.md', 'sub/upload_b.md']:
+                    debouncer.submit(JobType.NEW,
+                                     os.path.join(config.RAG_FILE_DIR, name))
+                time.sleep(0.5)
+                self.assertTrue(pipeline.wait_idle(timeout=120))
+                self.assertEqual(len(pipeline._finished), finished)
+
+                for name in ['upload_a.md', 'sub/upload_b.md']:
+                    pipeline.submit(JobType.DELETE,
+                                    os.path.join(config.RAG_FILE_DIR, name))
+                self.assertTrue(pipeline.wait_idle(timeout=120))
+            finally:
+                config.RAG_FILE_DIR = rag_file_dir
+                pipeline_module._ingestion_pipeline = None
+                pipeline_module._path_debouncer = None
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,173 @@
+import unittest
+import os
+import tempfile
+
+import config
+
+
+def get_test_rational_db():
+    from rag.db import get_rational_db
+    from start_server import create_sqlite_table
+
+    config.SQLITE_DB_NAME = './test_sql_lite.db'
+    config.SQLITE_DOCUMENT_TABLE_NAME = 'document'
+    create_sqlite_table(
+        conn_url=config.SQLITE_DB_NAME,
+        table_name=config.SQLITE_DOCUMENT_TABLE_NAME,
+    )
+    return get_rational_db()
+
+
+class TestDocument(unittest.TestCase):
+
+    def test_check_file_change(self):
+        from rag.document import check_file_change
+        from utils import now_in_utc
+
+        db = get_test_rational_db()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'check_file_change.txt')
+            with open(file_path, 'w') as f:
+                f.write('file content')
+
+            # new file
+            file_change = check_file_change(file_path)
+            self.assertTrue(file_change is not None)
+            content_hash, fingerprint = file_change
+            db.insert_document({
+                'name': os.path.basename(file_path),
+                'chunks': '',
+                'created_date': now_in_utc(),
+                'content_hash': content_hash,
+                'fingerprint': fingerprint,
+            })
+
+            # fingerprint unchanged
+            self.assertTrue(check_file_change(file_path) is None)
+
+            # touched, content unchanged, fingerprint is refreshed
+            os.utime(file_path, ns=(1, 1))
+            self.assertTrue(check_file_change(file_path) is None)
+            record = db.get_document(name=os.path.basename(file_path))
+            self.assertNotEqual(record['fingerprint'], fingerprint)
+
+            # content changed
+            with open(file_path, 'w') as f:
+                f.write('file content changed')
+            file_change = check_file_change(file_path)
+            self.assertTrue(file_change is not None)
+            self.assertNotEqual(file_change[0], content_hash)
+
+            db.delete_document(name=os.path.basename(file_path))
+
+    def test_reconcile_file_dir(self):
+        from rag.document import reconcile_file_dir
+        from utils import now_in_utc, get_hash64, get_file_fingerprint
+
+        db = get_test_rational_db()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+
+            def _write(name: str, content: str) -> str:
+                file_path = os.path.join(temp_dir, name)
+                with open(file_path, 'w') as f:
+                    f.write(content)
+                return file_path
+
+            def _save(name: str, content: str, fingerprint: str):
+                db.insert_document({
+                    'name': name,
+                    'chunks': '',
+                    'created_date': now_in_utc(),
+                    'content_hash': get_hash64(content.encode('utf-8')),
+                    'fingerprint': fingerprint,
+                })
+
+            # unchanged
+            p = _write('reconcile_a.txt', 'a')
+            _save('reconcile_a.txt', 'a', get_file_fingerprint(os.stat(p)))
+            # touched only
+            _write('reconcile_b.txt', 'b')
+            _save('reconcile_b.txt', 'b', 'stale')
+            # content changed
+            _write('reconcile_c.txt', 'c changed')
+            _save('reconcile_c.txt', 'c', 'stale')
+            # new file
+            _write('reconcile_d.txt', 'd')
+            # ignored file
+            _write('.reconcile_hidden.txt', 'hidden')
+            # deleted file
+            _save('reconcile_e.txt', 'e', 'stale')
+
+            to_process, to_delete = reconcile_file_dir(temp_dir)
+            self.assertEqual(sorted(os.path.basename(p) for p in to_process),
+                             ['reconcile_c.txt', 'reconcile_d.txt'])
+            self.assertTrue(
+                os.path.join(temp_dir, 'reconcile_e.txt') in to_delete)
+            self.assertFalse(
+                os.path.join(temp_dir, 'reconcile_a.txt') in to_delete)
+
+            record = db.get_document(name='reconcile_b.txt')
+            self.assertNotEqual(record['fingerprint'], 'stale')
+
+            for name in 'abce':
+                db.delete_document(name=f'reconcile_{name}.txt')
+
+    def test_reconcile_file_tree(self):
+        from rag.document import (reconcile_file_dir, get_document_name,
+                                  get_document_paths, parse_file)
+        from utils import now_in_utc
+
+        db = get_test_rational_db()
+
+        rag_file_dir = config.RAG_FILE_DIR
+        with tempfile.TemporaryDirectory() as temp_dir:
+            config.RAG_FILE_DIR = temp_dir
+            try:
+                paths = []
+                for d in ['tree_a', 'tree_b', os.path.join('tree_b', 'c')]:
+                    os.makedirs(os.path.join(temp_dir, d), exist_ok=True)
+                    file_path = os.path.join(temp_dir, d, 'same_name.txt')
+                    with open(file_path, 'w') as f:
+                        f.write('same content with enough words')
+                    paths.append(file_path)
+                hidden_dir = os.path.join(temp_dir, '.hidden')
+                os.makedirs(hidden_dir)
+                with open(os.path.join(hidden_dir, 'hidden.txt'), 'w') as f:
+                    f.write('hidden')
+
+                # keyed by relative path, same named files do not collide
+                names = [get_document_name(p) for p in paths]
+                self.assertEqual(names, [
+                    'tree_a/same_name.txt', 'tree_b/same_name.txt',
+                    'tree_b/c/same_name.txt'
+                ])
+                self.assertEqual(
+                    len(set(parse_file(p)[0].uuid for p in paths)), 3)
+
+                db.insert_document({
+                    'name': 'tree_b/c/deleted.txt',
+                    'chunks': '',
+                    'created_date': now_in_utc(),
+                    'content_hash': '',
+                    'fingerprint': '',
+                })
+                to_process, to_delete = reconcile_file_dir(temp_dir)
+                self.assertEqual(sorted(to_process), sorted(paths))
+                deleted_path = os.path.join(temp_dir, 'tree_b', 'c',
+                                            'deleted.txt')
+                self.assertTrue(deleted_path in to_delete)
+                self.assertEqual(
+                    get_document_paths(os.path.join(temp_dir, 'tree_b')),
+                    [deleted_path])
+                self.assertEqual(
+                    get_document_paths(os.path.join(temp_dir, 'tree')), [])
+                db.delete_document(name='tree_b/c/deleted.txt')
+            finally:
+                config.RAG_FILE_DIR = rag_file_dir
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import tempfile
+import numpy as np
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def test_cached_encode(self):
+        from rag import MockEmbedingModel
+        from rag.embed_cache import EmbeddingCache, cached_encode
+        import rag.embed_cache as embed_cache
+
+        embed_model = MockEmbedingModel(dense_embed_dim=4)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            embed_cache._embed_caches['mock_cache_test'] = EmbeddingCache(
+                cache_dir=temp_dir, max_bytes=1024)
+
+            texts = ['text 1', 'text 2', 'text 1']
+            first = cached_encode(embed_model, 'mock_cache_test', texts)
+            self.assertEqual(len(first['dense']), 3)
+            self.assertEqual(first['sparse'].shape, (3, 3))
+            np.testing.assert_allclose(first['dense'][0], first['dense'][2])
+
+            # mock model returns random dense vector, cached ones are reused
+            second = cached_encode(embed_model, 'mock_cache_test',
+                                   ['text 2', 'text 3'])
+            np.testing.assert_allclose(second['dense'][0], first['dense'][1])
+            np.testing.assert_allclose(second['sparse'].toarray()[0],
+                                       first['sparse'].toarray()[1])
+
+            # reopen from disk
+            cache = EmbeddingCache(cache_dir=temp_dir, max_bytes=1024)
+            keys = [r[0] for r in cache.conn.execute("SELECT key FROM entry")]
+            self.assertEqual(len(cache.get_many(keys)), 3)
+            del embed_cache._embed_caches['mock_cache_test']
+
+    def test_eviction(self):
+        from rag.embed_cache import EmbeddingCache
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # 2 dense rows of dim 4
+            cache = EmbeddingCache(cache_dir=temp_dir, max_bytes=32)
+
+            def _entry(v: float):
+                return (np.full(4, v), np.array([0, 2]), np.array([v, v]))
+
+            cache.put_many({'a': _entry(1), 'b': _entry(2)}, sparse_dim=3)
+            cache.get_many(['a'])
+            cache.put_many({'c': _entry(3)}, sparse_dim=3)
+
+            entries = cache.get_many(['a', 'b', 'c'])
+            self.assertEqual(sorted(entries), ['a', 'c'])
+            np.testing.assert_allclose(entries['c'][0], np.full(4, 3))
+            np.testing.assert_allclose(entries['c'][2], [3, 3])
+            self.assertEqual(list(entries['c'][1]), [0, 2])
+
+    def test_crash_during_put(self):
+        from rag.embed_cache import EmbeddingCache
+
+        class CrashConnection:
+            """
+            Fail when entries are inserted, i.e., after dense rows are written.
+            """
+
+            def __init__(self, conn):
+                self.conn = conn
+
+            def executemany(self, sql, *args):
+                if sql.startswith('INSERT INTO entry'):
+                    raise RuntimeError('crash')
+                return self.conn.executemany(sql, *args)
+
+            def __getattr__(self, name):
+                return getattr(self.conn, name)
+
+        def _entry(v: float):
+            return (np.full(4, v), np.array([0]), np.array([v]))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = EmbeddingCache(cache_dir=temp_dir, max_bytes=32)
+            cache.put_many({'a': _entry(1), 'b': _entry(2)}, sparse_dim=3)
+            cache.get_many(['b'])
+
+            # 'a' is evicted and its row overwritten, then the process dies
+            # before entries are committed.
+            conn = cache.conn
+            cache.conn = CrashConnection(conn)
+            with self.assertRaises(RuntimeError):
+                cache.put_many({'c': _entry(3)}, sparse_dim=3)
+            conn.close()
+
+            cache = EmbeddingCache(cache_dir=temp_dir, max_bytes=32)
+            entries = cache.get_many(['a', 'b', 'c'])
+            self.assertEqual(sorted(entries), ['b'])
+            np.testing.assert_allclose(entries['b'][0], np.full(4, 2))
+
+            # row changed behind the index is detected and dropped
+            slot = cache.conn.execute(
+                "SELECT slot FROM entry WHERE key = 'b'").fetchone()[0]
+            cache.dense[slot] = np.full(4, 3)
+            self.assertEqual(cache.get_many(['b']), {})
+            self.assertEqual(
+                cache.conn.execute("SELECT COUNT(*) FROM entry").fetchone()[0],
+                0)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,43 @@
+import atexit
+import shutil
+import tempfile
+
+import config
+
+_embed_cache_dir = None
+
+
+def use_mock_embed_model():
+    """
+    Embed with the mock model, cached in a temporary directory removed when
+    tests exit, so that tests never touch the embedding cache of a real model.
+    """
+    global _embed_cache_dir
+    if _embed_cache_dir is None:
+        _embed_cache_dir = tempfile.mkdtemp(prefix='test_embed_cache_')
+        atexit.register(shutil.rmtree, _embed_cache_dir, ignore_errors=True)
+    config.EMBED_MODEL_NAME = 'mock_for_test'
+    config.EMBED_CACHE_DIR = _embed_cache_dir
+
+
+def setup_test_db():
+    """
+    Point vector db and document db at test dbs and create them, embed with
+    the mock model, see `use_mock_embed_model`.
+    """
+    from start_server import create_milvus_collection, create_sqlite_table
+
+    use_mock_embed_model()
+    config.MILVUS_DB_NAME = './test_milvus.db'
+    config.MILVUS_COLLECTION_NAME = 'test_milvus_collection'
+    config.SQLITE_DB_NAME = './test_sql_lite.db'
+    config.SQLITE_DOCUMENT_TABLE_NAME = 'document'
+    create_milvus_collection(
+        conn_url=config.MILVUS_DB_NAME,
+        collection_name=config.MILVUS_COLLECTION_NAME,
+        dense_embed_dim=10,
+    )
+    create_sqlite_table(
+        conn_url=config.SQLITE_DB_NAME,
+        table_name=config.SQLITE_DOCUMENT_TABLE_NAME,
+    )
@@ -0,0 +1,90 @@
+import unittest
+import os
+import time
+import tempfile
+
+
+class TestParseWorkerPool(unittest.TestCase):
+
+    def test_run_and_recycle(self):
+        from rag.parse_worker import ParseWorkerPool
+
+        pool = ParseWorkerPool(target=range, max_tasks_per_child=2)
+        self.assertEqual(list(pool.run_iter(3, batch_size=8)), [[0, 1, 2]])
+        self.assertEqual(len(pool._idle_workers), 1)
+        worker = pool._idle_workers[0]
+
+        # second task reaches max tasks, worker is recycled
+        self.assertEqual(list(pool.run_iter(2, batch_size=8)), [[0, 1]])
+        self.assertEqual(len(pool._idle_workers), 0)
+        self.assertFalse(worker.process.is_alive())
+
+    def test_run_iter(self):
+        import itertools
+        from rag.parse_worker import ParseWorkerPool, ParseWorkerError
+
+        pool = ParseWorkerPool(target=range)
+        self.assertEqual(list(pool.run_iter(5, batch_size=2)),
+                         [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(pool.run_iter(0, batch_size=2)), [])
+        self.assertEqual(len(pool._idle_workers), 1)
+
+        # batches yielded before target exception are received, the worker
+        # is kept
+        pool = ParseWorkerPool(target=map)
+        batches = []
+        with self.assertRaises(Exception) as ctx:
+            for batch in pool.run_iter(int, ['1', '2', 'x'], batch_size=1):
+                batches.append(batch)
+        self.assertFalse(isinstance(ctx.exception, ParseWorkerError))
+        self.assertEqual(batches, [[1], [2]])
+        self.assertEqual(len(pool._idle_workers), 1)
+        self.assertEqual(list(pool.run_iter(int, ['3'], batch_size=1)), [[3]])
+        pool.close()
+
+        # worker of an unfinished task is killed when iteration stops
+        pool = ParseWorkerPool(target=itertools.count)
+        batches = pool.run_iter(0, batch_size=3)
+        self.assertEqual(next(batches), [0, 1, 2])
+        batches.close()
+        self.assertEqual(len(pool._idle_workers), 0)
+
+    def test_timeout_and_crash(self):
+        from rag.parse_worker import ParseWorkerPool, ParseWorkerError
+
+        pool = ParseWorkerPool(target=time.sleep, timeout=1)
+        start = time.time()
+        with self.assertRaises(ParseWorkerError):
+            list(pool.run_iter(60, batch_size=1))
+        self.assertLess(time.time() - start, 30)
+        self.assertEqual(len(pool._idle_workers), 0)
+
+        pool = ParseWorkerPool(target=os._exit)
+        with self.assertRaises(ParseWorkerError):
+            list(pool.run_iter(1, batch_size=1))
+        self.assertEqual(len(pool._idle_workers), 0)
+
+
+class TestParseQuarantine(unittest.TestCase):
+
+    def test_quarantine(self):
+        from rag.parse_worker import ParseQuarantine
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'quarantine.json')
+            quarantine = ParseQuarantine(path=path)
+            self.assertFalse(quarantine.contains('/a/b.pdf', 'hash'))
+
+            quarantine.add('/a/b.pdf', 'hash', 'timeout')
+            self.assertTrue(quarantine.contains('/a/b.pdf', 'hash'))
+            # changed content is not quarantined
+            self.assertFalse(quarantine.contains('/a/b.pdf', 'new hash'))
+
+            # entries survive restart
+            quarantine = ParseQuarantine(path=path)
+            self.assertTrue(quarantine.contains('/a/b.pdf', 'hash'))
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -70,14 +70,17 @@ class TestPDFParser(unittest.TestCase):
         self.assertEqual(content, 'test\n\nblock 1')
 
     def test_parser_chunk(self):
+        from parse.chunker import TokenChunker
+
         content_list = [
             {
                 'type': 'text',
-                'text': '1'
+                'text': 'Title one',
+                'text_level': 1
             },
             {
                 'type': 'text',
-                'text': '2'
+                'text': 'a b. c d.'
             },
             {
                 'type': 'table',
@@ -86,19 +89,16 @@ class TestPDFParser(unittest.TestCase):
             },
             {
                 'type': 'text',
-                'text': '3'
-            },
-            {
-                'type': 'text',
-                'text': '4'
+                'text': 'e f g h'
             },
             {
                 'type': 'text',
-                'text': '5'
+                'text': 'Title two',
+                'text_level': 1
             },
             {
                 'type': 'text',
-                'text': '6'
+                'text': 'i j k l m n o p q r'
             },
             {
                 'type': 'table',
@@ -106,19 +106,21 @@ class TestPDFParser(unittest.TestCase):
                 'table_body': ''
             },
         ]
+        # one word as one token
         parser = PDFParser()
-        parser.consecutive_block_num = 4
-        parser.block_overlap_num = 1
+        chunker = parser.chunker
+        parser.chunker = TokenChunker(min_tokens=4,
+                                      max_tokens=8,
+                                      overlap_tokens=2,
+                                      count_tokens=lambda t: len(t.split()))
         parser.file_name = '/fake/path'
 
-        chunks = parser.chunk(content_list=content_list,
-                              temp_asset_dir='',
-                              asset_save_dir='')
-
-        # print('=' * 80)
-        # for chunk in chunks:
-        #     print(chunk)
-        #     print('=' * 80)
+        try:
+            chunks = parser.chunk(content_list=content_list,
+                                  temp_asset_dir='',
+                                  asset_save_dir='')
+        finally:
+            parser.chunker = chunker
 
         # should have 2 table chunk
         table_chunks = [
@@ -130,22 +132,59 @@ class TestPDFParser(unittest.TestCase):
         self.assertEqual(table_chunks[1].extra_description.decode('utf-8'),
                          'table 2')
 
-        # should have 2 text chunk
         text_chunks = [
-            chunk for chunk in chunks if chunk.content_type == 'text'
+            chunk.content.decode('utf-8') for chunk in chunks
+            if chunk.content_type == 'text'
         ]
-        self.assertEqual(len(text_chunks), 2)
-        self.assertEqual(text_chunks[0].content.decode('utf-8'),
-                         '\n\n'.join(['1', '2', '3', '4']))
-        self.assertEqual(text_chunks[1].content.decode('utf-8'),
-                         '\n\n'.join(['4', '5', '6']))
+        self.assertEqual(
+            text_chunks,
+            [
+                # closed by max tokens
+                'Title one\n\na b. c d.',
+                # token overlap from previous chunk, closed at headline
+                'c d.\n\ne f g h',
+                # long block split to fill the chunk
+                'Title two\n\ni j k l m n',
+                'o p q r',
+            ])
+
+    def test_chunk_long_block(self):
+        from unittest import mock
+        import parse.chunker as chunker_module
+        from parse.chunker import TokenChunker
 
-        # # chunk 0
-        # self.assertTrue('h1' in str(chunks[0]) and 'p1' in str(chunks[0])
-        #                 and 'p2' in str(chunks[0]))
+        # record characters scanned for sentences
+        scanned = []
+        pattern = chunker_module._sentence_pattern
 
-        # # chunk 1
-        # self.assertTrue('h2' in str(chunks[1]))
+        class ScanPattern:
+
+            def findall(self, text):
+                scanned.append(len(text))
+                return pattern.findall(text)
+
+        sentences = [
+            f'sentence {i} ' + 'word ' * (i % 7) + ('.' if i % 5 else '')
+            for i in range(2000)
+        ]
+        text = ' '.join(sentences)
+        chunker = TokenChunker(min_tokens=10,
+                               max_tokens=20,
+                               overlap_tokens=0,
+                               count_tokens=lambda t: len(t.split()))
+        with mock.patch.object(chunker_module, '_sentence_pattern',
+                               ScanPattern()):
+            groups = list(
+                chunker.iter_groups([{
+                    'type': 'text',
+                    'text': text
+                }]))
+        self.assertGreater(len(groups), 100)
+        self.assertEqual(''.join(g[0]['text'] for g in groups), text)
+        for group in groups:
+            self.assertLessEqual(len(group[0]['text'].split()), 20)
+        # text is split once, not scanned again for every cut
+        self.assertLess(sum(scanned), 2 * len(text))
 
     def test_is_valid_block(self):
         parser = PDFParser()
@@ -164,6 +203,430 @@ class TestPDFParser(unittest.TestCase):
         pass
 
 
+class TestTextParser(unittest.TestCase):
+
+    def test_markdown_blocks(self):
+        import tempfile
+        from parse.text_parser import MarkdownParser
+
+        text = '\n'.join([
+            '---',
+            'title: front matter',
+            '---',
+            '# Title',
+            'paragraph 1 line 1',
+            'paragraph 1 line 2',
+            '',
+            '```python',
+            'code line 1',
+            '',
+            'code line 2',
+            '```',
+            '## Section ##',
+            'paragraph 2',
+        ])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'test.md')
+            with open(file_path, 'w') as f:
+                f.write(text)
+            blocks = list(MarkdownParser().iter_blocks(file_path))
+
+        self.assertEqual(blocks, [
+            {
+                'type': 'text',
+                'text': 'Title',
+                'text_level': 1
+            },
+            {
+                'type': 'text',
+                'text': 'paragraph 1 line 1\nparagraph 1 line 2'
+            },
+            {
+                'type': 'text',
+                'text': '```python\ncode line 1\n\ncode line 2\n```'
+            },
+            {
+                'type': 'text',
+                'text': 'Section',
+                'text_level': 2
+            },
+            {
+                'type': 'text',
+                'text': 'paragraph 2'
+            },
+        ])
+
+    def test_parse_iter(self):
+        import tempfile
+        from parse.text_parser import TextParser
+
+        paragraphs = [
+            f'paragraph {i} has enough words to keep' for i in range(100)
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'test.txt')
+            with open(file_path, 'w') as f:
+                f.write('\n\n'.join(paragraphs))
+
+            parser = TextParser()
+            chunks = parser.parse(file_path=file_path, asset_save_dir=temp_dir)
+            streamed = list(
+                parser.parse_iter(file_path=file_path,
+                                  asset_save_dir=temp_dir))
+        self.assertEqual([c.uuid for c in streamed], [c.uuid for c in chunks])
+
+        # blocks are pulled lazily, first chunk is yielded before the rest of
+        # blocks are produced.
+        pulled = []
+
+        def _blocks():
+            for i, text in enumerate(paragraphs):
+                pulled.append(i)
+                yield {'type': 'text', 'text': text}
+
+        parser.file_name = 'test.txt'
+        first = next(
+            parser.build_chunks_iter(blocks=_blocks(),
+                                     temp_asset_dir='',
+                                     asset_save_dir=''))
+        self.assertEqual(first.uuid, chunks[0].uuid)
+        self.assertLess(len(pulled), len(paragraphs))
+
+    def test_get_file_parser(self):
+        from parse import get_file_parser
+        from parse.text_parser import TextParser, MarkdownParser
+        from parse.docx_parser import DocxParser
+
+        self.assertTrue(isinstance(get_file_parser('/a/b.txt'), TextParser))
+        self.assertTrue(isinstance(get_file_parser('/a/b.MD'), MarkdownParser))
+        self.assertTrue(isinstance(get_file_parser('/a/b.docx'), DocxParser))
+        with self.assertRaises(Exception):
+            get_file_parser('/a/b.ppt')
+
+    def test_docx_parse(self):
+        import tempfile
+        import docx
+        from parse.docx_parser import DocxParser
+
+        document = docx.Document()
+        document.add_heading('Docx Title', level=1)
+        document.add_paragraph('docx paragraph with enough words to keep')
+        table = document.add_table(rows=1, cols=2)
+        table.rows[0].cells[0].text = 'a'
+        table.rows[0].cells[1].text = 'b'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'test.docx')
+            document.save(file_path)
+            parser = DocxParser()
+            blocks = list(parser.iter_blocks(file_path))
+            chunks = parser.parse(file_path=file_path, asset_save_dir='')
+
+        self.assertEqual(blocks[0], {
+            'type': 'text',
+            'text': 'Docx Title',
+            'text_level': 1
+        })
+        self.assertEqual(blocks[2]['table_body'],
+                         '<table><tr><td>a</td><td>b</td></tr></table>')
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[0].file_name, 'test.docx')
+
+
+class TestChunk(unittest.TestCase):
+
+    def test_serialize(self):
+        import io
+        import pickle
+        from parse.parser import write_chunks, read_chunks
+        from utils import get_hash64
+
+        chunks = [
+            Chunk(content_type=ChunkType.TEXT,
+                  file_name='测试.md',
+                  content='文本 text'.encode('utf-8'),
+                  extra_description=b''),
+            Chunk(content_type=ChunkType.IMAGE,
+                  file_name='test.pdf',
+                  content=b'abc.png',
+                  extra_description=b'figure 1',
+                  content_url='/assets/ab/abc.png'),
+        ]
+        # incremental hash is the same as hash of concatenated bytes
+        self.assertEqual(chunks[0].uuid,
+                         get_hash64('测试.md文本 text'.encode('utf-8')))
+
+        def _fields(chunk):
+            return (chunk.content_type, chunk.file_name, chunk.content,
+                    chunk.extra_description, chunk.content_url, chunk.uuid)
+
+        f = io.BytesIO()
+        self.assertEqual(write_chunks(f, chunks), 2)
+        f.seek(0)
+        loaded = list(read_chunks(f))
+        self.assertEqual([_fields(c) for c in loaded],
+                         [_fields(c) for c in chunks])
+        self.assertEqual(loaded[0].text, '文本 text')
+        self.assertEqual(loaded[1].description, 'figure 1')
+
+        loaded = pickle.loads(pickle.dumps(chunks))
+        self.assertEqual([_fields(c) for c in loaded],
+                         [_fields(c) for c in chunks])
+
+
+class TestParseCache(unittest.TestCase):
+
+    def test_file_and_page_entry(self):
+        import tempfile
+        from parse.parse_cache import ParseCache
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                tempfile.TemporaryDirectory() as temp_asset_dir:
+            cache = ParseCache(cache_dir=cache_dir)
+            self.assertTrue(cache.iter_file('content_hash') is None)
+            self.assertTrue(cache.get_page('page_hash') is None)
+            self.assertFalse(cache.has_page('page_hash'))
+
+            os.makedirs(os.path.join(temp_asset_dir, 'images'))
+            with open(os.path.join(temp_asset_dir, 'images', 'a.jpg'),
+                      'wb') as f:
+                f.write(b'image bytes')
+
+            blocks = [
+                {
+                    'type': 'text',
+                    'text': 'page text',
+                    'page_idx': 3
+                },
+                {
+                    'type': 'image',
+                    'img_path': 'images/a.jpg',
+                    'page_idx': 3
+                },
+            ]
+            saved = cache.put_page('page_hash', blocks, temp_asset_dir)
+            self.assertEqual(cache.get_page('page_hash'), saved)
+            self.assertEqual(saved[0]['page_idx'], 0)
+            with open(os.path.join(cache_dir, saved[1]['img_path']),
+                      'rb') as f:
+                self.assertEqual(f.read(), b'image bytes')
+
+            # empty page is cached as well
+            cache.put_page('empty_page_hash', [], temp_asset_dir)
+            self.assertEqual(cache.get_page('empty_page_hash'), [])
+
+            # file entry is written block by block, saved once committed
+            writer = cache.open_file('content_hash')
+            for block in saved:
+                writer.write(block)
+            self.assertTrue(cache.iter_file('content_hash') is None)
+            writer.commit()
+            writer.close()
+            self.assertEqual(list(cache.iter_file('content_hash')), saved)
+            # discarded if closed before commit
+            writer = cache.open_file('other_content_hash')
+            writer.write(saved[0])
+            writer.close()
+            self.assertTrue(cache.iter_file('other_content_hash') is None)
+            self.assertEqual(
+                [n for n in os.listdir(cache.file_dir) if n.startswith('.')],
+                [])
+
+            # entries parsed under other settings are never hit
+            other = ParseCache(cache_dir=cache_dir, config_key='other')
+            self.assertTrue(other.iter_file('content_hash') is None)
+            self.assertTrue(other.get_page('page_hash') is None)
+
+    def test_eviction(self):
+        import time
+        import tempfile
+        from parse.parse_cache import ParseCache
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                tempfile.TemporaryDirectory() as temp_asset_dir:
+            blocks = [{'type': 'text', 'text': 'x' * 1000, 'page_idx': 0}]
+            cache = ParseCache(cache_dir=cache_dir, max_bytes=5000)
+            for i in range(4):
+                cache.put_page(f'page_{i}', blocks, temp_asset_dir)
+                time.sleep(0.01)
+            # hit refreshes last used time
+            self.assertTrue(cache.get_page('page_0') is not None)
+            time.sleep(0.01)
+
+            # least recently used entries are evicted once size is exceeded
+            cache.put_page('page_4', blocks, temp_asset_dir)
+            self.assertTrue(cache.get_page('page_0') is not None)
+            self.assertTrue(cache.get_page('page_1') is None)
+            self.assertTrue(cache.get_page('page_4') is not None)
+            size = sum(
+                os.path.getsize(os.path.join(cache.page_dir, n))
+                for n in os.listdir(cache.page_dir))
+            self.assertTrue(size <= 5000)
+
+    def test_cached_pdf_parse(self):
+        import tempfile
+        import fitz
+        from parse.parse_cache import ParseCache
+
+        file_path = os.path.join(
+            get_project_base_directory(), 'assets', 'test',
+            'Batch Normalization Accelerating Deep Network Training by Reducing Internal Covariate Shift.pdf'
+        )
+        with open(file_path, 'rb') as f:
+            pdf_bytes = f.read()
+        parser = PDFParser()
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                tempfile.TemporaryDirectory() as temp_asset_dir:
+            cache = ParseCache(cache_dir=cache_dir)
+
+            def _parse():
+                return list(
+                    parser.iter_pdf_content_cached(
+                        file_path=file_path,
+                        temp_asset_dir=temp_asset_dir,
+                        pdf_bytes=pdf_bytes,
+                        parse_cache=cache,
+                        content_hash='content_hash'))
+
+            blocks = _parse()
+            page_count = fitz.open(stream=pdf_bytes, filetype='pdf').page_count
+            self.assertEqual(len(os.listdir(cache.page_dir)), page_count)
+            self.assertEqual(list(cache.iter_file('content_hash')), blocks)
+
+            # file entry missing, merged from page entries and parsed pages
+            os.remove(os.path.join(cache.file_dir, 'content_hash.jsonl'))
+            os.remove(
+                os.path.join(cache.page_dir,
+                             sorted(os.listdir(cache.page_dir))[0]))
+            self.assertEqual(_parse(), blocks)
+            self.assertEqual(list(cache.iter_file('content_hash')), blocks)
+
+    def test_page_hash(self):
+        import fitz
+        from parse.parse_cache import get_page_hash
+
+        def _xobject_doc(texts: list[str]):
+            src = fitz.open()
+            for text in texts:
+                src.new_page().insert_text((72, 72), text)
+            doc = fitz.open()
+            for i in range(len(texts)):
+                page = doc.new_page()
+                page.show_pdf_page(page.rect, src, i)
+            return doc
+
+        # pages drawing a form XObject share the same content stream
+        doc = _xobject_doc(['first page text', 'second page text'])
+        self.assertEqual(doc[0].read_contents(), doc[1].read_contents())
+        self.assertNotEqual(get_page_hash(doc, 0), get_page_hash(doc, 1))
+
+        # same page in another document has the same hash
+        other = _xobject_doc(['other page', 'second page text'])
+        memo = {}
+        self.assertEqual(get_page_hash(other, 1, memo),
+                         get_page_hash(doc, 1))
+        self.assertEqual(get_page_hash(other, 1, memo),
+                         get_page_hash(other, 1))
+
+
+class TestPDFTextLayer(unittest.TestCase):
+
+    def test_extract_text_page(self):
+        import tempfile
+        import fitz
+        from parse.pdf_text_layer import is_text_page, extract_page_blocks
+
+        file_path = os.path.join(
+            get_project_base_directory(), 'assets', 'test',
+            'Batch Normalization Accelerating Deep Network Training by Reducing Internal Covariate Shift.pdf'
+        )
+        doc = fitz.open(file_path)
+        self.assertTrue(is_text_page(doc[0]))
+
+        # blank page has no text layer
+        blank_doc = fitz.open()
+        blank_doc.new_page()
+        self.assertFalse(is_text_page(blank_doc[0]))
+
+        with tempfile.TemporaryDirectory() as temp_asset_dir:
+            blocks = extract_page_blocks(page=doc[0],
+                                         page_idx=0,
+                                         temp_asset_dir=temp_asset_dir)
+        self.assertTrue(len(blocks) > 0)
+        self.assertTrue(all(b['page_idx'] == 0 for b in blocks))
+        headlines = [b['text'] for b in blocks if 'text_level' in b]
+        self.assertIn('Abstract', headlines)
+
+    def test_sharded_parse(self):
+        import tempfile
+        import fitz
+
+        file_path = os.path.join(
+            get_project_base_directory(), 'assets', 'test',
+            'Batch Normalization Accelerating Deep Network Training by Reducing Internal Covariate Shift.pdf'
+        )
+        with open(file_path, 'rb') as f:
+            pdf_bytes = f.read()
+        doc = fitz.open(stream=pdf_bytes, filetype='pdf')
+        page_indices = list(range(doc.page_count))
+
+        parser = PDFParser()
+        shard_pages = config.PDF_PARSE_SHARD_PAGES
+        workers = config.PDF_PARSE_WORKERS
+        # (shard pages, workers): no sharding, sequential, parallel
+        settings = [(0, 1), (3, 1), (3, 2)]
+        results = []
+        split = []
+        try:
+            for config.PDF_PARSE_SHARD_PAGES, config.PDF_PARSE_WORKERS in settings:
+                parser.timer.reset()
+                with tempfile.TemporaryDirectory() as temp_asset_dir:
+                    results.append(
+                        dict(
+                            parser.iter_pdf_pages(
+                                file_path=file_path,
+                                temp_asset_dir=temp_asset_dir,
+                                pdf_bytes=pdf_bytes,
+                                doc=doc,
+                                page_indices=page_indices)))
+                split.append('split_shards' in parser.timer.timings)
+        finally:
+            config.PDF_PARSE_SHARD_PAGES = shard_pages
+            config.PDF_PARSE_WORKERS = workers
+
+        self.assertEqual(sorted(results[0]), page_indices)
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+        # shards are only copied into sub documents for parallel workers
+        self.assertEqual(split, [False, False, True])
+
+
+class TestParseTimings(unittest.TestCase):
+
+    def test_parse_step_timings(self):
+        import tempfile
+
+        file_path = os.path.join(
+            get_project_base_directory(), 'assets', 'test',
+            'Batch Normalization Accelerating Deep Network Training by Reducing Internal Covariate Shift.pdf'
+        )
+        parser = PDFParser()
+        cache_enable = config.PARSE_CACHE_ENABLE
+        config.PARSE_CACHE_ENABLE = False
+        try:
+            with tempfile.TemporaryDirectory() as asset_save_dir:
+                chunks = parser.parse(file_path=file_path,
+                                      asset_save_dir=asset_save_dir)
+        finally:
+            config.PARSE_CACHE_ENABLE = cache_enable
+
+        self.assertTrue(len(chunks) > 0)
+        # text layer pages only, no model step
+        self.assertIn('text_layer_extract', parser.timer.timings)
+        self.assertNotIn('analyze', parser.timer.timings)
+
+
 if __name__ == '__main__':
 
     unittest.main()
@@ -0,0 +1,394 @@
+import unittest
+import os
+import time
+import tempfile
+
+
+class RecordPipeline:
+    """
+    Record submitted jobs instead of running them.
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, job_type, file_path, src_path=None):
+        if src_path is None:
+            self.jobs.append((job_type, file_path))
+        else:
+            self.jobs.append((job_type, file_path, src_path))
+
+
+class TestPathDebouncer(unittest.TestCase):
+
+    def test_coalesce(self):
+        from rag.pipeline import PathDebouncer, JobType
+
+        pipeline = RecordPipeline()
+        debouncer = PathDebouncer(pipeline=pipeline, settle_seconds=0.2)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'test.txt')
+            # file being written, events keep coming
+            for i in range(5):
+                with open(file_path, 'a') as f:
+                    f.write(f'line {i}\n')
+                debouncer.submit(JobType.NEW, file_path)
+                time.sleep(0.05)
+            self.assertEqual(pipeline.jobs, [])
+
+            time.sleep(0.5)
+            self.assertEqual(pipeline.jobs, [(JobType.NEW, file_path)])
+
+            # delete supersedes pending new file event
+            debouncer.submit(JobType.NEW, file_path)
+            debouncer.submit(JobType.DELETE, file_path)
+            time.sleep(0.5)
+            self.assertEqual(pipeline.jobs[1:], [(JobType.DELETE, file_path)])
+
+    def test_coalesce_move(self):
+        from rag.pipeline import PathDebouncer, JobType
+
+        pipeline = RecordPipeline()
+        debouncer = PathDebouncer(pipeline=pipeline, settle_seconds=0.2)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            a, b, c = [os.path.join(temp_dir, f'{n}.txt') for n in 'abc']
+            with open(c, 'w') as f:
+                f.write('content')
+
+            # moved twice then modified, still a move from the first source
+            debouncer.submit(JobType.NEW, a)
+            debouncer.submit(JobType.MOVE, b, src_path=a)
+            debouncer.submit(JobType.MOVE, c, src_path=b)
+            debouncer.submit(JobType.NEW, c)
+            time.sleep(0.5)
+            self.assertEqual(pipeline.jobs, [(JobType.MOVE, c, a)])
+
+            # move target deleted, move source is deleted as well
+            debouncer.submit(JobType.MOVE, c, src_path=a)
+            debouncer.submit(JobType.DELETE, c)
+            time.sleep(0.5)
+            self.assertEqual(sorted(pipeline.jobs[1:]),
+                             sorted([(JobType.DELETE, a),
+                                     (JobType.DELETE, c)]))
+
+
+class TestIngestionPipeline(unittest.TestCase):
+
+    def test_ingest_markdown(self):
+        from rag.db import get_vector_db, get_rational_db
+        from rag.pipeline import IngestionPipeline, JobType
+        from rag.job_store import JobStore
+        from rag.document import parse_file
+        from test.helper import setup_test_db
+
+        setup_test_db()
+        vector_db = get_vector_db()
+        sql_db = get_rational_db()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job_store = JobStore(
+                db_path=os.path.join(temp_dir, 'jobs', 'jobs.db'),
+                checkpoint_dir=os.path.join(temp_dir, 'jobs', 'checkpoint'))
+            pipeline = IngestionPipeline(hash_workers=2,
+                                         parse_workers=1,
+                                         queue_size=2,
+                                         job_store=job_store)
+            file_path = os.path.join(temp_dir, 'pipeline_test.md')
+            paragraphs = [
+                f'paragraph {i} has enough words to keep' for i in range(100)
+            ]
+            with open(file_path, 'w') as f:
+                f.write('\n\n'.join(paragraphs))
+
+            pipeline.submit(JobType.NEW, file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            record = sql_db.get_document(name='pipeline_test.md')
+            uuids = record['chunks'].split('\x07')
+            self.assertEqual(len(vector_db.get(keys=uuids)), len(uuids))
+
+            # edit last paragraph, only trailing chunk changes
+            paragraphs[-1] = 'last paragraph is edited with enough words'
+            with open(file_path, 'w') as f:
+                f.write('\n\n'.join(paragraphs))
+            pipeline.submit(JobType.NEW, file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            record = sql_db.get_document(name='pipeline_test.md')
+            new_uuids = record['chunks'].split('\x07')
+            self.assertEqual(new_uuids[:-1], uuids[:-1])
+            self.assertNotEqual(new_uuids[-1], uuids[-1])
+            self.assertEqual(len(vector_db.get(keys=[uuids[-1]])), 0)
+
+            # rename, chunks are moved to uuids of the new name
+            moved_path = os.path.join(temp_dir, 'pipeline_moved.md')
+            os.rename(file_path, moved_path)
+            pipeline.submit(JobType.MOVE, moved_path, src_path=file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            self.assertTrue(sql_db.get_document(name='pipeline_test.md') is None)
+            record = sql_db.get_document(name='pipeline_moved.md')
+            moved_uuids = record['chunks'].split('\x07')
+            self.assertEqual(
+                moved_uuids,
+                [chunk.uuid for chunk in parse_file(moved_path)])
+            self.assertEqual(len(vector_db.get(keys=moved_uuids)),
+                             len(moved_uuids))
+            self.assertEqual(len(vector_db.get(keys=new_uuids)), 0)
+
+            pipeline.submit(JobType.DELETE, moved_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            self.assertTrue(
+                sql_db.get_document(name='pipeline_moved.md') is None)
+            self.assertEqual(len(vector_db.get(keys=moved_uuids)), 0)
+            # committed jobs and checkpoints are deleted
+            self.assertEqual(job_store.unfinished(), [])
+            self.assertEqual(os.listdir(job_store.checkpoint_dir), [])
+
+    def test_ingest_in_ranges(self):
+        import config
+        from rag.db import get_vector_db, get_rational_db
+        from rag.pipeline import IngestionPipeline, JobType
+        from rag.job_store import JobStore
+        from rag.document import parse_file
+        from test.helper import setup_test_db
+
+        setup_test_db()
+        vector_db = get_vector_db()
+        sql_db = get_rational_db()
+
+        batch_size = config.EMBED_BATCH_SIZE
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job_store = JobStore(
+                db_path=os.path.join(temp_dir, 'jobs', 'jobs.db'),
+                checkpoint_dir=os.path.join(temp_dir, 'jobs', 'checkpoint'))
+            pipeline = IngestionPipeline(hash_workers=1,
+                                         parse_workers=1,
+                                         queue_size=1,
+                                         job_store=job_store)
+            file_path = os.path.join(temp_dir, 'ranges_test.md')
+            with open(file_path, 'w') as f:
+                f.write('\n\n'.join(
+                    f'paragraph {i} has enough words to keep'
+                    for i in range(100)))
+            uuids = [chunk.uuid for chunk in parse_file(file_path)]
+            self.assertGreater(len(uuids), 2)
+
+            # chunks are parsed, embedded and written two at a time
+            config.EMBED_BATCH_SIZE = 2
+            try:
+                pipeline.submit(JobType.NEW, file_path)
+                self.assertTrue(pipeline.wait_idle(timeout=120))
+            finally:
+                config.EMBED_BATCH_SIZE = batch_size
+            record = sql_db.get_document(name='ranges_test.md')
+            self.assertEqual(record['chunks'].split('\x07'), uuids)
+            self.assertEqual(len(vector_db.get(keys=uuids)), len(uuids))
+
+            pipeline.submit(JobType.DELETE, file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            self.assertEqual(len(vector_db.get(keys=uuids)), 0)
+
+    def test_ingest_concurrent(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from rag.db import get_vector_db, get_rational_db
+        from rag.pipeline import IngestionPipeline, JobType
+        from rag.job_store import JobStore
+        from test.helper import setup_test_db
+
+        setup_test_db()
+        vector_db = get_vector_db()
+        sql_db = get_rational_db()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job_store = JobStore(
+                db_path=os.path.join(temp_dir, 'jobs', 'jobs.db'),
+                checkpoint_dir=os.path.join(temp_dir, 'jobs', 'checkpoint'))
+            pipeline = IngestionPipeline(hash_workers=4,
+                                         parse_workers=2,
+                                         queue_size=2,
+                                         job_store=job_store)
+            file_paths = []
+            for i in range(8):
+                file_path = os.path.join(temp_dir, f'concurrent_{i}.md')
+                with open(file_path, 'w') as f:
+                    f.write(f'document {i} has enough words to keep')
+                file_paths.append(file_path)
+
+            # same files submitted from several threads at once, jobs of a
+            # path are applied one by one and hash, parse and write stages
+            # share the document db.
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(
+                    executor.map(
+                        lambda p: pipeline.submit(JobType.NEW, p),
+                        file_paths * 3))
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            names = [
+                n for n in sql_db.get_all_documents()
+                if n.startswith('concurrent_')
+            ]
+            self.assertCountEqual(names,
+                                  [os.path.basename(p) for p in file_paths])
+            for name in names:
+                uuids = sql_db.get_document(name=name)['chunks'].split('\x07')
+                self.assertEqual(len(vector_db.get(keys=uuids)), len(uuids))
+
+            for file_path in file_paths:
+                pipeline.submit(JobType.DELETE, file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            self.assertEqual(job_store.unfinished(), [])
+
+    def test_recover(self):
+        import config
+        from parse.parser import Chunk, ChunkType
+        from rag.db import get_vector_db, get_rational_db
+        from rag.pipeline import IngestionPipeline, JobType
+        from rag.job_store import JobStore
+        from utils import get_file_hash64
+        from test.helper import setup_test_db
+
+        setup_test_db()
+        vector_db = get_vector_db()
+        sql_db = get_rational_db()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job_store = JobStore(
+                db_path=os.path.join(temp_dir, 'jobs', 'jobs.db'),
+                checkpoint_dir=os.path.join(temp_dir, 'jobs', 'checkpoint'))
+            file_path = os.path.join(temp_dir, 'recover_test.md')
+            with open(file_path, 'w') as f:
+                f.write('file content with enough words to keep')
+
+            # job parsed by last run, checkpoint differs from parse result so
+            # that a resumed parse would be noticed.
+            job_id = job_store.add(JobType.NEW, file_path)
+            job_store.start(job_id)
+            job_store.update(job_id, content_hash=get_file_hash64(file_path))
+            chunks = [
+                Chunk(content_type=ChunkType.TEXT,
+                      file_name='recover_test.md',
+                      content=b'checkpointed content with enough words',
+                      extra_description=b'')
+            ]
+            job_store.save_chunks(job_id, chunks)
+
+            pipeline = IngestionPipeline(hash_workers=1,
+                                         parse_workers=1,
+                                         queue_size=2,
+                                         job_store=job_store)
+            pipeline.recover()
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            record = sql_db.get_document(name='recover_test.md')
+            self.assertEqual(record['chunks'], chunks[0].uuid)
+            self.assertEqual(len(vector_db.get(keys=[chunks[0].uuid])), 1)
+            self.assertEqual(job_store.unfinished(), [])
+            self.assertEqual(os.listdir(job_store.checkpoint_dir), [])
+
+            pipeline.submit(JobType.DELETE, file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+
+            # job interrupted after writing some chunks, file is changed
+            # before restart, chunks written are stale.
+            job_id = job_store.add(JobType.NEW, file_path)
+            job_store.start(job_id)
+            job_store.update(job_id, content_hash=get_file_hash64(file_path))
+            job_store.add_written(job_id, [chunks[0].uuid])
+            self.assertEqual(vector_db.insert_many(chunks), [True])
+            with open(file_path, 'w') as f:
+                f.write('file content is changed with enough words')
+            pipeline.recover()
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            self.assertEqual(len(vector_db.get(keys=[chunks[0].uuid])), 0)
+            record = sql_db.get_document(name='recover_test.md')
+            self.assertNotEqual(record['chunks'], chunks[0].uuid)
+            self.assertEqual(job_store.get_written(job_id), [])
+
+            pipeline.submit(JobType.DELETE, file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+
+            # job interrupted too many times is not resumed, its chunks
+            # written are deleted
+            job_id = job_store.add(JobType.NEW, file_path)
+            for _ in range(config.INGEST_JOB_MAX_ATTEMPTS):
+                job_store.start(job_id)
+            job_store.add_written(job_id, [chunks[0].uuid])
+            self.assertEqual(vector_db.insert_many(chunks), [True])
+            pipeline.recover()
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            self.assertTrue(sql_db.get_document(name='recover_test.md') is None)
+            self.assertEqual(len(vector_db.get(keys=[chunks[0].uuid])), 0)
+
+    def test_memory_budget(self):
+        import threading
+        from rag.pipeline import MemoryBudget
+
+        budget = MemoryBudget(capacity=100)
+        self.assertEqual(budget.acquire(60), 60)
+        acquired = threading.Event()
+
+        def _acquire():
+            budget.acquire(60)
+            acquired.set()
+
+        threading.Thread(target=_acquire, daemon=True).start()
+        self.assertFalse(acquired.wait(timeout=0.2))
+        budget.release(60)
+        self.assertTrue(acquired.wait(timeout=5))
+
+        # oversized request is granted alone
+        budget.release(60)
+        self.assertEqual(budget.acquire(1000), 100)
+        budget.release(100)
+        self.assertEqual(budget.used, 0)
+
+    def test_backpressure(self):
+        from rag.db import get_rational_db
+        from rag.pipeline import IngestionPipeline, JobType
+        from rag.job_store import JobStore
+        from rag.document import parse_file
+        from test.helper import setup_test_db
+
+        setup_test_db()
+        sql_db = get_rational_db()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job_store = JobStore(
+                db_path=os.path.join(temp_dir, 'jobs', 'jobs.db'),
+                checkpoint_dir=os.path.join(temp_dir, 'jobs', 'checkpoint'))
+            # one job at a time, every parsed job exceeds memory budget, the
+            # large file is parsed by a worker like others and indexed in
+            # streaming mode.
+            pipeline = IngestionPipeline(hash_workers=2,
+                                         parse_workers=2,
+                                         queue_size=2,
+                                         job_store=job_store,
+                                         max_pending_jobs=1,
+                                         memory_budget=16,
+                                         stream_file_size=1024)
+            file_paths = []
+            for i, num in enumerate([1, 2, 3, 100]):
+                file_path = os.path.join(temp_dir, f'backpressure_{i}.md')
+                with open(file_path, 'w') as f:
+                    f.write('\n\n'.join(
+                        f'paragraph {i} {j} has enough words to keep'
+                        for j in range(num)))
+                file_paths.append(file_path)
+
+            for file_path in file_paths:
+                pipeline.submit(JobType.NEW, file_path)
+                self.assertLessEqual(pipeline._unfinished, 1)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+            self.assertEqual(pipeline._memory_budget.used, 0)
+
+            for file_path in file_paths:
+                record = sql_db.get_document(name=os.path.basename(file_path))
+                self.assertEqual(
+                    record['chunks'].split('\x07'),
+                    [chunk.uuid for chunk in parse_file(file_path)])
+                pipeline.submit(JobType.DELETE, file_path)
+            self.assertTrue(pipeline.wait_idle(timeout=120))
+
+
+if __name__ == '__main__':
+
+    unittest.main()
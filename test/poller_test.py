@@ -0,0 +1,125 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+
+class RecordDebouncer:
+    """
+    Record submitted jobs instead of running them.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.jobs = []
+
+    def submit(self, job_type, file_path, src_path=None):
+        file_path = os.path.relpath(file_path, self.root_dir)
+        if src_path is None:
+            self.jobs.append((job_type, file_path))
+        else:
+            self.jobs.append(
+                (job_type, file_path, os.path.relpath(src_path,
+                                                      self.root_dir)))
+
+
+class TestDirectoryPoller(unittest.TestCase):
+
+    def _write(self, temp_dir: str, name: str, content: str):
+        with open(os.path.join(temp_dir, name), 'w') as f:
+            f.write(content)
+
+    def test_scan(self):
+        from rag.poller import DirectoryPoller
+        from rag.pipeline import JobType
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._write(temp_dir, 'a.md', 'a')
+            self._write(temp_dir, 'b.md', 'b')
+            os.mkdir(os.path.join(temp_dir, 'sub'))
+
+            debouncer = RecordDebouncer(temp_dir)
+            # existing files are in snapshot, nothing changed
+            poller = DirectoryPoller(temp_dir, debouncer, stat_batch=1)
+            self.assertEqual(poller.scan(), 0)
+
+            self._write(temp_dir, 'c.md', 'c')
+            self._write(temp_dir, '.hidden.md', 'hidden')
+            os.rename(os.path.join(temp_dir, 'a.md'),
+                      os.path.join(temp_dir, 'd.md'))
+            os.remove(os.path.join(temp_dir, 'b.md'))
+            self.assertEqual(poller.scan(), 3)
+            self.assertCountEqual(debouncer.jobs, [
+                (JobType.NEW, 'c.md'),
+                (JobType.MOVE, 'd.md', 'a.md'),
+                (JobType.DELETE, 'b.md'),
+            ])
+
+            # modified files are found by round robin stat, one per scan
+            debouncer.jobs.clear()
+            poller._hot.clear()
+            self._write(temp_dir, 'c.md', 'c modified')
+            self._write(temp_dir, 'd.md', 'd modified')
+            self.assertEqual(sum(poller.scan() for _ in range(2)), 2)
+            self.assertCountEqual(debouncer.jobs, [
+                (JobType.NEW, 'c.md'),
+                (JobType.NEW, 'd.md'),
+            ])
+
+            # recently changed files are stat on every scan
+            debouncer.jobs.clear()
+            self._write(temp_dir, 'c.md', 'c modified again')
+            self._write(temp_dir, 'd.md', 'd modified again')
+            self.assertEqual(poller.scan(), 2)
+            self.assertEqual(poller.scan(), 0)
+
+    def test_scan_tree(self):
+        from rag.poller import DirectoryPoller
+        from rag.pipeline import JobType
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.makedirs(os.path.join(temp_dir, 'a', 'b'))
+            os.makedirs(os.path.join(temp_dir, '.hidden'))
+            self._write(temp_dir, 'a/b/x.md', 'x')
+
+            debouncer = RecordDebouncer(temp_dir)
+            poller = DirectoryPoller(temp_dir, debouncer, stat_batch=1)
+            self.assertEqual(poller.scan(), 0)
+
+            # created in new and nested directories
+            os.makedirs(os.path.join(temp_dir, 'c', 'd'))
+            self._write(temp_dir, 'c/d/y.md', 'y')
+            self._write(temp_dir, 'a/b/z.md', 'z')
+            self._write(temp_dir, '.hidden/h.md', 'h')
+            # changed directories are found in round robin, one per scan
+            for _ in range(4):
+                poller.scan()
+            self.assertCountEqual(debouncer.jobs, [
+                (JobType.NEW, os.path.join('c', 'd', 'y.md')),
+                (JobType.NEW, os.path.join('a', 'b', 'z.md')),
+            ])
+
+            # directory renamed, files in it are moved
+            debouncer.jobs.clear()
+            os.rename(os.path.join(temp_dir, 'a'), os.path.join(temp_dir, 'e'))
+            for _ in range(4):
+                poller.scan()
+            self.assertCountEqual(debouncer.jobs, [
+                (JobType.MOVE, os.path.join('e', 'b', 'x.md'),
+                 os.path.join('a', 'b', 'x.md')),
+                (JobType.MOVE, os.path.join('e', 'b', 'z.md'),
+                 os.path.join('a', 'b', 'z.md')),
+            ])
+
+            # directory deleted
+            debouncer.jobs.clear()
+            shutil.rmtree(os.path.join(temp_dir, 'c'))
+            for _ in range(4):
+                poller.scan()
+            self.assertEqual(debouncer.jobs,
+                             [(JobType.DELETE, os.path.join('c', 'd', 'y.md'))])
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import time
+import tempfile
+
+
+class TestParseScheduler(unittest.TestCase):
+
+    def _write(self, temp_dir: str, name: str, size: int) -> str:
+        file_path = os.path.join(temp_dir, name)
+        with open(file_path, 'wb') as f:
+            f.write(b'0' * size)
+        return file_path
+
+    def test_priority(self):
+        from rag.scheduler import ParseScheduler
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # 100s and 200s large pdfs, a small markdown note
+            pdf_a = self._write(temp_dir, 'a.pdf', 200 * 1024 * 100)
+            pdf_b = self._write(temp_dir, 'b.pdf', 200 * 1024 * 200)
+            note = self._write(temp_dir, 'c.md', 2048)
+
+            scheduler = ParseScheduler(workers=2,
+                                       large_seconds=60,
+                                       recent_seconds=0)
+            for p in [pdf_a, pdf_b, note]:
+                scheduler.put(p, file_path=p)
+
+            status = scheduler.status(note)
+            self.assertEqual(status['position'], 1)
+            self.assertLess(status['eta_seconds'], 1)
+            self.assertEqual(scheduler.status(pdf_b)['position'], 3)
+
+            # small note first, then one large job, the other large job is
+            # held back so that one worker is left for small jobs.
+            self.assertEqual(scheduler.get(), note)
+            self.assertEqual(scheduler.get(), pdf_a)
+            self.assertEqual(scheduler.status(pdf_a)['position'], 0)
+            scheduler.done(note)
+            self.assertEqual(scheduler._next(), None)
+            scheduler.done(pdf_a)
+            self.assertEqual(scheduler.get(), pdf_b)
+
+    def test_aging(self):
+        from rag.scheduler import ParseScheduler
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pdf = self._write(temp_dir, 'a.pdf', 200 * 1024 * 2)
+            note = self._write(temp_dir, 'b.md', 2048)
+
+            # large job waited longer than its extra cost goes first
+            scheduler = ParseScheduler(workers=1, aging=100)
+            scheduler.put(pdf, file_path=pdf)
+            time.sleep(0.05)
+            scheduler.put(note, file_path=note)
+            self.assertEqual(scheduler.get(), pdf)
+
+    def test_throughput(self):
+        from rag.scheduler import ParseScheduler
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pdf = self._write(temp_dir, 'a.pdf', 200 * 1024)
+
+            # time waited before parse starts is not counted
+            scheduler = ParseScheduler(workers=1)
+            scheduler.put(pdf, file_path=pdf)
+            self.assertEqual(scheduler.get(), pdf)
+            time.sleep(0.5)
+            scheduler.start(pdf)
+            self.assertGreater(scheduler.status(pdf)['eta_seconds'], 0.9)
+            scheduler.done(pdf)
+            self.assertGreater(scheduler._throughput['pdf'], 1000 * 1024)
+
+            # parse seconds given by worker, excluding downstream waits
+            throughput = scheduler._throughput['pdf']
+            scheduler.put(pdf, file_path=pdf)
+            scheduler.get()
+            time.sleep(0.5)
+            scheduler.done(pdf, seconds=2)
+            self.assertAlmostEqual(scheduler._throughput['pdf'],
+                                   0.8 * throughput + 0.2 * 200 * 1024 / 2)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -14,6 +14,22 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(tokens, want)
         pass
 
+    def test_open_mmap(self):
+        import tempfile
+        from utils import open_mmap, get_hash64, get_file_hash64
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'test.bin')
+            with open(file_path, 'wb') as f:
+                f.write(b'mapped content' * 1000)
+            with open_mmap(file_path) as buf:
+                self.assertEqual(len(buf), 14000)
+                self.assertEqual(get_hash64(buf), get_file_hash64(file_path))
+
+            open(file_path, 'wb').close()
+            with open_mmap(file_path) as buf:
+                self.assertEqual(buf, b'')
+
 
 if __name__ == '__main__':
 
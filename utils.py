@@ -1,6 +1,9 @@
 import logging
+import mmap
 import os
+import time
 import traceback
+from contextlib import contextmanager
 from typing import Any, Tuple
 from logging.handlers import RotatingFileHandler
 
@@ -117,6 +120,124 @@ def get_hash64(content: bytes) -> str:
     return xxhash.xxh64(content).hexdigest()
 
 
+def get_file_hash64(file_path: str, block_size: int = 4 * 1024 * 1024) -> str:
+    """
+    Hash file content block by block, same digest as `get_hash64` over the whole
+    file content without loading the file into memory.
+    """
+    h = xxhash.xxh64()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+@contextmanager
+def open_mmap(file_path: str):
+    """
+    Map file into memory read-only, pages are loaded by the OS on access and
+    shared with the page cache, so hashing and parsing the buffer copies no
+    file content into the process.
+
+    Returns:
+    - A context manager of the mapped buffer, `b''` for empty file.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+def get_file_fingerprint(st: os.stat_result) -> str:
+    """
+    Cheap file change fingerprint built from file stat, file content is
+    considered unchanged if size, mtime and inode are all unchanged.
+    """
+    return f'{st.st_size}:{st.st_mtime_ns}:{st.st_ino}'
+
+
+def get_child_pids(pid: int) -> list[int]:
+    """
+    Get pids of all descendant processes, read from `/proc`, empty list on
+    platforms without procfs.
+    """
+    children = []
+    try:
+        for tid in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{tid}/children', 'r') as f:
+                children.extend(int(c) for c in f.read().split())
+    except OSError:
+        return []
+    return children + [p for c in children for p in get_child_pids(c)]
+
+
+def get_process_rss(pid: int, include_children: bool = True) -> int:
+    """
+    Get resident set size in bytes of a process, read from `/proc`. Returns 0
+    if the process does not exist or on platforms without procfs.
+
+    Args:
+    - pid: process id.
+    - include_children: add up rss of all descendant processes.
+    """
+    pids = [pid]
+    if include_children:
+        pids.extend(get_child_pids(pid))
+
+    rss = 0
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/statm', 'r') as f:
+                rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            continue
+    return rss
+
+
+class StepTimer:
+    """
+    Accumulate wall time of named steps, steps run more than once are summed.
+
+    Usage:
+    ```
+    timer = StepTimer()
+    with timer.step('analyze'):
+        ...
+    logging.info(timer.summary())
+    ```
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + \
+                time.perf_counter() - start
+
+    def merge(self, timings: dict):
+        for k, v in timings.items():
+            self.timings[k] = self.timings.get(k, 0.0) + v
+
+    def reset(self):
+        self.timings = {}
+
+    def summary(self) -> str:
+        return ', '.join(f'{k}: {v:.3f}s' for k, v in self.timings.items())
+
+
 def logging_exception(e: Exception):
     logging.info(f"Exception: {type(e).__name__} - {e}")
     formatted_traceback = traceback.format_exc()